@@ -0,0 +1,331 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import warnings
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "predictions"))
+sys.path.insert(0, os.path.join(BENCH_DIR, "..", "plots"))
+
+# -------- END-TO-END BENCHMARK SUITE --------
+# Every benchmark runs in a fresh (spawned) process so its peak RSS is its own,
+# against a synthetic cohort generated once per run. Each one returns per-item
+# latencies; the runner reports items/sec, p50/p95 latency and peak RSS as JSON,
+# tagged with the git commit, so two result files can be compared (--compare).
+#
+#   python benchmarks/run_benchmarks.py --patients 40 --output bench.json
+#   python benchmarks/run_benchmarks.py --only request_path_gpt4o --latency 0.2 --concurrency 8
+#   python benchmarks/run_benchmarks.py --compare bench_before.json --output bench_after.json
+
+PROVIDER_SCRIPTS = {"gpt4o": "GPT4o_prediction", "grok": "Grok_prediction", "gemini": "gemini_prediction"}
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Silence the scripts' per-case prints while timing."""
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def _slice_paths(config: dict) -> List[str]:
+    folder = config["IMAGES_FOLDER"]
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder))
+
+
+# -------- BENCHMARKS (run inside the child process) --------
+def bench_encode_image(config: dict) -> dict:
+    """Decode + resize + JPEG-encode + base64 of one slice, as encode_image does without a cache."""
+    from image_cache import ImageCache
+
+    cache = ImageCache(None)
+    latencies = []
+    for path in _slice_paths(config):
+        start = time.perf_counter()
+        cache.get_base64(path, max_size=(1024, 1024), quality=85)
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies}
+
+
+def bench_encode_image_cached(config: dict) -> dict:
+    """encode_image served from a warm on-disk image cache (hash check + read)."""
+    from image_cache import ImageCache
+
+    cache = ImageCache(os.path.join(config["workdir"], "bench_image_cache"))
+    paths = _slice_paths(config)
+    for path in paths:
+        cache.get_base64(path, max_size=(1024, 1024), quality=85)
+    latencies = []
+    for path in paths:
+        start = time.perf_counter()
+        cache.get_base64(path, max_size=(1024, 1024), quality=85)
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies, "hit_rate": cache.stats()["hit_rate"]}
+
+
+def bench_image_lookup(config: dict) -> dict:
+    """Slices of one patient from the case index (build and reload times reported separately)."""
+    from case_index import load_case_index
+
+    index_path = os.path.join(config["workdir"], "bench_case_index.json")
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    start = time.perf_counter()
+    with _quiet():
+        load_case_index(config["IMAGES_FOLDER"], index_path)
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    with _quiet():
+        index = load_case_index(config["IMAGES_FOLDER"], index_path)
+    reload = time.perf_counter() - start
+
+    latencies = []
+    for _ in range(20):
+        for pid in range(1, config["patients"] + 1):
+            start = time.perf_counter()
+            index.slices(pid)
+            latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies, "index_build_s": build, "index_reload_s": reload}
+
+
+def bench_slice_dedup(config: dict) -> dict:
+    """Perceptual hashing + near-duplicate filtering of one case's slices (no hashes in the index yet)."""
+    from case_index import load_case_index
+    from slice_dedup import SliceDeduper
+
+    with _quiet():
+        index = load_case_index(config["IMAGES_FOLDER"])
+    deduper = SliceDeduper("dhash")
+    latencies = []
+    for pid in index.patients():
+        start = time.perf_counter()
+        deduper.filter(index.slices(pid))
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies, "dropped_fraction": deduper.dropped / max(1, deduper.slices)}
+
+
+def bench_request_path(config: dict, provider: str) -> dict:
+    """Whole per-case path of a prediction script (preprocess, request, parse, journal) against the mock server."""
+    import mock_llm_server
+
+    workdir = config["workdir"]
+    with mock_llm_server.running(latency=config["latency"], jitter=config["jitter"],
+                                 error_rate=config["error_rate"], rate_429=config["rate_429"],
+                                 retry_after=0.05) as (url, server):
+        os.environ.update({
+            "EXCEL_PATH": config["EXCEL_PATH"],
+            "IMAGES_FOLDER": config["IMAGES_FOLDER"],
+            "OUTPUT_FILE": os.path.join(workdir, f"bench_{provider}.xlsx"),
+            "CASE_INDEX_FILE": os.path.join(workdir, "bench_case_index.json"),
+            "IMAGE_CACHE_DIR": "",
+            "SHEET_CACHE_DIR": os.path.join(workdir, "bench_sheet_cache"),
+            "RESPONSE_CACHE_MODE": "off",
+            "RETRY_BASE_DELAY": "0.05",
+            "OPENAI_BASE_URL": url,
+            "XAI_API_URL": url + "/chat/completions",
+            "GEMINI_API_ENDPOINT": url[:-len("/v1")],
+            "OPENAI_API_KEY": "bench", "XAI_API_KEY": "bench", "GEMINI_API_KEY": "bench",
+        })
+        journal = os.path.join(workdir, f"bench_{provider}.{provider}.journal.jsonl")
+        if os.path.exists(journal):
+            os.remove(journal)
+
+        import importlib
+        with _quiet():
+            script = importlib.import_module(PROVIDER_SCRIPTS[provider])
+        process_case = script.process_case
+        latencies, failures = [], []
+
+        def timed_case(prepared):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = process_case(prepared)
+                return result
+            finally:
+                latencies.append(time.perf_counter() - start)
+                if result is None:
+                    failures.append(prepared["item"]["Reihenfolge Bilder"])
+
+        script.process_case = timed_case  # looked up at call time by process_excel_and_images
+        start = time.perf_counter()
+        with _quiet():
+            script.process_excel_and_images(concurrency=config["concurrency"])
+        wall = time.perf_counter() - start
+        stats = server.state.snapshot()
+    return {"latencies": latencies, "wall_s": wall, "failed_cases": len(failures), "server": stats}
+
+
+def bench_parse_response(config: dict) -> dict:
+    """Categories and Likert scores of one free-text answer (shared response parser)."""
+    from synthetic import response_texts
+    from response_parser import parse_response
+
+    texts = response_texts(config["texts"], seed=config["seed"])
+    latencies = []
+    for text in texts:
+        start = time.perf_counter()
+        parse_response(text)
+        latencies.append(time.perf_counter() - start)
+    return {"latencies": latencies}
+
+
+def bench_parse_responses_bulk(config: dict) -> dict:
+    """Bulk parsing of an archive of answers (every answer gets the average latency)."""
+    import pandas as pd
+    from synthetic import response_texts
+    from response_parser import parse_responses
+
+    texts = pd.Series(response_texts(config["texts"], seed=config["seed"]))
+    start = time.perf_counter()
+    parse_responses(texts)
+    wall = time.perf_counter() - start
+    return {"latencies": [wall / len(texts)] * len(texts), "wall_s": wall}
+
+
+def bench_compute_weighted_kappa_stats(config: dict) -> dict:
+    """Mean/std kappa of one rater pair, plus one batched pass over all comparisons."""
+    from synthetic import rater_sheet
+    from cohen_kappa_plots import comparisons, compute_weighted_kappa_stats, kappa_metrics
+
+    df = rater_sheet(config["kappa_cases"], seed=config["seed"])
+    latencies = []
+    for col1, col2 in comparisons:
+        start = time.perf_counter()
+        compute_weighted_kappa_stats(df[col1], df[col2])
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    kappa_metrics(df, comparisons)
+    return {"latencies": latencies, "all_pairs_s": time.perf_counter() - start}
+
+
+BENCHMARKS: Dict[str, Callable[[dict], dict]] = {
+    "encode_image": bench_encode_image,
+    "encode_image_cached": bench_encode_image_cached,
+    "image_lookup": bench_image_lookup,
+    "slice_dedup": bench_slice_dedup,
+    **{f"request_path_{provider}": (lambda config, p=provider: bench_request_path(config, p))
+       for provider in PROVIDER_SCRIPTS},
+    "parse_response": bench_parse_response,
+    "parse_responses_bulk": bench_parse_responses_bulk,
+    "compute_weighted_kappa_stats": bench_compute_weighted_kappa_stats,
+}
+
+
+def _run_in_child(name: str, config: dict) -> dict:
+    random.seed(config["seed"])
+    warnings.filterwarnings("ignore", category=FutureWarning)  # google.generativeai deprecation notice
+    result = BENCHMARKS[name](config)
+    latencies = np.asarray(result.pop("latencies"), dtype=np.float64)
+    wall = result.pop("wall_s", float(latencies.sum()))
+    summary = {
+        "items": int(latencies.size),
+        "items_per_sec": latencies.size / wall if wall > 0 else None,
+        "p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies.size else None,
+        "p95_ms": float(np.percentile(latencies, 95) * 1000) if latencies.size else None,
+        # KiB on Linux; children covers the preprocessing workers
+        "peak_rss_mb": max(resource.getrusage(who).ru_maxrss
+                           for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) / 1024,
+    }
+    return {**summary, **result}
+
+
+# -------- RUNNER --------
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(names: List[str], config: dict) -> dict:
+    from synthetic import write_cohort
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        start = time.perf_counter()
+        config = {**config, "workdir": workdir,
+                  **write_cohort(workdir, config["patients"], config["slices"], config["size"], config["seed"])}
+        print(f"🧪 Synthetic cohort: {config['patients']} patient(s) x {config['slices']} slice(s) "
+              f"at {config['size']} px ({time.perf_counter() - start:.1f}s)")
+
+        results = {}
+        spawn = multiprocessing.get_context("spawn")
+        for name in names:
+            with ProcessPoolExecutor(max_workers=1, mp_context=spawn) as pool:
+                try:
+                    results[name] = pool.submit(_run_in_child, name, config).result()
+                except Exception as e:
+                    results[name] = {"error": f"{type(e).__name__}: {e}"}
+            print(format_result(name, results[name]))
+
+    config = {k: v for k, v in config.items() if k not in ("workdir", "EXCEL_PATH", "IMAGES_FOLDER")}
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": config,
+        "benchmarks": results,
+    }
+
+
+def format_result(name: str, result: dict, baseline: Optional[dict] = None) -> str:
+    if "error" in result:
+        return f"❌ {name}: {result['error']}"
+    line = (f"⏱️ {name}: {result['items_per_sec']:.1f}/s, p50 {result['p50_ms']:.3f} ms, "
+            f"p95 {result['p95_ms']:.3f} ms, peak RSS {result['peak_rss_mb']:.0f} MB")
+    if baseline and "error" not in baseline and baseline.get("items_per_sec"):
+        change = result["items_per_sec"] / baseline["items_per_sec"] - 1
+        line += f" ({change:+.0%} throughput, p95 {baseline['p95_ms']:.3f} → {result['p95_ms']:.3f} ms)"
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prediction and analysis pipeline offline.")
+    parser.add_argument("--output", default="bench_results.json", help="JSON file for the results.")
+    parser.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument("--compare", help="Earlier results JSON to compare against.")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--slices", type=int, default=3, help="Slices per patient.")
+    parser.add_argument("--size", type=int, default=512, help="Slice size in pixels.")
+    parser.add_argument("--concurrency", type=int, default=4, help="Cases in flight for the request path.")
+    parser.add_argument("--latency", type=float, default=0.05, help="Mock server latency (seconds).")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random mock latency (seconds).")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock requests answered 500.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of mock requests answered 429.")
+    parser.add_argument("--texts", type=int, default=5000, help="Responses parsed by the response parser benchmarks.")
+    parser.add_argument("--kappa-cases", type=int, default=2000, help="Cases in the synthetic rater sheet.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "only", "compare")}
+    report = run_benchmarks(args.only or list(BENCHMARKS), config)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"📁 Results saved to: {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n📈 Compared with {baseline.get('commit') or args.compare}:")
+        for name, result in report["benchmarks"].items():
+            if name in baseline.get("benchmarks", {}):
+                print(format_result(name, result, baseline["benchmarks"][name]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+from PIL import Image
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plots"))
+from dicom_series import synthetic_volume, window_volume
+from cohen_kappa_plots import comparisons
+
+# -------- SYNTHETIC CT SLICES, COHORTS AND RATER SHEETS --------
+# Deterministic inputs for the benchmarks (and for trying the scripts without
+# real data): CT-like JPEG slices rendered from the head phantom in
+# dicom_series.py, an input sheet in the layout the prediction scripts read,
+# a rater sheet with the columns the plot scripts compare, and free-text
+# answers in the format the Likert parsers expect.
+
+HISTORIES = (
+    "Keine Vorerkrankungen bekannt.",
+    "Sturz auf den Hinterkopf, GCS 14.",
+    "Plötzlicher Vernichtungskopfschmerz, bekannte Hypertonie.",
+    "Antikoaguliert (Apixaban), Verkehrsunfall.",
+    "Progrediente Vigilanzminderung seit 2 Tagen.",
+)
+LABELS = ("1", "2", "3", "4", "5", "2+3", "1+3", "1+5", "3+5", "4+1")
+
+
+def ct_slices(n_slices: int = 3, size: int = 512, seed: int = 0) -> List[Image.Image]:
+    """`n_slices` brain-windowed grayscale slices through a fresh phantom."""
+    volume = window_volume(synthetic_volume(max(n_slices, 3), size, seed), "brain")
+    middle = np.linspace(volume.shape[0] * 0.3, volume.shape[0] * 0.7, n_slices).astype(int)
+    return [Image.fromarray(volume[i]).convert("RGB") for i in middle]
+
+
+def write_cohort(out_dir: str, n_patients: int = 20, slices_per_patient: int = 3, size: int = 512,
+                 seed: int = 0) -> Dict[str, str]:
+    """Write ct_scans/Patient<id>_<n>.jpg and input_data.xlsx; returns their paths (EXCEL_PATH, IMAGES_FOLDER)."""
+    rng = np.random.default_rng(seed)
+    images_folder = os.path.join(out_dir, "ct_scans")
+    os.makedirs(images_folder, exist_ok=True)
+    for pid in range(1, n_patients + 1):
+        for n, image in enumerate(ct_slices(slices_per_patient, size, seed + pid), start=1):
+            image.save(os.path.join(images_folder, f"Patient{pid}_{n}.jpg"), quality=92)
+
+    excel_path = os.path.join(out_dir, "input_data.xlsx")
+    pd.DataFrame({
+        "Reihenfolge Bilder": np.arange(1, n_patients + 1),
+        "Anamnese (medical history)": rng.choice(HISTORIES, n_patients),
+    }).to_excel(excel_path, index=False)
+    return {"EXCEL_PATH": excel_path, "IMAGES_FOLDER": images_folder}
+
+
+def rater_sheet(n_cases: int = 200, agreement: float = 0.6, seed: int = 0) -> pd.DataFrame:
+    """Reference column plus every compared rater column; each rater copies the reference with p=`agreement`.
+
+    Labels mix ints and "2+3" strings like a real sheet; Likert columns (<rater>_With / _Without) are added too.
+    """
+    rng = np.random.default_rng(seed)
+    reference = rng.choice(LABELS, n_cases)
+    as_cell = lambda label: int(label) if label.isdigit() else label
+    df = pd.DataFrame({"Radiologist Prediction": [as_cell(label) for label in reference]})
+    for col in dict.fromkeys(col for col, _ in comparisons):
+        labels = np.where(rng.random(n_cases) < agreement, reference, rng.choice(LABELS, n_cases))
+        df[col] = [as_cell(label) for label in labels]
+    for rater in dict.fromkeys(col.split("-with")[0] for col, _ in comparisons):
+        df[f"{rater}_Without"] = rng.integers(1, 6, n_cases)
+        df[f"{rater}_With"] = np.clip(df[f"{rater}_Without"] + rng.integers(0, 2, n_cases), 1, 5)
+    return df
+
+
+def response_texts(n: int = 1000, seed: int = 0, noise: Optional[float] = 0.1) -> List[str]:
+    """Free-text answers in the prompt's format; a fraction `noise` omits one or both Likert lines."""
+    rng = np.random.default_rng(seed)
+    texts = []
+    for _ in range(n):
+        parts = []
+        for i, condition in enumerate(("without", "with")):
+            parts.append(f"{i + 1}. Hypothetical classification {condition} medical history:\n"
+                         f"- Category: {rng.choice(LABELS)}\n"
+                         f"- Reasoning: {'Hyperdense lesion near the convexity. ' * int(rng.integers(1, 4))}\n")
+            if not noise or rng.random() >= noise:
+                parts.append(f"- Likert confidence: {int(rng.integers(1, 6))}\n")
+        texts.append("\n".join(parts))
+    return texts
@@ -1,15 +1,19 @@
 import os
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.metrics import cohen_kappa_score
+import sys
 import textwrap
-from dotenv import load_dotenv
-from matplotlib.patches import Patch
+import numpy as np
+import pandas as pd
+from typing import Optional, Sequence, Tuple
+from kappa_engine import LABEL_SET, comparison_kappa_stats, parse_label_entry
+from resampling import WITH_SUFFIX, WITHOUT_SUFFIX, bootstrap_kappa, permutation_test_history
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from sheet_store import read_sheet, sheet_columns  # Parquet-backed Excel reads, shared with the prediction scripts
 
-# -------- LOAD ENVIRONMENT VARIABLES --------
-load_dotenv()
-excel_path = os.getenv("EXCEL_PATH", "input_data.xlsx")  # Default path if not in .env
+# -------- COHEN'S KAPPA AGREEMENT PLOT --------
+# Importable: the functions take DataFrames and only import matplotlib when a
+# figure is drawn, so plots/render_batch.py can render them headless (Agg) in
+# worker processes. Run the file directly for the interactive plot.
 
 # -------- COMPARISON PAIRS --------
 comparisons = [
@@ -35,78 +39,149 @@ comparisons = [
     ("grok-4-fast-reasoning-with-medical history", "Radiologist Prediction"),
 ]
 
-label_set = [1, 2, 3, 4, 5]
+label_set = list(LABEL_SET)
 
 # -------- HELPER FUNCTIONS --------
 def to_binary_vector(label_entry, label_set):
     """Convert label string like '2+3' to binary vector [0,1,1,0,0]."""
-    if isinstance(label_entry, str):
-        labels = list(map(int, label_entry.split('+')))
-    else:
-        labels = [int(label_entry)]
+    labels = parse_label_entry(label_entry)
     return [1 if lbl in labels else 0 for lbl in label_set]
 
 def compute_weighted_kappa_stats(true_col, pred_col):
     """Compute average Cohen's Kappa across all binary categories."""
-    y_true_bin = np.array([to_binary_vector(val, label_set) for val in true_col])
-    y_pred_bin = np.array([to_binary_vector(val, label_set) for val in pred_col])
-
-    kappas = []
-    for i in range(len(label_set)):
-        kappa = cohen_kappa_score(y_true_bin[:, i], y_pred_bin[:, i], weights='quadratic')
-        kappas.append(kappa)
-    return np.mean(kappas), np.std(kappas)
-
-# -------- LOAD DATA & CALCULATE METRICS --------
-df = pd.read_excel(excel_path)
-comparison_names = []
-kappa_means = []
-kappa_errors = []
-
-for col1, col2 in comparisons:
-    mean_kappa, std_kappa = compute_weighted_kappa_stats(df[col1], df[col2])
-    comparison_names.append(f"{col1} vs {col2}")
-    kappa_means.append(mean_kappa)
-    kappa_errors.append(std_kappa)
+    pair = pd.DataFrame({"true": np.asarray(true_col, dtype=object), "pred": np.asarray(pred_col, dtype=object)})
+    means, stds = comparison_kappa_stats(pair, [("true", "pred")], label_set)
+    return means[0], stds[0]
+
+def comparison_columns(comparisons: Sequence[Tuple[str, str]]):
+    """Distinct columns used by the comparisons, in order (what has to be loaded)."""
+    return list(dict.fromkeys(col for pair in comparisons for col in pair))
+
+def sheet_comparisons(columns: Sequence[str], reference: str = "Radiologist Prediction"):
+    """The default comparisons whose columns exist, plus any other '<rater>-with(out)-medical history'
+    column in the sheet (e.g. models added by predictions/multi_provider.py), compared to `reference`."""
+    columns = list(columns)
+    pairs = [pair for pair in comparisons if all(col in columns for col in pair)]
+    known = {col for col, _ in pairs}
+    if reference in columns:
+        pairs += [(col, reference) for col in columns
+                  if col.endswith((WITHOUT_SUFFIX, WITH_SUFFIX)) and col not in known]
+    return pairs
+
+def require_comparisons(pairs: Sequence[Tuple[str, str]], sheet: str):
+    """`pairs`, or a ValueError naming the sheet when there is nothing to compare."""
+    if not pairs:
+        raise ValueError(f"no comparison columns found in {sheet} "
+                         f"(expected 'Radiologist Prediction' and '<rater>-with(out)-medical history' columns)")
+    return pairs
+
+# -------- CALCULATE METRICS --------
+def kappa_metrics(df: pd.DataFrame, comparisons: Sequence[Tuple[str, str]] = comparisons,
+                  n_resamples: int = 0, seed: int = 0, workers: Optional[int] = 0,
+                  label_set: Sequence[int] = label_set) -> pd.DataFrame:
+    """Mean kappa per comparison plus lower/upper error bar lengths.
+
+    Error bars are case-level bootstrap CIs (asymmetric) when n_resamples > 0,
+    otherwise the std across labels.
+    """
+    if not len(comparisons):
+        raise ValueError("no comparison columns to compute kappa for")
+    # All comparison pairs in one batched pass (identical to per-pair sklearn kappas)
+    kappa_means, kappa_std = comparison_kappa_stats(df, comparisons, label_set)
+    err_low = err_high = kappa_std
+    if n_resamples > 0:
+        ci = bootstrap_kappa(df, comparisons, n_resamples=n_resamples, seed=seed, workers=workers,
+                             label_set=label_set)
+        err_low = np.clip(kappa_means - ci["ci_low"].to_numpy(), 0, None)
+        err_high = np.clip(ci["ci_high"].to_numpy() - kappa_means, 0, None)
+    return pd.DataFrame({
+        "comparison": [f"{col1} vs {col2}" for col1, col2 in comparisons],
+        "rater": [col1 for col1, _ in comparisons],
+        "kappa": kappa_means,
+        "err_low": err_low,
+        "err_high": err_high,
+    })
 
 # -------- PLOT HORIZONTAL BARS --------
-fig, ax = plt.subplots(figsize=(12, 10))
-
-# Wrap long labels
-wrapped_labels = ['\n'.join(textwrap.wrap(name, width=50)) for name in comparison_names]
-
-# Alternate colors for without/with history
-bar_colors = ['gold' if i % 2 == 0 else 'royalblue' for i in range(len(kappa_means))]
-
-# Draw bars with error bars
-bars = ax.barh(
-    wrapped_labels,
-    kappa_means,
-    xerr=kappa_errors,
-    capsize=6,
-    color=bar_colors,
-    edgecolor='black'
-)
-
-# Annotate values
-for bar, score in zip(bars, kappa_means):
-    width = bar.get_width()
-    ax.text(
-        width + 0.015,
-        bar.get_y() + bar.get_height() / 2,
-        f"{score:.2f}",
-        ha='left',
-        va='center',
-        fontsize=9
+def plot_kappa_bars(metrics: pd.DataFrame, ax=None, title: str = "Cohen Kappa Agreement with Error Bars"):
+    """Horizontal kappa bars with error bars; returns the figure."""
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Patch
+
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(12, max(4, 0.5 * len(metrics))))
+    else:
+        fig = ax.figure
+
+    # Wrap long labels
+    wrapped_labels = ['\n'.join(textwrap.wrap(name, width=50)) for name in metrics["comparison"]]
+
+    # Gold for without, blue for with medical history
+    bar_colors = ['gold' if WITHOUT_SUFFIX in rater else 'royalblue' for rater in metrics["rater"]]
+
+    # Draw bars with error bars
+    bars = ax.barh(
+        wrapped_labels,
+        metrics["kappa"],
+        xerr=np.vstack([metrics["err_low"], metrics["err_high"]]),
+        capsize=6,
+        color=bar_colors,
+        edgecolor='black'
     )
 
-# Aesthetics
-ax.set_xlim(0, 1)
-ax.set_xlabel("Cohen Kappa", fontsize=12)
-ax.set_title("Cohen Kappa Agreement with Error Bars", fontsize=14)
-ax.set_yticklabels(wrapped_labels, fontsize=9)
-ax.xaxis.grid(True, linestyle='--', alpha=0.7)
+    # Annotate values
+    for bar, score in zip(bars, metrics["kappa"]):
+        width = bar.get_width()
+        ax.text(
+            width + 0.015,
+            bar.get_y() + bar.get_height() / 2,
+            f"{score:.2f}",
+            ha='left',
+            va='center',
+            fontsize=9
+        )
+
+    # Aesthetics
+    ax.set_xlim(0, 1)
+    ax.set_xlabel("Cohen Kappa", fontsize=12)
+    ax.set_title(title, fontsize=14)
+    ax.set_yticks(range(len(wrapped_labels)))
+    ax.set_yticklabels(wrapped_labels, fontsize=9)
+    ax.xaxis.grid(True, linestyle='--', alpha=0.7)
+
+    # Add legend
+    legend_elements = [
+        Patch(facecolor='gold', edgecolor='black', label='Without medical history'),
+        Patch(facecolor='royalblue', edgecolor='black', label='With medical history'),
+    ]
+    ax.legend(handles=legend_elements, loc='lower right')
+    fig.tight_layout()
+    return fig
+
+# -------- RUN SCRIPT --------
+def main():
+    from dotenv import load_dotenv
+    import matplotlib.pyplot as plt
+
+    load_dotenv()
+    excel_path = os.getenv("EXCEL_PATH", "input_data.xlsx")  # Default path if not in .env
+    n_resamples = int(os.getenv("KAPPA_RESAMPLES", "10000"))  # Bootstrap / permutation resamples (0 = std error bars)
+    resample_seed = int(os.getenv("KAPPA_SEED", "0"))
+
+    # Only the rater columns being compared (and present in the sheet) are loaded
+    pairs = require_comparisons(sheet_comparisons(sheet_columns(excel_path)), excel_path)
+    df = read_sheet(excel_path, columns=comparison_columns(pairs))
+    metrics = kappa_metrics(df, pairs, n_resamples=n_resamples, seed=resample_seed, workers=None)
+
+    if n_resamples > 0:
+        # Paired permutation test: does the medical history change agreement with the reference?
+        history_tests = permutation_test_history(df, pairs, n_resamples=n_resamples, seed=resample_seed,
+                                                 label_set=label_set)
+        print("\nWith vs without medical history (paired permutation test):")
+        print(history_tests.to_string(index=False, float_format=lambda v: f"{v:.3f}"))
+
+    plot_kappa_bars(metrics)
+    plt.show()
 
-# Add legend
-legend_elements = [
-    Patch(facecolor='gold', edge
+if __name__ == "__main__":
+    main()
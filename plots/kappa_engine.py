@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Sequence, Tuple
+
+# -------- VECTORIZED MULTI-LABEL KAPPA ENGINE --------
+# Label strings such as "2+3" are parsed once per distinct value into a
+# (raters x cases x labels) bit tensor. Per-label Cohen's kappa for every rater
+# pair then comes from batched 2x2 confusion counts (one matrix product per
+# label) instead of one sklearn call per label and pair.
+#
+# For binary labels the quadratic weights are [[0, 1], [1, 0]], so the weighted
+# kappa reduces to 1 - (n01 + n10) / (e01 + e10). The arithmetic below follows
+# sklearn's cohen_kappa_score(..., weights="quadratic") step by step, so results
+# are bit-identical to it (including NaN where kappa is undefined).
+#
+# A missing rating (a case a model did not answer, or whose categories could not
+# be parsed: None, NaN, "" or "N/A") is the explicit "no answer" label: no
+# category is marked, so it counts as disagreement with any rater who chose one.
+
+LABEL_SET = (1, 2, 3, 4, 5)
+NO_ANSWER = "N/A"
+
+
+def is_no_answer(label_entry) -> bool:
+    if isinstance(label_entry, str):
+        return label_entry.strip() in ("", NO_ANSWER)
+    return label_entry is None or bool(pd.isna(label_entry))
+
+
+def parse_label_entry(label_entry) -> List[int]:
+    """'2+3' -> [2, 3]; 4 or 4.0 -> [4]; a missing rating -> [] (no category)."""
+    if is_no_answer(label_entry):
+        return []
+    if isinstance(label_entry, str):
+        return list(map(int, label_entry.split('+')))
+    return [int(label_entry)]
+
+
+def label_masks(values, label_set: Sequence[int] = LABEL_SET) -> np.ndarray:
+    """Boolean (cases x labels) matrix for one rater column, parsing each distinct value once."""
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=False)
+    lookup = np.array(
+        [[label in parse_label_entry(value) for label in label_set] for value in uniques], dtype=bool
+    ).reshape(len(uniques), len(label_set))
+    return lookup[codes]
+
+
+def label_tensor(df: pd.DataFrame, columns: Sequence[str], label_set: Sequence[int] = LABEL_SET) -> np.ndarray:
+    """Boolean (raters x cases x labels) tensor for the given rater columns."""
+    values = df[list(columns)].to_numpy(dtype=object).T  # (R, N)
+    return label_masks(values.ravel(), label_set).reshape(values.shape + (len(label_set),))
+
+
+def _pair_counts(tensor: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """(positives per rater and label (R, L), joint positives per label and rater pair (L, R, R))."""
+    n_cases = tensor.shape[1]
+    # float32 products are exact for counts below 2**24
+    dtype = np.float32 if n_cases < 2 ** 24 else np.float64
+    per_label = np.ascontiguousarray(tensor.transpose(2, 0, 1), dtype=dtype)  # (L, R, N)
+    both = np.matmul(per_label, per_label.transpose(0, 2, 1))
+    positives = tensor.sum(axis=1, dtype=np.int64)
+    return positives, np.rint(both).astype(np.int64)
+
+
+def kappa_from_counts(n_cases: int, true_pos: np.ndarray, pred_pos: np.ndarray, both: np.ndarray) -> np.ndarray:
+    """Quadratic-weighted kappa of binary labels, elementwise over broadcast count arrays."""
+    n = np.float64(n_cases)
+    observed = (pred_pos - both) + (true_pos - both)  # n01 + n10
+    # sklearn: expected = outer(column sums, row sums) / n, weighted by the off-diagonal
+    expected = ((n_cases - pred_pos) * true_pos) / n + (pred_pos * (n_cases - true_pos)) / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappa = 1 - observed.astype(np.float64) / expected
+    return np.where(expected == 0, np.nan, kappa)
+
+
+def pairwise_label_kappa(tensor: np.ndarray) -> np.ndarray:
+    """Per-label kappa for every ordered rater pair: array (R, R, L), [i, j] = kappa(rater i, rater j)."""
+    positives, both = _pair_counts(tensor)
+    true_pos = positives[:, None, :]  # rater i as y1
+    pred_pos = positives[None, :, :]  # rater j as y2
+    return kappa_from_counts(tensor.shape[1], true_pos, pred_pos, both.transpose(1, 2, 0))
+
+
+def comparison_kappa_stats(df: pd.DataFrame, comparisons: Sequence[Tuple[str, str]],
+                           label_set: Sequence[int] = LABEL_SET) -> Tuple[np.ndarray, np.ndarray]:
+    """Mean and std over labels of the kappa for each (rater, reference) pair, like the sklearn loop."""
+    columns = list(dict.fromkeys(col for pair in comparisons for col in pair))
+    position = {col: i for i, col in enumerate(columns)}
+    tensor = label_tensor(df, columns, label_set)
+    positives, both = _pair_counts(tensor)
+
+    # col1 is y1 (true_col) and col2 is y2, as in compute_weighted_kappa_stats(df[col1], df[col2])
+    first = np.array([position[a] for a, _ in comparisons])
+    second = np.array([position[b] for _, b in comparisons])
+    kappas = kappa_from_counts(tensor.shape[1], positives[first], positives[second], both[:, first, second].T)
+    return np.mean(kappas, axis=1), np.std(kappas, axis=1)
+
+
+def agreement_matrix(df: pd.DataFrame, columns: Sequence[str], label_set: Sequence[int] = LABEL_SET) -> pd.DataFrame:
+    """All-pairs agreement: mean per-label kappa for every pair of rater columns."""
+    kappas = pairwise_label_kappa(label_tensor(df, columns, label_set))
+    return pd.DataFrame(np.mean(kappas, axis=2), index=list(columns), columns=list(columns))
+
+
+def fleiss_kappa(tensor: np.ndarray) -> np.ndarray:
+    """Fleiss' kappa per label (each label rated present/absent by all raters), array (L,)."""
+    n_raters, n_cases = tensor.shape[:2]
+    present = tensor.sum(axis=0, dtype=np.float64)  # (N, L) raters marking the label
+    absent = n_raters - present
+    per_case = (present ** 2 + absent ** 2 - n_raters) / (n_raters * (n_raters - 1))
+    p_bar = per_case.mean(axis=0)
+    p_present = present.sum(axis=0) / (n_cases * n_raters)
+    p_e = p_present ** 2 + (1 - p_present) ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        kappa = (p_bar - p_e) / (1 - p_e)
+    return np.where(p_e == 1, np.nan, kappa)
+
+
+def fleiss_summary(df: pd.DataFrame, columns: Sequence[str],
+                   label_set: Sequence[int] = LABEL_SET) -> Dict[int, float]:
+    """Fleiss' kappa per label across all given rater columns."""
+    return dict(zip(label_set, fleiss_kappa(label_tensor(df, columns, label_set)).tolist()))
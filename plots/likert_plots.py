@@ -1,33 +1,56 @@
 import os
+import sys
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
-from dotenv import load_dotenv
+from typing import List, Sequence
 
-# -------- LOAD ENVIRONMENT VARIABLES --------
-load_dotenv()
-file_path = os.getenv("EXCEL_PATH", "input_data.xlsx")  # Default fallback
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from sheet_store import read_sheet, sheet_columns  # Parquet-backed Excel reads, shared with the prediction scripts
 
-# -------- STEP 1: LOAD EXCEL FILE --------
-df = pd.read_excel(file_path)
+# -------- LIKERT CONFIDENCE BOXPLOTS --------
+# Importable like cohen_kappa_plots.py: DataFrame in, figure out, with
+# matplotlib/seaborn imported only when drawing.
 
-# -------- STEP 2: FILTER COLUMNS (With/Without Medical History) --------
-rater_cols = [col for col in df.columns if 'With' in col or 'Without' in col]
+# -------- STEP 1: FILTER COLUMNS (With/Without Medical History) --------
+def likert_columns(columns: Sequence[str]) -> List[str]:
+    return [col for col in columns if 'With' in col or 'Without' in col]
 
-# -------- STEP 3: TRANSFORM TO LONG FORMAT --------
-df_long = df[rater_cols].melt(var_name='Rater_Condition', value_name='Confidence')
+# -------- STEP 2-3: TRANSFORM TO LONG FORMAT WITH RATER AND CONDITION --------
+def likert_long(df: pd.DataFrame) -> pd.DataFrame:
+    """One row per (rater column, case): Rater_Condition, Confidence, Rater, Condition."""
+    df_long = df[likert_columns(df.columns)].melt(var_name='Rater_Condition', value_name='Confidence')
+    df_long[['Rater', 'Condition']] = df_long['Rater_Condition'].str.extract(r'(.+?)[ _](Without|With)', expand=True)
+    return df_long
 
-# -------- STEP 4: EXTRACT RATER AND CONDITION INFO --------
-df_long[['Rater', 'Condition']] = df_long['Rater_Condition'].str.extract(r'(.+?)[ _](Without|With)', expand=True)
+# -------- STEP 4: BOXPLOT --------
+def plot_likert_box(df: pd.DataFrame, ax=None,
+                    title: str = 'Confidence Ratings by Rater (With vs Without Medical History)'):
+    """Boxplot of confidence per rater and condition; returns the figure."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
-# Optional sanity check
-# print(df_long.head())
+    if ax is None:
+        fig, ax = plt.subplots(figsize=(14, 6))
+    else:
+        fig = ax.figure
+    sns.boxplot(data=likert_long(df), x='Rater', y='Confidence', hue='Condition', palette='Set2', ax=ax)
+    ax.tick_params(axis='x', labelrotation=45)
+    ax.set_ylabel('Confidence Score')
+    ax.set_title(title)
+    fig.tight_layout()
+    return fig
 
-# -------- STEP 5: BOXPLOT --------
-plt.figure(figsize=(14, 6))
-sns.boxplot(data=df_long, x='Rater', y='Confidence', hue='Condition', palette='Set2')
-plt.xticks(rotation=45)
-plt.ylabel('Confidence Score')
-plt.title('Confidence Ratings by Rater (With vs Without Medical History)')
-plt.tight_layout()
-plt.show()
+# -------- RUN SCRIPT --------
+def main():
+    from dotenv import load_dotenv
+    import matplotlib.pyplot as plt
+
+    load_dotenv()
+    file_path = os.getenv("EXCEL_PATH", "input_data.xlsx")  # Default fallback
+
+    # Only the With/Without columns are loaded
+    df = read_sheet(file_path, columns=likert_columns(sheet_columns(file_path)))
+    plot_likert_box(df)
+    plt.show()
+
+if __name__ == "__main__":
+    main()
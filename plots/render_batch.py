@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+from cohen_kappa_plots import (comparison_columns, kappa_metrics, plot_kappa_bars, require_comparisons,
+                               sheet_comparisons)
+from likert_plots import likert_columns, plot_likert_box
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from sheet_store import cached_sheet, read_sheet, sheet_columns
+
+# -------- HEADLESS BATCH RENDERING --------
+# Renders many figures straight to files, e.g. for CI or a nightly report. A job
+# is a dict naming the plot kind, the sheet and the output file:
+#   {"kind": "kappa", "sheet": "cohort_a.xlsx", "output": "report/kappa_a.png",
+#    "raters": ["GPT-4o", "gemini"], "title": "...", "n_resamples": 2000}
+# "raters" keeps only columns starting with one of the prefixes (one plot per
+# cohort or model). Jobs run in worker processes that use the Agg backend, and
+# each worker loads only the columns its plot needs from the Parquet sheet store.
+
+
+def _init_worker() -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _keep(column: str, raters: Optional[Sequence[str]]) -> bool:
+    return not raters or any(column.startswith(prefix) for prefix in raters)
+
+
+def _render_kappa(job: dict):
+    if "comparisons" in job:
+        pairs = [tuple(pair) for pair in job["comparisons"]]
+    else:
+        pairs = sheet_comparisons(sheet_columns(job["sheet"]))
+    pairs = require_comparisons([pair for pair in pairs if _keep(pair[0], job.get("raters"))], job["sheet"])
+    df = read_sheet(job["sheet"], columns=comparison_columns(pairs))
+    metrics = kappa_metrics(
+        df, pairs,
+        n_resamples=int(job.get("n_resamples", os.getenv("KAPPA_RESAMPLES", "10000"))),
+        seed=int(job.get("seed", os.getenv("KAPPA_SEED", "0"))),
+        workers=0,  # the batch is already spread over processes
+    )
+    return plot_kappa_bars(metrics, **({"title": job["title"]} if "title" in job else {}))
+
+
+def _render_likert(job: dict):
+    columns = [col for col in likert_columns(sheet_columns(job["sheet"])) if _keep(col, job.get("raters"))]
+    df = read_sheet(job["sheet"], columns=columns)
+    return plot_likert_box(df, **({"title": job["title"]} if "title" in job else {}))
+
+
+PLOT_KINDS: Dict[str, Callable[[dict], object]] = {
+    "kappa": _render_kappa,
+    "likert": _render_likert,
+}
+
+
+def render_job(job: dict) -> dict:
+    """Render one job to job["output"]; failures are reported in the result instead of raised."""
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    try:
+        if job.get("kind") not in PLOT_KINDS:
+            raise ValueError(f"unknown plot kind '{job.get('kind')}', expected one of {sorted(PLOT_KINDS)}")
+        fig = PLOT_KINDS[job["kind"]](job)
+        os.makedirs(os.path.dirname(job["output"]) or ".", exist_ok=True)
+        fig.savefig(job["output"], dpi=job.get("dpi", 150))
+        plt.close(fig)
+        error = None
+    except Exception as e:
+        plt.close("all")
+        error = f"{type(e).__name__}: {e}"
+    return {"output": job.get("output"), "seconds": time.perf_counter() - start, "error": error}
+
+
+def render_workers() -> int:
+    """RENDER_WORKERS from the environment (default: CPU count, 0 = in-process)."""
+    workers = os.getenv("RENDER_WORKERS")
+    return int(workers) if workers else (os.cpu_count() or 1)
+
+
+def render_batch(jobs: Sequence[dict], workers: Optional[int] = None) -> List[dict]:
+    """Render all jobs (in job order) across `workers` Agg processes."""
+    jobs = list(jobs)
+    # Convert each sheet once up front so workers don't race to build the same Parquet copy
+    for sheet in dict.fromkeys(job["sheet"] for job in jobs if "sheet" in job):
+        if os.path.exists(sheet):
+            cached_sheet(sheet)
+
+    workers = render_workers() if workers is None else workers
+    if workers <= 0 or len(jobs) <= 1:
+        _init_worker()
+        return [render_job(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_worker) as pool:
+        return list(pool.map(render_job, jobs))
+
+
+def default_jobs(sheets: Sequence[str], out_dir: str, fmt: str = "png") -> List[dict]:
+    """A kappa and a Likert plot for every sheet."""
+    jobs = []
+    for sheet in sheets:
+        name = os.path.splitext(os.path.basename(sheet))[0]
+        for kind in PLOT_KINDS:
+            jobs.append({"kind": kind, "sheet": sheet, "output": os.path.join(out_dir, f"{name}_{kind}.{fmt}")})
+    return jobs
+
+
+# -------- RUN SCRIPT --------
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Render kappa and Likert plots to files without a display.")
+    parser.add_argument("sheets", nargs="*", help="Sheets to plot (default: EXCEL_PATH).")
+    parser.add_argument("--jobs", help="JSON file with a list of job dicts instead of the default plots per sheet.")
+    parser.add_argument("--out", default="figures", help="Output directory for the default jobs.")
+    parser.add_argument("--format", default="png", help="Image format for the default jobs (png, pdf, svg).")
+    parser.add_argument("--workers", type=int, default=None, help="Render processes (default RENDER_WORKERS).")
+    args = parser.parse_args()
+
+    if args.jobs:
+        with open(args.jobs, "r", encoding="utf-8") as f:
+            jobs = json.load(f)
+    else:
+        jobs = default_jobs(args.sheets or [os.getenv("EXCEL_PATH", "input_data.xlsx")], args.out, args.format)
+
+    start = time.perf_counter()
+    results = render_batch(jobs, args.workers)
+    for result in results:
+        if result["error"]:
+            print(f"❌ {result['output']}: {result['error']}")
+        else:
+            print(f"🖼️ {result['output']} ({result['seconds']:.1f}s)")
+    failed = sum(1 for result in results if result["error"])
+    print(f"📊 Rendered {len(results) - failed}/{len(results)} figure(s) in {time.perf_counter() - start:.1f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
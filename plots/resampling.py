@@ -0,0 +1,185 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Sequence, Tuple
+from kappa_engine import LABEL_SET, comparison_kappa_stats, kappa_from_counts, label_tensor
+
+# -------- BOOTSTRAP CIs AND PERMUTATION TESTS FOR KAPPA --------
+# Statistic: mean over labels of the per-label kappa (the bar length in the kappa plot).
+# Resamples are drawn in fixed-size batches, each with its own child of
+# SeedSequence(seed), so results depend only on `seed` and `n_resamples`, not on
+# the number of worker processes. Within a batch every resample is evaluated at
+# once: case weights (bootstrap) or swap masks (permutation) are multiplied with
+# the (cases x pairs*labels) label matrices to get all 2x2 counts in one product.
+
+BATCH_SIZE = 500
+WITH_SUFFIX = "-with-medical history"
+WITHOUT_SUFFIX = "-without-medical history"
+
+# Per-process copy of the label matrices, set once by the pool initializer
+_STATE: dict = {}
+
+
+def _init_worker(state: dict) -> None:
+    global _STATE
+    _STATE = state
+
+
+def _count_matrix(masks: np.ndarray) -> np.ndarray:
+    """(pairs, cases, labels) masks -> (cases, pairs * labels) float32 for count products."""
+    return np.ascontiguousarray(masks.transpose(1, 0, 2).reshape(masks.shape[1], -1), dtype=np.float32)
+
+
+def _mean_kappa(n_cases: int, true_pos, pred_pos, both, n_labels: int) -> np.ndarray:
+    """(..., pairs * labels) counts -> (..., pairs) mean kappa over labels."""
+    split = lambda counts: counts.reshape(counts.shape[:-1] + (-1, n_labels))
+    kappas = kappa_from_counts(n_cases, split(true_pos), split(pred_pos), split(both))
+    return np.mean(kappas, axis=-1)
+
+
+def _case_weights(rng: np.random.Generator, size: int, n_cases: int) -> np.ndarray:
+    """How often each case is drawn in `size` bootstrap resamples, shape (size, cases)."""
+    draws = rng.integers(0, n_cases, (size, n_cases)) + np.arange(size)[:, None] * n_cases
+    return np.bincount(draws.ravel(), minlength=size * n_cases).reshape(size, n_cases).astype(np.float32)
+
+
+def _bootstrap_batch(job: Tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    seed, size = job
+    s = _STATE
+    weights = _case_weights(np.random.default_rng(seed), size, s["n_cases"])
+    counts = [np.rint(weights @ s[name]).astype(np.int64) for name in ("true", "pred", "both")]
+    return _mean_kappa(s["n_cases"], *counts, s["n_labels"])
+
+
+def _permutation_batch(job: Tuple[np.random.SeedSequence, int]) -> np.ndarray:
+    seed, size = job
+    s = _STATE
+    # Swap each case's with/without answers with probability 1/2
+    swaps = np.random.default_rng(seed).integers(0, 2, (size, s["n_cases"])).astype(np.float32)
+    shift_pos = np.rint(swaps @ s["delta_pos"]).astype(np.int64)
+    shift_both = np.rint(swaps @ s["delta_both"]).astype(np.int64)
+    with_kappa = _mean_kappa(s["n_cases"], s["with_pos"] + shift_pos, s["ref_pos"], s["with_both"] + shift_both,
+                             s["n_labels"])
+    without_kappa = _mean_kappa(s["n_cases"], s["without_pos"] - shift_pos, s["ref_pos"],
+                                s["without_both"] - shift_both, s["n_labels"])
+    return with_kappa - without_kappa
+
+
+def _run_batches(batch_fn: Callable, state: dict, n_resamples: int, seed: int,
+                 workers: Optional[int]) -> np.ndarray:
+    """Evaluate `n_resamples` resamples in seeded batches, across a process pool if workers > 0."""
+    n_batches = -(-n_resamples // BATCH_SIZE)
+    sizes = [BATCH_SIZE] * (n_batches - 1) + [n_resamples - BATCH_SIZE * (n_batches - 1)]
+    jobs = list(zip(np.random.SeedSequence(seed).spawn(n_batches), sizes))
+    workers = resample_workers() if workers is None else workers
+    if workers <= 0 or n_batches == 1:
+        _init_worker(state)
+        return np.concatenate([batch_fn(job) for job in jobs])
+    with ProcessPoolExecutor(max_workers=min(workers, n_batches), initializer=_init_worker,
+                             initargs=(state,)) as pool:
+        return np.concatenate(list(pool.map(batch_fn, jobs)))
+
+
+def resample_workers() -> int:
+    """RESAMPLE_WORKERS from the environment (default: CPU count, 0 = in-process)."""
+    workers = os.getenv("RESAMPLE_WORKERS")
+    return int(workers) if workers else (os.cpu_count() or 1)
+
+
+# -------- BOOTSTRAP --------
+def bootstrap_kappa(df: pd.DataFrame, comparisons: Sequence[Tuple[str, str]], n_resamples: int = 10000,
+                    seed: int = 0, ci: float = 95.0, workers: Optional[int] = None,
+                    label_set: Sequence[int] = LABEL_SET) -> pd.DataFrame:
+    """Case-level bootstrap percentile CI of the mean per-label kappa for each (rater, reference) pair."""
+    columns = list(dict.fromkeys(col for pair in comparisons for col in pair))
+    position = {col: i for i, col in enumerate(columns)}
+    tensor = label_tensor(df, columns, label_set)
+    first = tensor[[position[a] for a, _ in comparisons]]
+    second = tensor[[position[b] for _, b in comparisons]]
+    state = {
+        "n_cases": tensor.shape[1],
+        "n_labels": len(label_set),
+        "true": _count_matrix(first),
+        "pred": _count_matrix(second),
+        "both": _count_matrix(first & second),
+    }
+
+    point, _ = comparison_kappa_stats(df, comparisons, label_set)
+    stats = _run_batches(_bootstrap_batch, state, n_resamples, seed, workers)  # (resamples, pairs)
+    alpha = (100 - ci) / 2
+    with np.errstate(all="ignore"):
+        low, high = np.nanpercentile(stats, [alpha, 100 - alpha], axis=0)
+    return pd.DataFrame({
+        "comparison": [f"{a} vs {b}" for a, b in comparisons],
+        "kappa": point,
+        "ci_low": low,
+        "ci_high": high,
+        "n_valid": np.isfinite(stats).sum(axis=0),
+    })
+
+
+# -------- PAIRED PERMUTATION TEST (WITH vs WITHOUT MEDICAL HISTORY) --------
+def history_pairs(comparisons: Sequence[Tuple[str, str]]) -> List[Tuple[str, str, str]]:
+    """(without column, with column, reference) for every rater compared in both conditions."""
+    pairs = []
+    lookup = set(comparisons)
+    for col, ref in comparisons:
+        if col.endswith(WITHOUT_SUFFIX):
+            with_col = col[:-len(WITHOUT_SUFFIX)] + WITH_SUFFIX
+            if (with_col, ref) in lookup:
+                pairs.append((col, with_col, ref))
+    return pairs
+
+
+def permutation_test_history(df: pd.DataFrame, comparisons: Sequence[Tuple[str, str]], n_resamples: int = 10000,
+                             seed: int = 0, workers: Optional[int] = None,
+                             label_set: Sequence[int] = LABEL_SET) -> pd.DataFrame:
+    """Two-sided paired permutation test of kappa(with history) - kappa(without history) per rater.
+
+    Under the null the two answers of a rater are exchangeable within each case,
+    so each resample swaps them for a random half of the cases.
+    """
+    triples = history_pairs(comparisons)
+    if not triples:
+        return pd.DataFrame(columns=["rater", "reference", "kappa_without", "kappa_with", "difference", "p_value"])
+    columns = list(dict.fromkeys(col for triple in triples for col in triple))
+    position = {col: i for i, col in enumerate(columns)}
+    tensor = label_tensor(df, columns, label_set)
+    without = tensor[[position[t[0]] for t in triples]]
+    with_ = tensor[[position[t[1]] for t in triples]]
+    ref = tensor[[position[t[2]] for t in triples]]
+
+    totals = lambda masks: masks.sum(axis=1, dtype=np.int64).reshape(1, -1)
+    state = {
+        "n_cases": tensor.shape[1],
+        "n_labels": len(label_set),
+        "with_pos": totals(with_),
+        "without_pos": totals(without),
+        "ref_pos": totals(ref),
+        "with_both": totals(with_ & ref),
+        "without_both": totals(without & ref),
+        # A swapped case contributes its "without" answer to the "with" counts and vice versa
+        "delta_pos": _count_matrix(without.astype(np.int8) - with_.astype(np.int8)),
+        "delta_both": _count_matrix((without & ref).astype(np.int8) - (with_ & ref).astype(np.int8)),
+    }
+    _init_worker(state)
+    kappa_with = _mean_kappa(state["n_cases"], state["with_pos"], state["ref_pos"], state["with_both"],
+                             state["n_labels"])[0]
+    kappa_without = _mean_kappa(state["n_cases"], state["without_pos"], state["ref_pos"], state["without_both"],
+                                state["n_labels"])[0]
+    observed = kappa_with - kappa_without
+
+    null = _run_batches(_permutation_batch, state, n_resamples, seed, workers)  # (resamples, raters)
+    with np.errstate(invalid="ignore"):
+        extreme = (np.abs(null) >= np.abs(observed) - 1e-12).sum(axis=0)
+    valid = np.isfinite(null).sum(axis=0)
+    p_value = np.where(np.isfinite(observed), (1 + extreme) / (1 + valid), np.nan)
+    return pd.DataFrame({
+        "rater": [t[1][:-len(WITH_SUFFIX)] for t in triples],
+        "reference": [t[2] for t in triples],
+        "kappa_without": kappa_without,
+        "kappa_with": kappa_with,
+        "difference": observed,
+        "p_value": p_value,
+    })
@@ -0,0 +1,101 @@
+import os
+import sys
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from typing import List, Sequence
+from kappa_engine import LABEL_SET, fleiss_kappa, label_tensor, pairwise_label_kappa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from sheet_store import read_table
+
+# -------- MODEL SELF-CONSISTENCY ACROSS REPLICATES --------
+# Reads the replicate tables written with REPLICATES=N (one row per patient and
+# replicate) and treats the N samples of a model as N raters of the same cases:
+# intra-model agreement is the mean per-label Cohen's kappa over all replicate
+# pairs and Fleiss' kappa over all replicates at once, and Likert stability is
+# the per-case variance of the score across replicates. Only cases where every
+# replicate was parsed are used, so all statistics share the same cases.
+
+CONDITIONS = (
+    ("without history", "Kategorien ohne Anamnese", "Likert-Skala ohne Anamnese"),
+    ("with history", "Kategorien mit Anamnese", "Likert-Skala mit Anamnese"),
+)
+
+
+def _model_name(path: str) -> str:
+    """'out.GPT-4o.replicates.parquet' -> 'GPT-4o'."""
+    name = os.path.basename(path)
+    for suffix in (".replicates.parquet", ".replicates.xlsx"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)].split(".", 1)[-1]
+    return os.path.splitext(name)[0]
+
+
+def read_replicates(path: str) -> pd.DataFrame:
+    if path.lower().endswith(".parquet"):
+        return read_table(path)
+    return pd.read_excel(path)
+
+
+def wide(table: pd.DataFrame, column: str) -> pd.DataFrame:
+    """Cases x replicates for one result column, keeping only cases answered by every replicate."""
+    pivot = table.pivot_table(index="Patient ID", columns="replicate", values=column, aggfunc="first", dropna=False)
+    return pivot.dropna(how="any")
+
+
+def condition_stats(table: pd.DataFrame, category_col: str, likert_col: str,
+                    label_set: Sequence[int] = LABEL_SET) -> dict:
+    categories = wide(table, category_col)
+    n_replicates = categories.shape[1]
+    stats = {"replicates": n_replicates, "cases": len(categories), "pairwise_kappa": np.nan, "fleiss_kappa": np.nan}
+    if n_replicates >= 2 and len(categories):
+        tensor = label_tensor(categories, list(categories.columns), label_set)
+        with warnings.catch_warnings():
+            # Kappa is undefined (NaN) for labels no replicate varies on; all-NaN slices stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            kappas = np.nanmean(pairwise_label_kappa(tensor), axis=2)  # (R, R) mean over labels
+            off_diagonal = ~np.eye(n_replicates, dtype=bool)
+            stats["pairwise_kappa"] = float(np.nanmean(kappas[off_diagonal]))
+            stats["fleiss_kappa"] = float(np.nanmean(fleiss_kappa(tensor)))
+        stats["category_disagreement"] = float((categories.nunique(axis=1) > 1).mean())
+
+    likert = wide(table, likert_col).astype(float)
+    if likert.shape[1] >= 2 and len(likert):
+        variance = likert.var(axis=1, ddof=1)
+        stats["likert_cases"] = len(likert)
+        stats["likert_variance"] = float(variance.mean())
+        stats["likert_sd"] = float(np.sqrt(variance).mean())
+        stats["likert_disagreement"] = float((variance > 0).mean())
+    return stats
+
+
+def self_consistency(paths: Sequence[str]) -> pd.DataFrame:
+    """One row per (model, condition) with intra-model kappa and Likert variance."""
+    rows: List[dict] = []
+    for path in paths:
+        table = read_replicates(path)
+        for condition, category_col, likert_col in CONDITIONS:
+            rows.append({"model": _model_name(path), "condition": condition,
+                         **condition_stats(table, category_col, likert_col)})
+    return pd.DataFrame(rows)
+
+
+# -------- RUN SCRIPT --------
+def main():
+    parser = argparse.ArgumentParser(description="Intra-model agreement and Likert variance across replicates.")
+    parser.add_argument("tables", nargs="+", help="Replicate tables (*.replicates.parquet or .xlsx).")
+    parser.add_argument("--output", help="Also write the statistics to this CSV file.")
+    args = parser.parse_args()
+
+    stats = self_consistency(args.tables)
+    with pd.option_context("display.width", 160, "display.max_columns", None, "display.float_format", "{:.3f}".format):
+        print(stats.to_string(index=False))
+    if args.output:
+        stats.to_csv(args.output, index=False)
+        print(f"✅ Self-consistency written to: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
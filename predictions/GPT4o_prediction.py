@@ -1,12 +1,23 @@
 import os
-import pandas as pd
-import openai
-from PIL import Image
 import base64
-from io import BytesIO
-import time
-import re
+import argparse
 from dotenv import load_dotenv
+from async_dispatch import InFlightTracker, run_dispatch
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources, dicom_settings
+from image_cache import open_image_cache
+from payload_plan import open_payload_planner
+from preprocess import open_preprocess_pipeline
+from providers import OpenAIProvider
+from rate_limit import limiter_from_env, rough_request_tokens
+from replicates import REPLICATE_COLUMN, answered, default_replicates_path, replicates_from_env, save_replicates
+from response_cache import open_response_cache
+from structured_output import (
+    STRUCTURED_INSTRUCTIONS, STRUCTURED_MAX_TOKENS, openai_response_format, result_columns, structured_enabled
+)
+from result_journal import ResultJournal, default_journal_path, default_results_path
+from sheet_store import read_sheet
+from telemetry import open_telemetry
 
 # === LOAD ENVIRONMENT VARIABLES FROM .env FILE ===
 load_dotenv()
@@ -15,19 +26,28 @@ load_dotenv()
 EXCEL_PATH = os.getenv("EXCEL_PATH", "input_data.xlsx")
 IMAGES_FOLDER = os.getenv("IMAGES_FOLDER", "ct_scans")
 OUTPUT_FILE = os.getenv("OUTPUT_FILE", "diagnosis_results.xlsx")
-openai.api_key = os.getenv("OPENAI_API_KEY")  # Store this securely in a .env file
+GPT_CONCURRENCY = int(os.getenv("GPT_CONCURRENCY", "1"))  # Cases sent to the API in parallel
+CASE_INDEX_FILE = os.getenv("CASE_INDEX_FILE", "case_index.json")  # Persisted slice index
+DICOM_WINDOW, DICOM_SLICES = dicom_settings()  # Window and slice count for Patient<id>/ DICOM series
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", default_journal_path(OUTPUT_FILE, "gpt4o"))  # Crash-safe per-case results
+RESULTS_FILE = os.getenv("RESULTS_FILE", default_results_path(OUTPUT_FILE, "gpt4o"))  # Columnar results table
+TELEMETRY = open_telemetry("gpt4o", OUTPUT_FILE)  # Per-stage timings, tokens and cost
+GPT_PROVIDER = OpenAIProvider(api_key=os.getenv("OPENAI_API_KEY"))  # Store this securely in a .env file
+GPT_LIMITER = limiter_from_env("openai", "OPENAI")  # OPENAI_RPM / OPENAI_TPM
+GPT_PAYLOAD = open_payload_planner("openai", "OPENAI")  # Resolution / montage per request token budget
+IMAGE_CACHE = open_image_cache()  # Encoded slices shared across runs and providers
+RESPONSE_CACHE = open_response_cache()  # Memoized model answers (RESPONSE_CACHE_MODE)
+STRUCTURED_OUTPUT = structured_enabled()  # Ask for compact JSON instead of free text
+REPLICATES = replicates_from_env()  # Answers sampled per case (self-consistency runs)
+REPLICATES_FILE = os.getenv("REPLICATES_FILE", default_replicates_path(OUTPUT_FILE, "gpt4o"))  # Parsed replicates
 
 # === FUNCTION TO ENCODE IMAGES WITH COMPRESSION ===
 def encode_image(image_path, max_size=(1024, 1024)):
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        img.thumbnail(max_size)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG", quality=85)
-        return base64.b64encode(buffered.getvalue()).decode()
+    return IMAGE_CACHE.get_base64(image_path, max_size=max_size, quality=85)
 
-# === FUNCTION TO QUERY GPT-4o WITH IMAGES ===
-def ask_gpt(images_base64, medical_history=None):
+# === REQUEST BODY FOR ONE CASE ===
+def gpt_request_body(images_base64, medical_history=None, structured=STRUCTURED_OUTPUT, plan=None):
+    """chat.completions arguments for one case (also the body of a batch_mode.py request line)."""
     image_parts = [
         {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img}"}}
         for img in images_base64
@@ -52,83 +72,192 @@ def ask_gpt(images_base64, medical_history=None):
         f"2. Hypothetical classification **with medical history**: {medical_history or 'No history provided.'}"
     )
 
-    for attempt in range(3):
+    # Montage payloads tell the model how the slices are tiled
+    if plan is not None:
+        prompt += plan.prompt_note()
+
+    # Structured mode: compact JSON answer, far fewer output tokens
+    max_tokens = 1000
+    response_options = {}
+    if structured:
+        prompt += STRUCTURED_INSTRUCTIONS
+        max_tokens = STRUCTURED_MAX_TOKENS
+        response_options = {"response_format": openai_response_format()}
+
+    return {
+        "model": "gpt-4o",
+        "messages": [
+            {"role": "user", "content": [{"type": "text", "text": prompt}] + image_parts}
+        ],
+        "max_tokens": max_tokens,
+        **response_options
+    }
+
+# === FUNCTION TO QUERY GPT-4o WITH IMAGES ===
+def ask_gpt(images_base64, medical_history=None, structured=STRUCTURED_OUTPUT, plan=None, samples=1):
+    """GPT-4o answer text, or a list of `samples` answers (one request with n=samples) when samples > 1."""
+    body = gpt_request_body(images_base64, medical_history, structured, plan)
+    prompt = body["messages"][0]["content"][0]["text"]
+    max_tokens = body["max_tokens"]
+
+    def request(n=1):
+        # Throttling, backoff on 429/5xx (honouring Retry-After) and circuit breaking live in GPT_LIMITER
         try:
-            response = openai.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "user", "content": [{"type": "text", "text": prompt}] + image_parts}
-                ],
-                max_tokens=1000
+            raw = GPT_LIMITER.call(
+                lambda: GPT_PROVIDER.client.chat.completions.with_raw_response.create(
+                    **body,
+                    **({"n": n} if n > 1 else {})
+                ),
+                tokens=rough_request_tokens(
+                    prompt, len(images_base64), max_tokens * n, per_image=plan.tokens_per_image if plan else 765
+                ),
+                headers_of=lambda raw: raw.headers,
             )
-            return response.choices[0].message.content
-        except openai.RateLimitError:
-            print("⚠️ Rate limit hit, retrying in 10 seconds...")
-            time.sleep(10)
+            completion = raw.parse()
+            if completion.usage:
+                TELEMETRY.record_usage("gpt-4o", completion.usage.prompt_tokens, completion.usage.completion_tokens)
+            return [choice.message.content for choice in completion.choices]
         except Exception as e:
             print(f"❌ Error during GPT call: {e}")
-            break
-    return "ERROR"
-
-# === FUNCTION TO EXTRACT LIKERT SCORES ===
-def extract_likert_scores(text):
-    scores = re.findall(r'Likert[^:]*[:\-]?\s*([1-5])', text)
-    if len(scores) == 2:
-        return int(scores[0]), int(scores[1])
-    elif len(scores) == 1:
-        return int(scores[0]), "N/A"
-    return "N/A", "N/A"
+        return ["ERROR"] * n
 
-# === MAIN FUNCTION ===
-def process_excel_and_images():
-    df = pd.read_excel(EXCEL_PATH)
-    results = []
+    # Identical requests are answered from RESPONSE_CACHE when it is enabled
+    if samples > 1:
+        return RESPONSE_CACHE.memoized_samples("openai", "gpt-4o", prompt, images_base64, request, samples,
+                                               max_tokens=max_tokens)
+    return RESPONSE_CACHE.memoized("openai", "gpt-4o", prompt, images_base64, lambda: request()[0],
+                                   max_tokens=max_tokens)
+
+# === PER-CASE PIPELINE ===
+def process_case(prepared):
+    row = prepared["item"]
+    patient_id = row["Reihenfolge Bilder"]
+    medical_history = row.get("Anamnese (medical history)", "")
+
+    print(f"\n🔍 Processing Patient{patient_id}")
 
-    for idx, row in df.iterrows():
-        patient_id = row["Reihenfolge Bilder"]
-        medical_history = row.get("Anamnese (medical history)", "")
+    image_paths = prepared["paths"]
 
-        print(f"\n🔍 Processing Patient{patient_id}")
+    if not image_paths:
+        print(f"⚠️ No images found for Patient{patient_id}")
+        return None
 
-        image_paths = sorted([
-            os.path.join(IMAGES_FOLDER, f)
-            for f in os.listdir(IMAGES_FOLDER)
-            if f.startswith(f"Patient{patient_id}_") and f.endswith(".jpg")
-        ])
+    print(f"🖼️ Found {len(image_paths)} image(s) for Patient{patient_id}")
 
-        if not image_paths:
-            print(f"⚠️ No images found for Patient{patient_id}")
-            continue
+    if medical_history.strip():
+        print(f"📄 Medical history provided.")
+    else:
+        print("📄 No medical history.")
 
-        print(f"🖼️ Found {len(image_paths)} image(s) for Patient{patient_id}")
+    if prepared["error"]:
+        print(f"❌ Image encoding failed for Patient{patient_id}: {prepared['error']}")
+        return None
 
-        if medical_history.strip():
-            print(f"📄 Medical history provided.")
-        else:
-            print("📄 No medical history.")
+    print(prepared["plan"].describe(prepared["images"]))
+    if "dedup" in prepared:
+        print(prepared["dedup"].describe(prepared["images"]))
+    encoded_images = [base64.b64encode(data).decode() for data in prepared["images"]]
 
-        encoded_images = [encode_image(p) for p in image_paths]
+    if REPLICATES > 1:
+        # One payload, REPLICATES sampled answers; the first one fills the usual columns
+        replicates = answered(ask_gpt(encoded_images, medical_history, plan=prepared["plan"], samples=REPLICATES))
+        print(f"🔁 {len(replicates)} of {REPLICATES} replicate(s) answered")
+        gpt_response = replicates[0] if replicates else "ERROR"
+    else:
+        gpt_response = ask_gpt(encoded_images, medical_history, plan=prepared["plan"])
 
-        gpt_response = ask_gpt(encoded_images, medical_history)
+    if gpt_response == "ERROR":
+        return None
 
-        if gpt_response == "ERROR":
-            continue
+    print(f"✅ Diagnosis completed for Patient{patient_id}")
 
-        likert_no_hist, likert_with_hist = extract_likert_scores(gpt_response)
+    record = result_record(row, gpt_response, len(image_paths))
+    if REPLICATES > 1:
+        record[REPLICATE_COLUMN] = replicates
+    return record
 
-        results.append({
-            "Patient ID": patient_id,
-            "Combined GPT Response": gpt_response,
-            "Likert-Skala ohne Anamnese": likert_no_hist,
-            "Likert-Skala mit Anamnese": likert_with_hist
-        })
+def result_record(row, gpt_response, n_images=0, structured=STRUCTURED_OUTPUT):
+    """Journal record of one answered case (also built by batch_mode.py when ingesting)."""
+    return {
+        "Patient ID": row["Reihenfolge Bilder"],
+        "Combined GPT Response": gpt_response,
+        "Number of Images": n_images,
+        **result_columns(gpt_response, structured=structured)
+    }
 
-        print(f"✅ Diagnosis completed for Patient{patient_id}")
+# === MAIN FUNCTION ===
+def process_excel_and_images(concurrency=GPT_CONCURRENCY, resume=False):
+    with TELEMETRY.stage("load_sheet"):
+        df = read_sheet(EXCEL_PATH)
+    rows = [row for _, row in df.iterrows()]
+    journal = ResultJournal(JOURNAL_FILE)
+
+    if resume:
+        done = journal.completed_ids()
+        rows = [row for row in rows if normalize_patient_id(row["Reihenfolge Bilder"]) not in done]
+        print(f"⏩ Resuming: {len(df) - len(rows)} patient(s) already in {JOURNAL_FILE}")
+    else:
+        # A fresh run starts an empty journal, so no earlier answer ends up in this run's results
+        previous = journal.rotate()
+        if previous:
+            print(f"🗂️ Previous journal moved to {previous}")
 
-    out_df = pd.DataFrame(results)
-    out_df.to_excel(OUTPUT_FILE, index=False)
-    print(f"\n📁 Results saved to: {OUTPUT_FILE}")
+    with TELEMETRY.stage("discovery"):
+        index = load_case_index(IMAGES_FOLDER, CASE_INDEX_FILE)
+
+    # Slices are encoded in worker processes ahead of the API calls, sized by the payload planner
+    pipeline = open_preprocess_pipeline(IMAGE_CACHE, GPT_PAYLOAD, telemetry=TELEMETRY, index=index)
+    prepared_cases = pipeline.stream(
+        rows, lambda row: case_sources(index, row["Reihenfolge Bilder"], DICOM_WINDOW, DICOM_SLICES)
+    )
+
+    # Each case is traced (stage timings, tokens, cost) before its result is journaled
+    worker = TELEMETRY.instrument(process_case, lambda prepared: prepared["item"]["Reihenfolge Bilder"])
+    tracker = InFlightTracker()
+    results = run_dispatch(
+        prepared_cases, journal.recording(worker), concurrency=concurrency,
+        key=lambda prepared: f"Patient{prepared['item']['Reihenfolge Bilder']}", tracker=tracker
+    )
+    results = [r for r in results if r is not None]
+
+    # Materialize the journal (including resumed cases) in sheet order
+    saved = journal.save_results(RESULTS_FILE, OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"\n📁 Results saved to: {saved}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
+    print(f"📊 {tracker.completed} case(s) processed, peak {tracker.peak} request(s) in flight.")
+    print(IMAGE_CACHE.summary())
+    print(pipeline.timing_summary())
+    print(GPT_PROVIDER.connection_summary())
+    print(GPT_LIMITER.summary())
+    print(GPT_PAYLOAD.summary())
+    print(RESPONSE_CACHE.summary())
+    print(TELEMETRY.summary())
+    TELEMETRY.write_metrics()
+
+# === EXPORT JOURNAL ===
+def export_results():
+    """Write OUTPUT_FILE (Excel) from the result journal without calling the API."""
+    df = read_sheet(EXCEL_PATH, columns=["Reihenfolge Bilder"])
+    journal = ResultJournal(JOURNAL_FILE)
+    count = journal.export_excel(OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"📁 Exported {count} journaled result(s) to: {OUTPUT_FILE}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
 
 # === RUN SCRIPT ===
 if __name__ == "__main__":
-    process_excel_and_images()
+    parser = argparse.ArgumentParser(description="Classify CT cases with GPT-4o.")
+    parser.add_argument("--resume", action="store_true", help="Skip patients already in the result journal.")
+    parser.add_argument("--export", action="store_true", help="Only export the result journal to the Excel OUTPUT_FILE.")
+    parser.add_argument("--replicates", type=int, default=REPLICATES,
+                        help="Answers sampled per case from one payload (default REPLICATES, 1 = off).")
+    args = parser.parse_args()
+    REPLICATES = max(1, args.replicates)
+
+    if args.export:
+        export_results()
+    else:
+        process_excel_and_images(resume=args.resume)
@@ -1,14 +1,28 @@
 import os
-import re
-import time
-import json
+import argparse
 import base64
+import json
 import requests
-import pandas as pd
-from io import BytesIO
-from PIL import Image
-from typing import List, Tuple
+from typing import List, Optional, Tuple, Union
 from dotenv import load_dotenv
+from async_dispatch import InFlightTracker, run_dispatch
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources, dicom_settings
+from image_cache import open_image_cache
+from payload_plan import PayloadPlan, open_payload_planner
+from preprocess import open_preprocess_pipeline
+from providers import XAIProvider
+from rate_limit import limiter_from_env, rough_request_tokens
+from replicates import (
+    REPLICATE_COLUMN, answered, default_replicates_path, fan_out, replicates_from_env, save_replicates
+)
+from response_cache import open_response_cache
+from structured_output import (
+    STRUCTURED_INSTRUCTIONS, STRUCTURED_MAX_TOKENS, openai_response_format, result_columns, structured_enabled
+)
+from result_journal import ResultJournal, default_journal_path, default_results_path
+from sheet_store import read_sheet
+from telemetry import open_telemetry
 
 # === LOAD ENVIRONMENT VARIABLES FROM .env FILE ===
 # Create a .env file in your project root with:
@@ -20,30 +34,35 @@ load_dotenv()
 
 # === CONFIGURATION ===
 XAI_API_KEY = os.getenv("XAI_API_KEY")
-XAI_API_URL = "https://api.x.ai/v1/chat/completions"
+XAI_API_URL = os.getenv("XAI_API_URL", "https://api.x.ai/v1/chat/completions")
 
 EXCEL_PATH = os.getenv("EXCEL_PATH", "input_data.xlsx")
 IMAGES_FOLDER = os.getenv("IMAGES_FOLDER", "ct_scans")
 OUTPUT_FILE = os.getenv("OUTPUT_FILE", "diagnosis_grok_results.xlsx")
+GROK_CONCURRENCY = int(os.getenv("GROK_CONCURRENCY", "1"))  # Cases sent to the API in parallel
+CASE_INDEX_FILE = os.getenv("CASE_INDEX_FILE", "case_index.json")  # Persisted slice index
+DICOM_WINDOW, DICOM_SLICES = dicom_settings()  # Window and slice count for Patient<id>/ DICOM series
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", default_journal_path(OUTPUT_FILE, "grok"))  # Crash-safe per-case results
+RESULTS_FILE = os.getenv("RESULTS_FILE", default_results_path(OUTPUT_FILE, "grok"))  # Columnar results table
+TELEMETRY = open_telemetry("grok", OUTPUT_FILE)  # Per-stage timings, tokens and cost
+XAI_PROVIDER = XAIProvider(api_key=XAI_API_KEY, api_url=XAI_API_URL)  # Pooled keep-alive session
+XAI_LIMITER = limiter_from_env("xai", "XAI")  # XAI_RPM / XAI_TPM
+XAI_PAYLOAD = open_payload_planner("xai", "XAI")  # Resolution / montage per request token budget
+IMAGE_CACHE = open_image_cache()  # Encoded slices shared across runs and providers
+RESPONSE_CACHE = open_response_cache()  # Memoized model answers (RESPONSE_CACHE_MODE)
+STRUCTURED_OUTPUT = structured_enabled()  # Ask for compact JSON instead of free text
+REPLICATES = replicates_from_env()  # Answers sampled per case (self-consistency runs)
+REPLICATES_FILE = os.getenv("REPLICATES_FILE", default_replicates_path(OUTPUT_FILE, "grok"))  # Parsed replicates
 
 # === FUNCTION TO ENCODE IMAGES ===
 def encode_image_to_base64(image_path: str, max_size: Tuple[int, int] = (1024, 1024)) -> str:
-    """Compress and encode image as base64 string for Grok API."""
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        img.thumbnail(max_size)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG", quality=85)
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
-
-# === FUNCTION TO QUERY GROK API ===
-def ask_grok(images_base64: List[str], medical_history: str = None) -> str:
-    """Send CT images and context to Grok (xAI) API for simulated classification."""
-    headers = {
-        "Authorization": f"Bearer {XAI_API_KEY}",
-        "Content-Type": "application/json"
-    }
+    """Compress and encode image as base64 string for Grok API (cached on disk)."""
+    return IMAGE_CACHE.get_base64(image_path, max_size=max_size, quality=85)
 
+# === REQUEST PAYLOAD FOR ONE CASE ===
+def grok_request_body(images_base64: List[str], medical_history: str = None, structured: bool = STRUCTURED_OUTPUT,
+                      plan: Optional[PayloadPlan] = None) -> dict:
+    """Chat completions payload for one case (also the body of a batch_mode.py request line)."""
     # Prepare image content blocks
     image_contents = [
         {
@@ -70,6 +89,10 @@ def ask_grok(images_base64: List[str], medical_history: str = None) -> str:
         f"2. Hypothetical classification **with medical history**: {medical_history or 'No history provided.'}"
     )
 
+    # Montage payloads tell the model how the slices are tiled
+    if plan is not None:
+        prompt += plan.prompt_note()
+
     payload = {
         "model": "grok-4-fast-reasoning",
         "messages": [
@@ -82,109 +105,204 @@ def ask_grok(images_base64: List[str], medical_history: str = None) -> str:
         "max_tokens": 2000
     }
 
-    # Retry logic for transient API issues
-    for attempt in range(3):
+    # Structured mode: compact JSON answer, far fewer output tokens
+    if structured:
+        payload["messages"][0]["content"][0]["text"] = prompt + STRUCTURED_INSTRUCTIONS
+        payload["max_tokens"] = STRUCTURED_MAX_TOKENS
+        payload["response_format"] = openai_response_format()
+
+    return payload
+
+# === FUNCTION TO QUERY GROK API ===
+def ask_grok(images_base64: List[str], medical_history: str = None, structured: bool = STRUCTURED_OUTPUT,
+             plan: Optional[PayloadPlan] = None, samples: int = 1) -> Union[str, List[str]]:
+    """Send CT images and context to Grok (xAI) API for simulated classification.
+
+    With samples > 1 a list of answers comes back; the payload is built once and the
+    samples are requested concurrently.
+    """
+    payload = grok_request_body(images_base64, medical_history, structured, plan)
+    prompt = payload["messages"][0]["content"][0]["text"]
+
+    def post() -> requests.Response:
+        response = XAI_PROVIDER.post(payload)
+        response.raise_for_status()
+        return response
+
+    def request() -> str:
+        # Throttling, backoff on 429/5xx (honouring Retry-After) and circuit breaking live in XAI_LIMITER
         try:
-            response = requests.post(XAI_API_URL, headers=headers, json=payload, timeout=120)
-            response.raise_for_status()
+            response = XAI_LIMITER.call(
+                post,
+                tokens=rough_request_tokens(
+                    prompt, len(images_base64), payload["max_tokens"],
+                    per_image=plan.tokens_per_image if plan else 765
+                ),
+                headers_of=lambda r: r.headers,
+            )
             data = response.json()
+            usage = data.get("usage") or {}
+            TELEMETRY.record_usage(payload["model"], usage.get("prompt_tokens"), usage.get("completion_tokens"))
             return data["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
-            print(f"⚠️ API error (attempt {attempt + 1}/3): {e}")
-            if attempt < 2:
-                time.sleep(10)
+            print(f"⚠️ API error: {e}")
         except (KeyError, IndexError, json.JSONDecodeError) as e:
             print(f"⚠️ Response parsing error: {e}")
-            time.sleep(10)
-    return "ERROR"
+        except Exception as e:
+            print(f"⚠️ Grok call failed: {e}")
+        return "ERROR"
 
-# === FUNCTION TO EXTRACT LIKERT SCORES ===
-def extract_likert_scores(text: str) -> Tuple[any, any]:
-    """Extract Likert scale (1–5) values from Grok output text."""
-    scores = re.findall(r"(?:likert|confidence|skala)\s*[:\-]?\s*(\d{1,2})", text, re.IGNORECASE)
-    scores = [int(s) for s in scores if 1 <= int(s) <= 5]
+    # Identical requests are answered from RESPONSE_CACHE when it is enabled
+    if samples > 1:
+        return RESPONSE_CACHE.memoized_samples(
+            "xai", payload["model"], prompt, images_base64,
+            lambda n: fan_out(request, n), samples,
+            temperature=payload["temperature"], max_tokens=payload["max_tokens"]
+        )
+    return RESPONSE_CACHE.memoized(
+        "xai", payload["model"], prompt, images_base64, request,
+        temperature=payload["temperature"], max_tokens=payload["max_tokens"]
+    )
 
-    if len(scores) >= 2:
-        return int(scores[0]), int(scores[1])
-    elif len(scores) == 1:
-        return int(scores[0]), "N/A"
-    return "N/A", "N/A"
+# === PER-CASE PIPELINE ===
+def process_case(prepared) -> dict:
+    """Classify the pre-encoded images of a single patient row."""
+    row = prepared["item"]
+    patient_id = row["Reihenfolge Bilder"]
+    medical_history = row.get("Anamnese (medical history)", "")
 
-# === MAIN PROCESSING FUNCTION ===
-def process_excel_and_images():
-    """Process Excel sheet, analyze CT scan images via Grok, and save results."""
-    if not XAI_API_KEY:
-        raise ValueError("❌ Missing XAI_API_KEY. Please set it in your .env file.")
+    print(f"\n🔍 Processing Patient{patient_id}...")
+
+    image_paths = prepared["paths"]
+
+    if not image_paths:
+        print(f"⚠️ No images found for Patient{patient_id}")
+        return {
+            "Patient ID": patient_id,
+            "Error": "No images found",
+            "Grok Response": "",
+            "Likert-Skala ohne Anamnese": "N/A",
+            "Likert-Skala mit Anamnese": "N/A"
+        }
 
-    df = pd.read_excel(EXCEL_PATH)
-    results = []
+    print(f"🖼️ Found {len(image_paths)} image(s)")
 
-    print(f"🚀 Starting analysis for {len(df)} patients...")
+    if prepared["error"]:
+        print(f"❌ Image encoding failed: {prepared['error']}")
+        return None
 
-    for idx, row in df.iterrows():
-        patient_id = row["Reihenfolge Bilder"]
-        medical_history = row.get("Anamnese (medical history)", "")
+    print(prepared["plan"].describe(prepared["images"]))
+    if "dedup" in prepared:
+        print(prepared["dedup"].describe(prepared["images"]))
+    encoded_images = [base64.b64encode(data).decode("utf-8") for data in prepared["images"]]
 
-        print(f"\n🔍 Processing Patient{patient_id}...")
+    if REPLICATES > 1:
+        # One payload, REPLICATES sampled answers; the first one fills the usual columns
+        replicates = answered(ask_grok(encoded_images, medical_history, plan=prepared["plan"], samples=REPLICATES))
+        print(f"🔁 {len(replicates)} of {REPLICATES} replicate(s) answered")
+        grok_response = replicates[0] if replicates else "ERROR"
+    else:
+        grok_response = ask_grok(encoded_images, medical_history, plan=prepared["plan"])
 
-        image_paths = sorted([
-            os.path.join(IMAGES_FOLDER, f)
-            for f in os.listdir(IMAGES_FOLDER)
-            if f.startswith(f"Patient{patient_id}_") and f.lower().endswith((".jpg", ".jpeg", ".png"))
-        ])
+    if grok_response == "ERROR":
+        print(f"❌ Failed to get valid response for Patient{patient_id}")
+        return None
 
-        if not image_paths:
-            print(f"⚠️ No images found for Patient{patient_id}")
-            results.append({
-                "Patient ID": patient_id,
-                "Error": "No images found",
-                "Grok Response": "",
-                "Likert-Skala ohne Anamnese": "N/A",
-                "Likert-Skala mit Anamnese": "N/A"
-            })
-            continue
+    print(f"✅ Completed Patient{patient_id}")
 
-        print(f"🖼️ Found {len(image_paths)} image(s)")
+    record = result_record(row, grok_response, len(image_paths))
+    if REPLICATES > 1:
+        record[REPLICATE_COLUMN] = replicates
+    return record
 
-        try:
-            encoded_images = [encode_image_to_base64(p) for p in image_paths]
-        except Exception as e:
-            print(f"❌ Image encoding failed: {e}")
-            continue
+def result_record(row, grok_response: str, n_images: int = 0, structured: bool = STRUCTURED_OUTPUT) -> dict:
+    """Journal record of one answered case (also built by batch_mode.py when ingesting)."""
+    medical_history = row.get("Anamnese (medical history)", "")
+    return {
+        "Patient ID": row["Reihenfolge Bilder"],
+        "Grok Response": grok_response,
+        "Number of Images": n_images,
+        "Medical History": (
+            medical_history[:200] + "..."
+            if len(medical_history) > 200
+            else medical_history
+        ),
+        **result_columns(grok_response, structured=structured)
+    }
 
-        grok_response = ask_grok(encoded_images, medical_history)
+# === MAIN PROCESSING FUNCTION ===
+def process_excel_and_images(concurrency: int = GROK_CONCURRENCY, resume: bool = False):
+    """Process Excel sheet, analyze CT scan images via Grok, and save results."""
+    if not XAI_API_KEY and not RESPONSE_CACHE.replay_only:
+        raise ValueError("❌ Missing XAI_API_KEY. Please set it in your .env file.")
 
-        if grok_response == "ERROR":
-            print(f"❌ Failed to get valid response for Patient{patient_id}")
-            continue
+    with TELEMETRY.stage("load_sheet"):
+        df = read_sheet(EXCEL_PATH)
+    rows = [row for _, row in df.iterrows()]
+    journal = ResultJournal(JOURNAL_FILE)
 
-        likert_no_hist, likert_with_hist = extract_likert_scores(grok_response)
+    if resume:
+        done = journal.completed_ids()
+        rows = [row for row in rows if normalize_patient_id(row["Reihenfolge Bilder"]) not in done]
+        print(f"⏩ Resuming: {len(df) - len(rows)} patient(s) already in {JOURNAL_FILE}")
+    else:
+        # A fresh run starts an empty journal, so no earlier answer ends up in this run's results
+        previous = journal.rotate()
+        if previous:
+            print(f"🗂️ Previous journal moved to {previous}")
 
-        results.append({
-            "Patient ID": patient_id,
-            "Grok Response": grok_response,
-            "Number of Images": len(image_paths),
-            "Medical History": (
-                medical_history[:200] + "..."
-                if len(medical_history) > 200
-                else medical_history
-            ),
-            "Likert-Skala ohne Anamnese": likert_no_hist,
-            "Likert-Skala mit Anamnese": likert_with_hist
-        })
-
-        print(f"✅ Completed Patient{patient_id}")
-
-    # Save all results
-    out_df = pd.DataFrame(results)
-    out_df.to_excel(OUTPUT_FILE, index=False)
-    print(f"\n📁 Results saved to: {OUTPUT_FILE}")
-    print(f"📊 Processed {len(results)} patients successfully.")
+    with TELEMETRY.stage("discovery"):
+        index = load_case_index(IMAGES_FOLDER, CASE_INDEX_FILE)
+
+    # Slices are encoded in worker processes ahead of the API calls, sized by the payload planner
+    pipeline = open_preprocess_pipeline(IMAGE_CACHE, XAI_PAYLOAD, telemetry=TELEMETRY, index=index)
+    prepared_cases = pipeline.stream(
+        rows, lambda row: case_sources(index, row["Reihenfolge Bilder"], DICOM_WINDOW, DICOM_SLICES)
+    )
+
+    print(f"🚀 Starting analysis for {len(rows)} patients ({concurrency} in parallel)...")
+
+    # Cases run concurrently; results come back in sheet order
+    # Each case is traced (stage timings, tokens, cost) before its result is journaled
+    worker = TELEMETRY.instrument(process_case, lambda prepared: prepared["item"]["Reihenfolge Bilder"])
+    tracker = InFlightTracker()
+    results = run_dispatch(
+        prepared_cases, journal.recording(worker), concurrency=concurrency,
+        key=lambda prepared: f"Patient{prepared['item']['Reihenfolge Bilder']}", tracker=tracker
+    )
+    results = [r for r in results if r is not None]
+
+    # Materialize the journal (including resumed cases) in sheet order
+    saved = journal.save_results(RESULTS_FILE, OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"\n📁 Results saved to: {saved}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
+    print(f"📊 Processed {len(results)} patients successfully (peak {tracker.peak} request(s) in flight).")
+    print(IMAGE_CACHE.summary())
+    print(pipeline.timing_summary())
+    print(XAI_PROVIDER.connection_summary())
+    print(XAI_LIMITER.summary())
+    print(XAI_PAYLOAD.summary())
+    print(RESPONSE_CACHE.summary())
+    print(TELEMETRY.summary())
+    TELEMETRY.write_metrics()
+
+# === EXPORT JOURNAL ===
+def export_results():
+    """Write OUTPUT_FILE (Excel) from the result journal without calling the API."""
+    df = read_sheet(EXCEL_PATH, columns=["Reihenfolge Bilder"])
+    journal = ResultJournal(JOURNAL_FILE)
+    count = journal.export_excel(OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"📁 Exported {count} journaled result(s) to: {OUTPUT_FILE}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
 
 # === HELPER ===
 def check_api_key() -> bool:
-    """Verify that the API key is correctly set."""
-    if not XAI_API_KEY:
+    """Verify that the API key is correctly set (not needed when only replaying cached answers)."""
+    if not XAI_API_KEY and not RESPONSE_CACHE.replay_only:
         print("❌ Missing API key! Get one at https://console.x.ai/")
         print("Add it to your .env file as: XAI_API_KEY=your_api_key_here")
         return False
@@ -192,7 +310,17 @@ def check_api_key() -> bool:
 
 # === RUN SCRIPT ===
 if __name__ == "__main__":
-    if check_api_key():
-        process_excel_and_images()
+    parser = argparse.ArgumentParser(description="Classify CT cases with Grok.")
+    parser.add_argument("--resume", action="store_true", help="Skip patients already in the result journal.")
+    parser.add_argument("--export", action="store_true", help="Only export the result journal to the Excel OUTPUT_FILE.")
+    parser.add_argument("--replicates", type=int, default=REPLICATES,
+                        help="Answers sampled per case from one payload (default REPLICATES, 1 = off).")
+    args = parser.parse_args()
+    REPLICATES = max(1, args.replicates)
+
+    if args.export:
+        export_results()
+    elif check_api_key():
+        process_excel_and_images(resume=args.resume)
     else:
         print("⚠️ Please configure your API key before running.")
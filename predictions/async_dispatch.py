@@ -0,0 +1,126 @@
+import time
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# === DISPATCH ENGINE SHARED BY THE PREDICTION SCRIPTS ===
+# Cases are handed to a worker with at most `concurrency` of them in flight.
+# Blocking workers (ask_gpt, ask_gemini, ask_grok, ...) run in a thread pool,
+# coroutine workers run directly on the loop. Results keep the input order.
+
+_DONE = object()
+
+
+class InFlightTracker:
+    """Record which cases are currently being processed and how long they took."""
+
+    def __init__(self):
+        self.active: Dict[Any, float] = {}
+        self.durations: List[float] = []
+        self.peak = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+
+    def start(self, key: Any) -> None:
+        self.active[key] = time.perf_counter()
+        self.started += 1
+        self.peak = max(self.peak, len(self.active))
+
+    def finish(self, key: Any, ok: bool = True) -> None:
+        started_at = self.active.pop(key, None)
+        if started_at is not None:
+            self.durations.append(time.perf_counter() - started_at)
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    @property
+    def in_flight(self) -> int:
+        return len(self.active)
+
+    def snapshot(self) -> dict:
+        """Return counters suitable for a progress line or a run summary."""
+        return {
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak,
+            "started": self.started,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+
+async def dispatch(
+    items: Iterable[Any],
+    worker: Callable[[Any], Any],
+    concurrency: int = 1,
+    key: Optional[Callable[[Any], Any]] = None,
+    tracker: Optional[InFlightTracker] = None,
+) -> List[Any]:
+    """Run `worker` over `items` with bounded concurrency, returning results in input order.
+
+    `items` is consumed lazily, so a generator that blocks (e.g. on a preprocessing
+    queue) only gets pulled when a slot is free. A worker that raises yields None
+    for that item instead of aborting the whole run.
+    """
+    concurrency = max(1, int(concurrency))
+    tracker = tracker if tracker is not None else InFlightTracker()
+    key = key or (lambda item: item)
+    is_coroutine = inspect.iscoroutinefunction(worker)
+
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency + 1, thread_name_prefix="dispatch")
+    loop.set_default_executor(executor)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    results: Dict[int, Any] = {}
+    tasks = []
+
+    async def run_one(index: int, item: Any) -> None:
+        item_key = None
+        ok = True
+        try:
+            item_key = key(item)
+            tracker.start(item_key)
+            if is_coroutine:
+                results[index] = await worker(item)
+            else:
+                results[index] = await asyncio.to_thread(worker, item)
+        except Exception as e:
+            ok = False
+            results[index] = None
+            print(f"❌ Worker failed for {item if item_key is None else item_key}: {e}")
+        finally:
+            tracker.finish(item_key, ok)
+            semaphore.release()
+
+    iterator = iter(items)
+    lazy = not isinstance(items, (list, tuple))
+    index = 0
+    try:
+        while True:
+            await semaphore.acquire()
+            item = await asyncio.to_thread(next, iterator, _DONE) if lazy else next(iterator, _DONE)
+            if item is _DONE:
+                semaphore.release()
+                break
+            tasks.append(asyncio.create_task(run_one(index, item)))
+            index += 1
+        await asyncio.gather(*tasks)
+    finally:
+        executor.shutdown(wait=False)
+
+    return [results[i] for i in range(index)]
+
+
+def run_dispatch(
+    items: Iterable[Any],
+    worker: Callable[[Any], Any],
+    concurrency: int = 1,
+    key: Optional[Callable[[Any], Any]] = None,
+    tracker: Optional[InFlightTracker] = None,
+) -> List[Any]:
+    """Blocking entry point around `dispatch` for the synchronous scripts."""
+    return asyncio.run(dispatch(items, worker, concurrency=concurrency, key=key, tracker=tracker))
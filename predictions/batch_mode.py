@@ -0,0 +1,348 @@
+import os
+import json
+import time
+import base64
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional
+from dotenv import load_dotenv
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources
+from multi_provider import PROVIDER_SCRIPTS, load_providers
+from preprocess import open_preprocess_pipeline
+from providers import OpenAIProvider
+from replicates import save_replicates
+from result_journal import REPLICATE_COLUMN, ResultJournal
+from sheet_store import read_sheet
+
+# === PROVIDER BATCH API: SUBMIT, POLL, INGEST ===
+# For large retrospective cohorts latency per case does not matter, but cost and
+# rate limits do. Batch mode writes every case as one line of a batch JSONL file
+# (the same request body ask_gpt / ask_grok send), uploads the files to the
+# provider's Files API, creates one batch per file, polls until the batches are
+# finished and journals the answers like a normal run, so the results table and
+# `--export` work unchanged. Big cohorts are split into several files by request
+# count and size. The manifest (<OUTPUT_FILE>.<provider>.batches.json) records
+# every file and batch, so each step can be re-run or resumed after a crash:
+#
+#   python predictions/batch_mode.py run --provider gpt4o       # all steps, waits for the batches
+#   python predictions/batch_mode.py prepare --provider gpt4o   # or one step at a time:
+#   python predictions/batch_mode.py submit --provider gpt4o    #   prepare, submit, poll, ingest
+#
+# Patients already in the journal are never batched again, so after a failed
+# batch a plain `prepare` puts the missing cases (and only them) into new batch
+# files; `--all` resends the whole sheet.
+
+load_dotenv()
+
+# === CONFIGURATION ===
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "50000"))  # Request lines per batch file
+BATCH_MAX_MB = float(os.getenv("BATCH_MAX_MB", "190"))  # Size per batch file (providers cap inputs at 200 MB)
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", "60"))  # Between status checks while batches run
+BATCH_COMPLETION_WINDOW = os.getenv("BATCH_COMPLETION_WINDOW", "24h")  # Window the provider has to finish
+BATCH_PRICE_FACTOR = float(os.getenv("BATCH_PRICE_FACTOR", "0.5"))  # Batch discount applied to cost estimates
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def _xai_batch_client(module) -> OpenAIProvider:
+    """OpenAI-compatible Files / Batches client on the xAI base URL (XAI_BATCH_BASE_URL overrides it)."""
+    base_url = os.getenv("XAI_BATCH_BASE_URL") or module.XAI_API_URL.rsplit("/chat/completions", 1)[0]
+    return OpenAIProvider(api_key=module.XAI_API_KEY, base_url=base_url)
+
+
+BATCH_PROVIDERS = {
+    "gpt4o": {"body": "gpt_request_body", "client": lambda module: module.GPT_PROVIDER, "samples": True},
+    "grok": {"body": "grok_request_body", "client": _xai_batch_client, "samples": False},
+}
+
+
+def default_manifest_path(output_file: str, provider: str) -> str:
+    return f"{os.path.splitext(output_file)[0]}.{provider}.batches.json"
+
+
+def default_batch_dir(output_file: str, provider: str) -> str:
+    return f"{os.path.splitext(output_file)[0]}.{provider}.batches"
+
+
+# === MANIFEST ===
+class BatchManifest:
+    """Batch files of one provider and the state of the batch each was submitted as."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks: List[dict] = []
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.chunks = json.load(f)["chunks"]
+
+    def save(self) -> None:
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"chunks": self.chunks}, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def pending_ids(self) -> set:
+        """Patients in batch files whose answers have not been ingested yet."""
+        return {pid for chunk in self.chunks if not chunk.get("ingested") for pid in chunk["cases"]}
+
+    def summary(self) -> str:
+        counts: Dict[str, int] = {}
+        for chunk in self.chunks:
+            state = "ingested" if chunk.get("ingested") else chunk.get("status") or "not submitted"
+            counts[state] = counts.get(state, 0) + 1
+        states = ", ".join(f"{n} {state}" for state, n in counts.items()) or "none"
+        return (f"📦 {len(self.chunks)} batch file(s), {sum(c['requests'] for c in self.chunks)} request(s): "
+                f"{states}")
+
+
+class ChunkWriter:
+    """Writes request lines to part-NNNN.jsonl files, starting a new file at the request or size limit."""
+
+    def __init__(self, directory: str, first_part: int, max_requests: int, max_bytes: int, structured: bool):
+        self.directory = directory
+        self.part = first_part
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.structured = structured
+        self.chunks: List[dict] = []
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, custom_id: str, body: dict, patient_id: str, n_images: int) -> None:
+        line = (json.dumps({"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+                           ensure_ascii=False) + "\n").encode("utf-8")
+        chunk = self.chunks[-1] if self._file else None
+        if chunk is None or chunk["requests"] >= self.max_requests or chunk["bytes"] + len(line) > self.max_bytes:
+            chunk = self._next_file()
+        if len(line) > self.max_bytes:
+            print(f"⚠️ {custom_id} alone is {len(line) / 1024 ** 2:.1f} MB, above BATCH_MAX_MB")
+        self._file.write(line)
+        chunk["requests"] += 1
+        chunk["bytes"] += len(line)
+        chunk["cases"][patient_id] = {"custom_id": custom_id, "images": n_images}
+        chunk["model"] = body["model"]  # priced by the requested name; responses report dated snapshots
+
+    def _next_file(self) -> dict:
+        self.close()
+        self.part += 1
+        path = os.path.join(self.directory, f"part-{self.part:04d}.jsonl")
+        self._file = open(path, "wb")
+        self.chunks.append({"file": path, "requests": 0, "bytes": 0, "structured": self.structured,
+                            "cases": {}, "status": None, "ingested": False})
+        return self.chunks[-1]
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+# === BATCH RUN ===
+class BatchRun:
+    """prepare / submit / poll / ingest for one provider script."""
+
+    def __init__(self, provider: str):
+        if provider not in BATCH_PROVIDERS:
+            raise ValueError(f"❌ Batch mode supports {sorted(BATCH_PROVIDERS)}, not '{provider}'")
+        self.provider = provider
+        self.module = load_providers([provider])[provider]
+        self.spec = BATCH_PROVIDERS[provider]
+        self.limiter = getattr(self.module, PROVIDER_SCRIPTS[provider]["limiter"])
+        self.manifest = BatchManifest(
+            os.getenv("BATCH_MANIFEST") or default_manifest_path(self.module.OUTPUT_FILE, provider))
+        self.batch_dir = os.getenv("BATCH_DIR") or default_batch_dir(self.module.OUTPUT_FILE, provider)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = self.spec["client"](self.module).client
+        return self._client
+
+    def prepare(self, all_cases: bool = False) -> int:
+        """Write batch files for every case not waiting in a batch or journaled; returns the request count.
+
+        With `all_cases`, journaled patients are batched again as well.
+        """
+        module = self.module
+        df = read_sheet(module.EXCEL_PATH)
+        rows = [row for _, row in df.iterrows()]
+        skip = self.manifest.pending_ids()
+        if not all_cases:
+            skip |= ResultJournal(module.JOURNAL_FILE).completed_ids()
+        rows = [row for row in rows if normalize_patient_id(row["Reihenfolge Bilder"]) not in skip]
+        print(f"🧾 {len(rows)} case(s) to batch, {len(df) - len(rows)} skipped (waiting in a batch or journaled)")
+        if not rows:
+            return 0
+
+        index = load_case_index(module.IMAGES_FOLDER, module.CASE_INDEX_FILE)
+        planner = getattr(module, PROVIDER_SCRIPTS[self.provider]["payload"])
+        pipeline = open_preprocess_pipeline(module.IMAGE_CACHE, planner, telemetry=module.TELEMETRY, index=index)
+        writer = ChunkWriter(self.batch_dir, len(self.manifest.chunks), BATCH_MAX_REQUESTS,
+                             int(BATCH_MAX_MB * 1024 ** 2), module.STRUCTURED_OUTPUT)
+        build = getattr(module, self.spec["body"])
+        try:
+            prepared_cases = pipeline.stream(
+                rows,
+                lambda row: case_sources(index, row["Reihenfolge Bilder"], module.DICOM_WINDOW, module.DICOM_SLICES)
+            )
+            for prepared in prepared_cases:
+                row = prepared["item"]
+                patient_id = row["Reihenfolge Bilder"]
+                if not prepared["paths"]:
+                    print(f"⚠️ No images found for Patient{patient_id}")
+                    continue
+                if prepared["error"]:
+                    print(f"❌ Image encoding failed for Patient{patient_id}: {prepared['error']}")
+                    continue
+                encoded_images = [base64.b64encode(data).decode("utf-8") for data in prepared["images"]]
+                body = build(encoded_images, row.get("Anamnese (medical history)", ""),
+                             structured=module.STRUCTURED_OUTPUT, plan=prepared["plan"])
+                if self.spec["samples"] and module.REPLICATES > 1:
+                    body["n"] = module.REPLICATES
+                writer.add(f"Patient{patient_id}", body, normalize_patient_id(patient_id), len(prepared["paths"]))
+        finally:
+            writer.close()
+
+        self.manifest.chunks.extend(writer.chunks)
+        self.manifest.save()
+        requests = sum(chunk["requests"] for chunk in writer.chunks)
+        size = sum(chunk["bytes"] for chunk in writer.chunks) / 1024 ** 2
+        print(f"📝 Wrote {requests} request(s) to {len(writer.chunks)} batch file(s) in {self.batch_dir} "
+              f"({size:.1f} MB)")
+        print(pipeline.timing_summary())
+        return requests
+
+    def submit(self) -> int:
+        """Upload every batch file not submitted yet and create its batch."""
+        submitted = 0
+        for chunk in self.manifest.chunks:
+            if chunk.get("batch_id"):
+                continue
+            if not chunk.get("input_file_id"):
+                # A path (not an open file), so a retried upload sends the whole file again
+                uploaded = self.limiter.call(
+                    lambda: self.client.files.create(file=Path(chunk["file"]), purpose="batch"))
+                chunk["input_file_id"] = uploaded.id
+                self.manifest.save()
+            batch = self.limiter.call(lambda: self.client.batches.create(
+                input_file_id=chunk["input_file_id"], endpoint=BATCH_ENDPOINT,
+                completion_window=BATCH_COMPLETION_WINDOW,
+                metadata={"provider": self.provider, "file": os.path.basename(chunk["file"])},
+            ))
+            chunk.update(batch_id=batch.id, status=batch.status, submitted=time.time(),
+                         output_file_id=batch.output_file_id, error_file_id=batch.error_file_id)
+            self.manifest.save()
+            submitted += 1
+            print(f"🚀 {os.path.basename(chunk['file'])}: batch {batch.id} ({chunk['requests']} request(s))")
+        return submitted
+
+    def poll(self, wait: bool = True, poll_seconds: float = BATCH_POLL_SECONDS) -> bool:
+        """Refresh batch states (until all are finished when `wait`); True when none is still running."""
+        while True:
+            running = 0
+            for chunk in self.manifest.chunks:
+                if not chunk.get("batch_id") or chunk["status"] in TERMINAL_STATUSES:
+                    continue
+                batch = self.limiter.call(lambda: self.client.batches.retrieve(chunk["batch_id"]))
+                counts = batch.request_counts
+                chunk.update(status=batch.status, output_file_id=batch.output_file_id,
+                             error_file_id=batch.error_file_id)
+                done = f"{counts.completed}/{counts.total} done, {counts.failed} failed" if counts else "no counts yet"
+                icon = "✅" if batch.status == "completed" else "⚠️" if batch.status in TERMINAL_STATUSES else "⏳"
+                print(f"{icon} {os.path.basename(chunk['file'])}: {batch.status} ({done})")
+                running += batch.status not in TERMINAL_STATUSES
+            self.manifest.save()
+            if not running or not wait:
+                return not running
+            time.sleep(poll_seconds)
+
+    def _file_lines(self, file_id: Optional[str]) -> List[dict]:
+        if not file_id:
+            return []
+        text = self.limiter.call(lambda: self.client.files.content(file_id)).text
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    def ingest(self) -> int:
+        """Journal the answers of finished batches and write the results table; returns answers journaled."""
+        module = self.module
+        df = read_sheet(module.EXCEL_PATH)
+        rows = {normalize_patient_id(row["Reihenfolge Bilder"]): row for _, row in df.iterrows()}
+        journal = ResultJournal(module.JOURNAL_FILE)
+        journaled = failed = 0
+        for chunk in self.manifest.chunks:
+            if chunk.get("ingested") or chunk.get("status") not in TERMINAL_STATUSES:
+                continue
+            by_custom_id = {case["custom_id"]: (pid, case) for pid, case in chunk["cases"].items()}
+            answered = set()
+            # Expired or cancelled batches still have output files for the requests that finished
+            for line in self._file_lines(chunk.get("output_file_id")):
+                pid, case = by_custom_id.get(line.get("custom_id"), (None, None))
+                response = line.get("response") or {}
+                body = response.get("body") or {}
+                if pid not in rows or response.get("status_code") != 200 or not body.get("choices"):
+                    continue
+                usage = body.get("usage") or {}
+                module.TELEMETRY.record_usage(chunk.get("model") or body.get("model"), usage.get("prompt_tokens"),
+                                              usage.get("completion_tokens"), price_factor=BATCH_PRICE_FACTOR)
+                texts = [choice["message"]["content"] for choice in body["choices"]]
+                record = module.result_record(rows[pid], texts[0], case["images"], structured=chunk["structured"])
+                if len(texts) > 1:
+                    record[REPLICATE_COLUMN] = texts
+                journal.append(pid, record, completed="Error" not in record)
+                answered.add(pid)
+            missing = sorted(set(chunk["cases"]) - answered)
+            for line in self._file_lines(chunk.get("error_file_id"))[:5]:
+                error = (line.get("error") or (line.get("response") or {}).get("body", {}).get("error") or {})
+                print(f"❌ {line.get('custom_id')}: {error.get('message', error)}")
+            if missing:
+                print(f"⚠️ {os.path.basename(chunk['file'])}: {len(missing)} case(s) without an answer "
+                      f"({chunk['status']}); `prepare` batches them again")
+            chunk["ingested"] = True
+            self.manifest.save()
+            journaled += len(answered)
+            failed += len(missing)
+            print(f"📥 {os.path.basename(chunk['file'])}: {len(answered)} answer(s) journaled")
+
+        order = df["Reihenfolge Bilder"]
+        saved = journal.save_results(module.RESULTS_FILE, module.OUTPUT_FILE, order=order)
+        print(f"\n📁 Results saved to: {saved} ({journaled} new answer(s), {failed} case(s) without one)")
+        replicates = save_replicates(journal, module.REPLICATES_FILE, order=order)
+        if replicates:
+            print(f"🔁 Replicates saved to: {replicates}")
+        print(module.TELEMETRY.summary())
+        module.TELEMETRY.write_metrics()
+        return journaled
+
+    def run(self, all_cases: bool = False, poll_seconds: float = BATCH_POLL_SECONDS) -> int:
+        self.prepare(all_cases=all_cases)
+        self.submit()
+        self.poll(wait=True, poll_seconds=poll_seconds)
+        return self.ingest()
+
+
+# === RUN SCRIPT ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify a cohort through the provider Batch API.")
+    parser.add_argument("command", choices=("run", "prepare", "submit", "poll", "status", "ingest"),
+                        help="run: all steps; prepare: write batch files; submit: upload and create batches; "
+                             "poll: wait for the batches; status: check once; ingest: journal the answers")
+    parser.add_argument("--provider", required=True, help="gpt4o or grok")
+    parser.add_argument("--all", dest="all_cases", action="store_true",
+                        help="prepare: also batch patients already in the journal.")
+    parser.add_argument("--poll", type=float, default=BATCH_POLL_SECONDS, help="Seconds between status checks.")
+    args = parser.parse_args()
+
+    batch_run = BatchRun(args.provider)
+    if args.command == "run":
+        batch_run.run(all_cases=args.all_cases, poll_seconds=args.poll)
+    elif args.command == "prepare":
+        batch_run.prepare(all_cases=args.all_cases)
+    elif args.command == "submit":
+        batch_run.submit()
+    elif args.command in ("poll", "status"):
+        batch_run.poll(wait=args.command == "poll", poll_seconds=args.poll)
+    elif args.command == "ingest":
+        batch_run.ingest()
+    print(batch_run.manifest.summary())
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+# === CASE MANIFEST INDEX ===
+# Maps patient IDs to their CT slices with a single walk over IMAGES_FOLDER
+# (including sharded subdirectories such as ct_scans/000/Patient3_1.jpg).
+# The index is persisted together with directory and file mtime/size, so later
+# runs only re-list directories whose mtime changed. A folder named Patient<id>
+# holding .dcm files is indexed as that patient's DICOM series. Perceptual hashes
+# of slices (see slice_dedup) are stored alongside, valid while the file's current
+# mtime/size match (a fresh stat: overwriting a slice in place leaves the
+# directory mtime, and so the recorded listing, unchanged).
+
+INDEX_VERSION = 2
+
+_SLICE_PATTERN = re.compile(r"^Patient(?P<patient>[^_]+)_(?P<slice>.+)\.(?i:jpe?g|png)$")
+_SERIES_DIR = re.compile(r"^Patient(?P<patient>[^_]+)$")
+_DICOM_FILE = re.compile(r"\.dcm$", re.IGNORECASE)
+_DIGITS = re.compile(r"(\d+)")
+
+
+def normalize_patient_id(patient_id) -> str:
+    """Turn sheet values like 3, 3.0 or ' 3 ' into the '3' used in file names."""
+    if isinstance(patient_id, float) and patient_id.is_integer():
+        patient_id = int(patient_id)
+    return str(patient_id).strip()
+
+
+def current_stat(path: str) -> Optional[Tuple[float, int]]:
+    """(mtime, size) of the file as it is now, None if it is gone."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size
+
+
+def slice_sort_key(name: str) -> Tuple:
+    """Natural order, so Patient3_2.jpg comes before Patient3_10.jpg."""
+    return tuple(int(part) if part.isdigit() else part.lower() for part in _DIGITS.split(name))
+
+
+class CaseIndex:
+    """Patient ID -> ordered slice list, built in one scan and refreshed incrementally."""
+
+    def __init__(self, root: str, index_path: Optional[str] = None):
+        self.root = os.path.abspath(root)
+        self.index_path = index_path
+        # relative dir -> {"mtime": float, "subdirs": [...], "files": {name: [mtime, size]}}
+        self.dirs: Dict[str, dict] = {}
+        # relative slice path (+ "#<cache_tag>" for rendered sources) -> [mtime, size, {method: hex hash}]
+        self.hashes: Dict[str, list] = {}
+        self._by_patient: Dict[str, List[str]] = {}
+        self._series: Dict[str, List[str]] = {}
+        self.stats = {"dirs_listed": 0, "dirs_reused": 0, "files": 0}
+
+    # --- persistence ---
+    def load(self) -> bool:
+        """Read a previously saved index; returns False if missing or built for another root."""
+        if not self.index_path or not os.path.exists(self.index_path):
+            return False
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != INDEX_VERSION or data.get("root") != self.root:
+            return False
+        self.dirs = data.get("dirs", {})
+        self.hashes = data.get("hashes", {})
+        return True
+
+    def save(self) -> None:
+        if not self.index_path:
+            return
+        # Hashes of files that changed or disappeared are dropped
+        hashes = {key: value for key, value in self.hashes.items()
+                  if current_stat(os.path.join(self.root, key.split("#")[0])) == tuple(value[:2])}
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "root": self.root, "saved_at": time.time(), "dirs": self.dirs,
+                       "hashes": hashes}, f)
+        os.replace(tmp_path, self.index_path)
+
+    # --- scanning ---
+    def refresh(self, full: bool = False) -> dict:
+        """Walk the tree, re-listing only directories whose mtime changed (or all if `full`)."""
+        self.stats = {"dirs_listed": 0, "dirs_reused": 0, "files": 0}
+        previous = {} if full else self.dirs
+        self.dirs = {}
+
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            abs_dir = os.path.join(self.root, rel_dir)
+            try:
+                mtime = os.stat(abs_dir).st_mtime
+            except FileNotFoundError:
+                continue
+
+            cached = previous.get(rel_dir)
+            if cached is not None and cached["mtime"] == mtime:
+                entry = cached
+                self.stats["dirs_reused"] += 1
+            else:
+                entry = self._list_dir(rel_dir, abs_dir, mtime)
+                self.stats["dirs_listed"] += 1
+
+            self.dirs[rel_dir] = entry
+            pending.extend(os.path.join(rel_dir, sub) for sub in entry["subdirs"])
+
+        self._rebuild_lookup()
+        self.stats["files"] = sum(len(paths) for paths in self._by_patient.values())
+        self.stats["series"] = len(self._series)
+        return self.stats
+
+    def _list_dir(self, rel_dir: str, abs_dir: str, mtime: float) -> dict:
+        subdirs, files = [], {}
+        with os.scandir(abs_dir) as it:
+            for entry in it:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif _SLICE_PATTERN.match(entry.name) or _DICOM_FILE.search(entry.name):
+                    st = entry.stat()
+                    files[entry.name] = [st.st_mtime, st.st_size]
+        return {"mtime": mtime, "subdirs": sorted(subdirs), "files": files}
+
+    def _rebuild_lookup(self) -> None:
+        by_patient: Dict[str, List[Tuple]] = {}
+        series: Dict[str, List[str]] = {}
+        for rel_dir, entry in self.dirs.items():
+            series_match = _SERIES_DIR.match(os.path.basename(rel_dir))
+            for name in entry["files"]:
+                if _DICOM_FILE.search(name):
+                    if series_match:
+                        series.setdefault(series_match.group("patient"), []).append(
+                            os.path.join(self.root, rel_dir, name)
+                        )
+                    continue
+                match = _SLICE_PATTERN.match(name)
+                key = (slice_sort_key(match.group("slice")), rel_dir)
+                by_patient.setdefault(match.group("patient"), []).append(
+                    (key, os.path.join(self.root, rel_dir, name))
+                )
+        self._by_patient = {
+            patient: [path for _, path in sorted(items)] for patient, items in by_patient.items()
+        }
+        self._series = {patient: sorted(paths, key=slice_sort_key) for patient, paths in series.items()}
+
+    # --- lookups ---
+    def slices(self, patient_id) -> List[str]:
+        """Ordered slice paths for a patient (empty list if none)."""
+        return list(self._by_patient.get(normalize_patient_id(patient_id), []))
+
+    def series(self, patient_id) -> List[str]:
+        """DICOM files of the patient's series folder, unordered along z (empty list if none)."""
+        return list(self._series.get(normalize_patient_id(patient_id), []))
+
+    def file_stat(self, path: str) -> Optional[Tuple[float, int]]:
+        """(mtime, size) recorded for a slice at scan time."""
+        rel_dir, name = os.path.split(os.path.relpath(path, self.root))
+        entry = self.dirs.get(rel_dir)
+        if entry is None or name not in entry["files"]:
+            return None
+        return tuple(entry["files"][name])
+
+    # --- slice hashes ---
+    def _hash_key(self, source) -> Tuple[str, Optional[Tuple[float, int]]]:
+        path = getattr(source, "path", source)
+        tag = getattr(source, "cache_tag", None)
+        key = os.path.relpath(path, self.root) + (f"#{tag}" if tag else "")
+        return key, current_stat(path)
+
+    def cached_hash(self, source, method: str) -> Optional[int]:
+        """Stored `method` hash of a slice (path or rendered source), None if missing or stale."""
+        key, stat = self._hash_key(source)
+        entry = self.hashes.get(key)
+        if stat is None or entry is None or tuple(entry[:2]) != stat or method not in entry[2]:
+            return None
+        return int(entry[2][method], 16)
+
+    def store_hash(self, source, method: str, value: int) -> None:
+        key, stat = self._hash_key(source)
+        if stat is None:
+            return
+        entry = self.hashes.get(key)
+        if entry is None or tuple(entry[:2]) != stat:
+            entry = self.hashes[key] = [stat[0], stat[1], {}]
+        entry[2][method] = f"{value:016x}"
+
+    def patients(self) -> List[str]:
+        return sorted(set(self._by_patient) | set(self._series), key=slice_sort_key)
+
+    def __len__(self) -> int:
+        return len(set(self._by_patient) | set(self._series))
+
+
+def load_case_index(root: str, index_path: Optional[str] = None, full: bool = False) -> CaseIndex:
+    """Load the persisted index for `root`, refresh what changed and save it back."""
+    index = CaseIndex(root, index_path)
+    if not full:
+        index.load()
+    start = time.perf_counter()
+    stats = index.refresh(full=full)
+    index.save()
+    print(
+        f"🗂️ Indexed {stats['files']} slice(s) and {stats['series']} DICOM series for {len(index)} patient(s) in "
+        f"{time.perf_counter() - start:.2f}s ({stats['dirs_listed']} dir(s) listed, {stats['dirs_reused']} reused)"
+    )
+    return index
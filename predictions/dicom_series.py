@@ -0,0 +1,265 @@
+import os
+import argparse
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from PIL import Image
+from case_index import slice_sort_key
+
+# === NATIVE DICOM SERIES INGESTION ===
+# A patient folder IMAGES_FOLDER/Patient<id>/ holding .dcm files is read as one
+# CT series instead of pre-exported JPEGs:
+#   - headers are read without pixel data to order the slices by position,
+#   - pixel data of uncompressed files is memory-mapped (only sampled slices are touched),
+#   - CT windows are applied as vectorized NumPy operations on the (slices, rows, cols) volume,
+#   - sampled slices are handed to the existing encoders as DicomSlice sources.
+# pydicom is only imported when DICOM data is actually encountered.
+#   python predictions/dicom_series.py synth --out ct_dicom --patients 12   # synthetic test series
+
+# (center, width) in Hounsfield units
+WINDOWS: Dict[str, Tuple[float, float]] = {
+    "brain": (40, 80),
+    "subdural": (75, 215),
+    "bone": (600, 2800),
+}
+# "multi" puts brain / subdural / bone into the R / G / B channels of one image
+MULTI_WINDOW = ("brain", "subdural", "bone")
+_PIXEL_DATA = 0x7FE00010
+
+
+def _require_pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ImportError("❌ DICOM input needs pydicom: pip install pydicom") from e
+    return pydicom
+
+
+# --- vectorized windowing ---
+def to_hounsfield(pixels: np.ndarray, slope: float = 1.0, intercept: float = 0.0) -> np.ndarray:
+    """Stored values -> HU as float32, for a single slice or a whole volume."""
+    return pixels.astype(np.float32) * np.float32(slope) + np.float32(intercept)
+
+
+def apply_window(hu: np.ndarray, center: float, width: float) -> np.ndarray:
+    """Clip HU to [center - width/2, center + width/2] and scale to uint8, elementwise."""
+    low = center - width / 2
+    scaled = (hu - np.float32(low)) * np.float32(255.0 / width)
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def window_volume(hu: np.ndarray, window: str = "brain") -> np.ndarray:
+    """Window a (..., rows, cols) array; "multi" adds a trailing RGB axis (brain, subdural, bone)."""
+    if window == "multi":
+        return np.stack([apply_window(hu, *WINDOWS[name]) for name in MULTI_WINDOW], axis=-1)
+    if window not in WINDOWS:
+        raise ValueError(f"❌ Unknown DICOM_WINDOW '{window}', expected one of {sorted(WINDOWS) + ['multi']}")
+    return apply_window(hu, *WINDOWS[window])
+
+
+def sample_indices(total: int, count: int) -> List[int]:
+    """`count` evenly spaced indices over `total` slices (all of them if count <= 0 or >= total)."""
+    if count <= 0 or count >= total:
+        return list(range(total))
+    return sorted(set(np.linspace(0, total - 1, count).round().astype(int).tolist()))
+
+
+# --- pixel access ---
+def read_pixels(path: str, frame: int = 0) -> Tuple[np.ndarray, float, float]:
+    """(stored pixels of one frame, slope, intercept); memory-mapped when the file is uncompressed."""
+    pydicom = _require_pydicom()
+    ds = pydicom.dcmread(path, defer_size=1024)
+    slope = float(getattr(ds, "RescaleSlope", 1) or 1)
+    intercept = float(getattr(ds, "RescaleIntercept", 0) or 0)
+    rows, cols = int(ds.Rows), int(ds.Columns)
+    frames = int(getattr(ds, "NumberOfFrames", 1) or 1)
+
+    transfer_syntax = getattr(getattr(ds, "file_meta", None), "TransferSyntaxUID", None)
+    try:
+        raw = ds.get_item(_PIXEL_DATA, keep_deferred=True)  # pydicom >= 3
+    except TypeError:
+        raw = ds.get_item(_PIXEL_DATA)
+    value_tell = getattr(raw, "value_tell", None)
+    # Deflated files are not compressed in the pixel-data sense, but their offsets point into the deflated stream
+    if (transfer_syntax is not None and not transfer_syntax.is_compressed and not transfer_syntax.is_deflated
+            and transfer_syntax.is_little_endian and value_tell is not None and int(ds.BitsAllocated) in (8, 16)
+            and int(getattr(ds, "SamplesPerPixel", 1)) == 1):
+        if int(ds.BitsAllocated) == 8:
+            dtype = np.uint8
+        else:
+            dtype = np.dtype("<i2") if int(ds.PixelRepresentation) == 1 else np.dtype("<u2")
+        volume = np.memmap(path, dtype=dtype, mode="r", offset=value_tell, shape=(frames, rows, cols))
+        return volume[frame], slope, intercept
+
+    # Compressed or unusual encodings: let pydicom decode the pixel data
+    pixels = ds.pixel_array
+    return (pixels[frame] if frames > 1 else pixels), slope, intercept
+
+
+class DicomSlice:
+    """One frame of a DICOM file plus the CT window to render it with (an encoder source)."""
+
+    __slots__ = ("path", "frame", "window")
+
+    def __init__(self, path: str, frame: int = 0, window: str = "brain"):
+        self.path = path
+        self.frame = frame
+        self.window = window
+
+    @property
+    def cache_tag(self) -> str:
+        """Distinguishes renderings of the same file in image cache keys."""
+        return f"dicom:{self.frame}:{self.window}"
+
+    def render(self) -> Image.Image:
+        pixels, slope, intercept = read_pixels(self.path, self.frame)
+        windowed = window_volume(to_hounsfield(pixels, slope, intercept), self.window)
+        return Image.fromarray(windowed, "RGB" if windowed.ndim == 3 else "L")
+
+    def __eq__(self, other):
+        return isinstance(other, DicomSlice) and (self.path, self.frame, self.window) == (
+            other.path, other.frame, other.window)
+
+    def __hash__(self):
+        return hash((self.path, self.frame, self.window))
+
+    def __repr__(self):
+        return f"DicomSlice({os.path.basename(self.path)!r}, frame={self.frame}, window={self.window!r})"
+
+
+class DicomSeries:
+    """The .dcm files of one folder, ordered along the patient axis from their headers."""
+
+    def __init__(self, paths: Sequence[str]):
+        pydicom = _require_pydicom()
+        entries = []
+        for path in paths:
+            ds = pydicom.dcmread(path, stop_before_pixels=True)
+            position = getattr(ds, "ImagePositionPatient", None)
+            order = (
+                float(position[2]) if position is not None else float(getattr(ds, "InstanceNumber", 0) or 0),
+                slice_sort_key(os.path.basename(path)),
+            )
+            for frame in range(int(getattr(ds, "NumberOfFrames", 1) or 1)):
+                entries.append((order, frame, path))
+        entries.sort()
+        self.frames: List[Tuple[str, int]] = [(path, frame) for _, frame, path in entries]
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def sample(self, count: int = 0, window: str = "brain") -> List[DicomSlice]:
+        return [DicomSlice(*self.frames[i], window=window) for i in sample_indices(len(self), count)]
+
+    def volume(self, indices: Optional[Sequence[int]] = None) -> np.ndarray:
+        """HU volume (slices, rows, cols) of the selected frames (all by default)."""
+        indices = range(len(self)) if indices is None else indices
+        slices = [to_hounsfield(*read_pixels(*self.frames[i])) for i in indices]
+        return np.stack(slices)
+
+    def render(self, count: int = 0, window: str = "brain") -> List[Image.Image]:
+        """Sample, window the whole sampled volume at once and return one image per slice."""
+        windowed = window_volume(self.volume(sample_indices(len(self), count)), window)
+        mode = "RGB" if windowed.ndim == 4 else "L"
+        return [Image.fromarray(slice_pixels, mode) for slice_pixels in windowed]
+
+
+def case_sources(index, patient_id, window: str = "brain", count: int = 0) -> list:
+    """Encoder sources for a case: sampled DICOM slices if the patient has a series, else image paths."""
+    series_paths = index.series(patient_id)
+    if series_paths:
+        return DicomSeries(series_paths).sample(count, window)
+    return index.slices(patient_id)
+
+
+def dicom_settings() -> Tuple[str, int]:
+    """(window, slices per case) from DICOM_WINDOW / DICOM_SLICES."""
+    return os.getenv("DICOM_WINDOW", "brain").lower(), int(os.getenv("DICOM_SLICES", "8"))
+
+
+# === SYNTHETIC SERIES FOR LOCAL TESTING ===
+def synthetic_volume(n_slices: int = 24, size: int = 256, seed: int = 0) -> np.ndarray:
+    """Head-like HU phantom: air, skull ring, brain, and a hyperdense bleed."""
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[0:n_slices, 0:size, 0:size].astype(np.float32)
+    zc = (z - (n_slices - 1) / 2) / (n_slices / 2)
+    radius = np.sqrt(((x - size / 2) / (size * 0.40)) ** 2 + ((y - size / 2) / (size * 0.46)) ** 2 + zc ** 2)
+    hu = np.full(z.shape, -1000, dtype=np.float32)
+    hu[radius < 1.0] = 1000  # skull
+    hu[radius < 0.92] = 35  # brain
+    cx, cy = size * (0.35 + 0.3 * rng.random()), size * (0.35 + 0.3 * rng.random())
+    bleed = ((x - cx) ** 2 + (y - cy) ** 2) < (size * 0.08) ** 2
+    hu[bleed & (radius < 0.92) & (np.abs(zc) < 0.4)] = 70
+    hu += rng.normal(0, 4, hu.shape).astype(np.float32)
+    return hu
+
+
+def write_synthetic_series(out_dir: str, patient_id: str = "1", n_slices: int = 24, size: int = 256,
+                           seed: int = 0) -> List[str]:
+    """Write an uncompressed CT series as out_dir/Patient<id>/slice_<n>.dcm and return the paths."""
+    pydicom = _require_pydicom()
+    from pydicom.dataset import FileDataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+    series_dir = os.path.join(out_dir, f"Patient{patient_id}")
+    os.makedirs(series_dir, exist_ok=True)
+    intercept = -1024.0
+    stored = np.clip(synthetic_volume(n_slices, size, seed) - intercept, 0, 4095).astype(np.int16)
+    study_uid, series_uid = generate_uid(), generate_uid()
+
+    paths = []
+    for i, pixels in enumerate(stored):
+        meta = FileMetaDataset()
+        meta.MediaStorageSOPClassUID = CTImageStorage
+        meta.MediaStorageSOPInstanceUID = generate_uid()
+        meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        path = os.path.join(series_dir, f"slice_{i + 1}.dcm")
+        ds = FileDataset(path, {}, file_meta=meta, preamble=b"\0" * 128)
+        ds.SOPClassUID = CTImageStorage
+        ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+        ds.StudyInstanceUID, ds.SeriesInstanceUID = study_uid, series_uid
+        ds.Modality = "CT"
+        ds.PatientID = f"Patient{patient_id}"
+        ds.InstanceNumber = i + 1
+        ds.ImagePositionPatient = [0.0, 0.0, float(i * 5)]
+        ds.SliceThickness = 5.0
+        ds.Rows, ds.Columns = pixels.shape
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = "MONOCHROME2"
+        ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 12, 11
+        ds.PixelRepresentation = 1
+        ds.RescaleIntercept, ds.RescaleSlope = intercept, 1.0
+        ds.WindowCenter, ds.WindowWidth = WINDOWS["brain"]
+        ds.PixelData = pixels.tobytes()
+        ds.save_as(path, enforce_file_format=True)
+        paths.append(path)
+    return paths
+
+
+# === CLI ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DICOM helpers for the prediction scripts.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    synth = sub.add_parser("synth", help="Write synthetic CT series (Patient<id>/slice_<n>.dcm).")
+    synth.add_argument("--out", default="ct_dicom")
+    synth.add_argument("--patients", type=int, default=12)
+    synth.add_argument("--slices", type=int, default=24)
+    synth.add_argument("--size", type=int, default=256)
+    preview = sub.add_parser("preview", help="Render sampled slices of one series to PNG files.")
+    preview.add_argument("series_dir")
+    preview.add_argument("--out", default=".")
+    preview.add_argument("--window", default="brain")
+    preview.add_argument("--slices", type=int, default=8)
+    args = parser.parse_args()
+
+    if args.command == "synth":
+        for patient in range(1, args.patients + 1):
+            write_synthetic_series(args.out, str(patient), args.slices, args.size, seed=patient)
+        print(f"✅ Wrote {args.patients} synthetic series to {args.out}")
+    else:
+        paths = sorted(os.path.join(args.series_dir, name) for name in os.listdir(args.series_dir)
+                       if name.lower().endswith(".dcm"))
+        images = DicomSeries(paths).render(args.slices, args.window)
+        os.makedirs(args.out, exist_ok=True)
+        for i, img in enumerate(images, start=1):
+            img.save(os.path.join(args.out, f"{os.path.basename(args.series_dir.rstrip('/'))}_{i}.png"))
+        print(f"✅ Rendered {len(images)} slice(s) with the {args.window} window to {args.out}")
@@ -0,0 +1,124 @@
+import os
+import io
+import json
+import time
+import threading
+from typing import Dict, List, Optional
+from response_cache import content_hash
+
+# === UPLOAD-ONCE IMAGE HANDLES FOR GEMINI ===
+# Image parts are prepared once per distinct slice (keyed by content hash) and
+# reused across retries, prompt variants and replicate runs.
+#   GEMINI_IMAGE_MODE=inline  send bytes as inline parts, built once per case (default)
+#   GEMINI_IMAGE_MODE=file    upload once via the File API and reference the file URI
+#                             until it expires (the registry is persisted between runs)
+
+FILE_TTL_MARGIN = 15 * 60  # stop reusing a file this many seconds before it expires
+DEFAULT_FILE_TTL = 47 * 3600  # File API keeps uploads for 48h
+
+
+class GeminiFileRegistry:
+    """Content hash -> Gemini image part, with File API uploads tracked until expiry.
+
+    `genai` is anything with google.generativeai's `upload_file`, normally the
+    GeminiProvider, which configures the SDK on the first upload.
+    """
+
+    def __init__(self, genai, mode: str = "inline", path: Optional[str] = None, mime_type: str = "image/jpeg"):
+        if mode not in ("inline", "file"):
+            raise ValueError(f"❌ Unknown GEMINI_IMAGE_MODE '{mode}', expected 'inline' or 'file'")
+        self.genai = genai
+        self.mode = mode
+        self.path = path
+        self.mime_type = mime_type
+        self.uploads = 0
+        self.reused = 0
+        self.uploaded_bytes = 0
+        self._lock = threading.Lock()
+        self._pending: Dict[str, threading.Event] = {}
+        # content hash -> {"name": ..., "uri": ..., "expires_at": epoch seconds}
+        self.files: Dict[str, dict] = {}
+        if mode == "file" and path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.files = json.load(f)
+            self.prune()
+
+    def prune(self) -> int:
+        """Forget handles that expired (or are about to)."""
+        now = time.time()
+        with self._lock:
+            expired = [h for h, entry in self.files.items() if entry["expires_at"] - FILE_TTL_MARGIN <= now]
+            for h in expired:
+                del self.files[h]
+        return len(expired)
+
+    def save(self) -> None:
+        if self.mode != "file" or not self.path:
+            return
+        with self._lock:
+            snapshot = dict(self.files)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def _file_part(self, entry: dict) -> dict:
+        return {"file_data": {"mime_type": self.mime_type, "file_uri": entry["uri"]}}
+
+    def _upload(self, digest: str, data: bytes) -> dict:
+        uploaded = self.genai.upload_file(io.BytesIO(data), mime_type=self.mime_type, display_name=digest[:32])
+        expiration = getattr(uploaded, "expiration_time", None)
+        expires_at = expiration.timestamp() if expiration is not None else time.time() + DEFAULT_FILE_TTL
+        with self._lock:
+            self.uploads += 1
+            self.uploaded_bytes += len(data)
+        return {"name": uploaded.name, "uri": uploaded.uri, "expires_at": expires_at}
+
+    def part(self, data: bytes) -> dict:
+        """Part for one encoded slice, uploading it at most once while its handle is valid."""
+        if self.mode == "inline":
+            return {"mime_type": self.mime_type, "data": data}
+
+        digest = content_hash(data)
+        while True:
+            with self._lock:
+                entry = self.files.get(digest)
+                if entry is not None and entry["expires_at"] - FILE_TTL_MARGIN > time.time():
+                    self.reused += 1
+                    return self._file_part(entry)
+                waiter = self._pending.get(digest)
+                if waiter is None:
+                    # This thread uploads; concurrent requests for the same slice wait for it
+                    self._pending[digest] = threading.Event()
+                    break
+            waiter.wait()
+
+        try:
+            entry = self._upload(digest, data)
+            with self._lock:
+                self.files[digest] = entry
+        finally:
+            with self._lock:
+                self._pending.pop(digest).set()
+        return self._file_part(entry)
+
+    def parts_for(self, images_bytes: List[bytes]) -> List[dict]:
+        """Image parts for a case, prepared once and reused for every retry of the request."""
+        return [self.part(data) for data in images_bytes]
+
+    def summary(self) -> str:
+        if self.mode == "inline":
+            return "📎 Gemini images: sent inline"
+        return (
+            f"📎 Gemini files: {self.uploads} upload(s) ({self.uploaded_bytes / 1024 ** 2:.1f} MB), "
+            f"{self.reused} handle(s) reused"
+        )
+
+
+def open_file_registry(genai) -> GeminiFileRegistry:
+    """Registry configured from GEMINI_IMAGE_MODE / GEMINI_FILE_REGISTRY."""
+    return GeminiFileRegistry(
+        genai,
+        mode=os.getenv("GEMINI_IMAGE_MODE", "inline").lower(),
+        path=os.getenv("GEMINI_FILE_REGISTRY", "gemini_files.json"),
+    )
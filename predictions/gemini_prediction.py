@@ -1,11 +1,23 @@
 import os
-import re
-import time
-import pandas as pd
-from PIL import Image
-from io import BytesIO
-import google.generativeai as genai
+import argparse
 from dotenv import load_dotenv
+from async_dispatch import InFlightTracker, run_dispatch
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources, dicom_settings
+from image_cache import open_image_cache
+from payload_plan import open_payload_planner
+from preprocess import open_preprocess_pipeline
+from providers import GeminiProvider
+from rate_limit import limiter_from_env, rough_request_tokens
+from replicates import REPLICATE_COLUMN, answered, default_replicates_path, replicates_from_env, save_replicates
+from response_cache import open_response_cache
+from gemini_files import open_file_registry
+from structured_output import (
+    STRUCTURED_INSTRUCTIONS, STRUCTURED_MAX_TOKENS, gemini_generation_config, result_columns, structured_enabled
+)
+from result_journal import ResultJournal, default_journal_path, default_results_path
+from sheet_store import read_sheet
+from telemetry import open_telemetry
 
 # === LOAD ENVIRONMENT VARIABLES FROM .env FILE ===
 # Create a .env file in your project root with keys like:
@@ -20,25 +32,35 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 EXCEL_PATH = os.getenv("EXCEL_PATH", "input_data.xlsx")
 IMAGES_FOLDER = os.getenv("IMAGES_FOLDER", "ct_scans")
 OUTPUT_FILE = os.getenv("OUTPUT_FILE", "diagnosis_gemini_results.xlsx")
+GEMINI_CONCURRENCY = int(os.getenv("GEMINI_CONCURRENCY", "1"))  # Cases sent to the API in parallel
+CASE_INDEX_FILE = os.getenv("CASE_INDEX_FILE", "case_index.json")  # Persisted slice index
+DICOM_WINDOW, DICOM_SLICES = dicom_settings()  # Window and slice count for Patient<id>/ DICOM series
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", default_journal_path(OUTPUT_FILE, "gemini"))  # Crash-safe per-case results
+RESULTS_FILE = os.getenv("RESULTS_FILE", default_results_path(OUTPUT_FILE, "gemini"))  # Columnar results table
+TELEMETRY = open_telemetry("gemini", OUTPUT_FILE)  # Per-stage timings, tokens and cost
+IMAGE_CACHE = open_image_cache()  # Encoded slices shared across runs and providers
+RESPONSE_CACHE = open_response_cache()  # Memoized model answers (RESPONSE_CACHE_MODE)
+STRUCTURED_OUTPUT = structured_enabled()  # Ask for compact JSON instead of free text
+REPLICATES = replicates_from_env()  # Answers sampled per case (self-consistency runs)
+REPLICATES_FILE = os.getenv("REPLICATES_FILE", default_replicates_path(OUTPUT_FILE, "gemini"))  # Parsed replicates
 
-# Initialize Gemini API
-genai.configure(api_key=GEMINI_API_KEY)
+# Initialize Gemini API once; the model client is reused for every case
+GEMINI_PROVIDER = GeminiProvider(api_key=GEMINI_API_KEY, model_name="gemini-1.5-pro")
+GEMINI_LIMITER = limiter_from_env("gemini", "GEMINI")  # GEMINI_RPM / GEMINI_TPM
+GEMINI_PAYLOAD = open_payload_planner("gemini", "GEMINI")  # Resolution / montage per request token budget
+GEMINI_FILES = open_file_registry(GEMINI_PROVIDER)  # Inline parts or File API handles, reused across calls
 
 # === FUNCTION TO ENCODE IMAGES (WITH COMPRESSION) ===
 def encode_image(image_path, max_size=(1024, 1024)):
-    """Compress image and return raw bytes for Gemini input."""
-    with Image.open(image_path) as img:
-        img = img.convert("RGB")
-        img.thumbnail(max_size)
-        buffered = BytesIO()
-        img.save(buffered, format="JPEG", quality=85)
-        return buffered.getvalue()
+    """Compress image and return raw bytes for Gemini input (cached on disk)."""
+    return IMAGE_CACHE.get_bytes(image_path, max_size=max_size, quality=85)
 
 # === FUNCTION TO QUERY GEMINI MULTIMODAL MODEL ===
-def ask_gemini(images_bytes, medical_history=None):
-    """Send images and patient history to Gemini for simulated classification."""
-    model = genai.GenerativeModel("gemini-1.5-pro")
+def ask_gemini(images_bytes, medical_history=None, structured=STRUCTURED_OUTPUT, plan=None, samples=1):
+    """Send images and patient history to Gemini for simulated classification.
 
+    With samples > 1 a list of answers comes back, sampled in one request (candidate_count).
+    """
     prompt = (
         "You are simulating a radiology assistant in a research scenario. "
         "Below is a fictional case study involving CT images. "
@@ -58,82 +80,186 @@ def ask_gemini(images_bytes, medical_history=None):
         f"2. Hypothetical classification **with medical history**: {medical_history or 'No history provided.'}"
     )
 
-    # Retry loop to handle transient API issues
-    for attempt in range(3):
+    # Montage payloads tell the model how the slices are tiled
+    if plan is not None:
+        prompt += plan.prompt_note()
+
+    # Structured mode: JSON response schema, far fewer output tokens
+    generation_config = {"temperature": 0.3}
+    if structured:
+        prompt += STRUCTURED_INSTRUCTIONS
+        generation_config = gemini_generation_config(temperature=0.3)
+
+    def request(n=1):
+        # Throttling, backoff on 429/5xx and circuit breaking live in GEMINI_LIMITER
         try:
-            response = model.generate_content(
-                contents=[prompt] + [genai.upload_image(img) for img in images_bytes],
-                generation_config={"temperature": 0.3},
+            # Image parts are prepared (or uploaded) once, outside the retry loop
+            image_parts = GEMINI_FILES.parts_for(images_bytes)
+            config = dict(generation_config, candidate_count=n) if n > 1 else generation_config
+            response = GEMINI_LIMITER.call(
+                lambda: GEMINI_PROVIDER.generate_content(
+                    contents=[prompt] + image_parts,
+                    generation_config=config,
+                ),
+                tokens=rough_request_tokens(
+                    prompt, len(images_bytes), (STRUCTURED_MAX_TOKENS if structured else 2000) * n,
+                    per_image=plan.tokens_per_image if plan else 258
+                ),
             )
-            return response.text
+            usage = getattr(response, "usage_metadata", None)
+            if usage:
+                TELEMETRY.record_usage(GEMINI_PROVIDER.model_name, usage.prompt_token_count,
+                                       usage.candidates_token_count)
+            if n == 1:
+                return [response.text]
+            return ["".join(part.text for part in candidate.content.parts) for candidate in response.candidates]
         except Exception as e:
-            print(f"⚠️ Error during Gemini call (attempt {attempt + 1}/3): {e}")
-            time.sleep(10)
-    return "ERROR"
-
-# === FUNCTION TO EXTRACT LIKERT SCORES ===
-def extract_likert_scores(text):
-    """Extract Likert scale values (1–5) from model response text."""
-    scores = re.findall(r'Likert[^:]*[:\-]?\s*([1-5])', text)
-    if len(scores) == 2:
-        return int(scores[0]), int(scores[1])
-    elif len(scores) == 1:
-        return int(scores[0]), "N/A"
-    return "N/A", "N/A"
+            print(f"⚠️ Error during Gemini call: {e}")
+        return ["ERROR"] * n
 
-# === MAIN FUNCTION ===
-def process_excel_and_images():
-    """Read Excel data, process patient images, query Gemini, and save results."""
-    df = pd.read_excel(EXCEL_PATH)
-    results = []
+    # Identical requests are answered from RESPONSE_CACHE when it is enabled
+    if samples > 1:
+        return RESPONSE_CACHE.memoized_samples(
+            "gemini", GEMINI_PROVIDER.model_name, prompt, images_bytes, request, samples, temperature=0.3,
+            max_tokens=generation_config.get("max_output_tokens")
+        )
+    return RESPONSE_CACHE.memoized(
+        "gemini", GEMINI_PROVIDER.model_name, prompt, images_bytes, lambda: request()[0], temperature=0.3,
+        max_tokens=generation_config.get("max_output_tokens")
+    )
 
-    for idx, row in df.iterrows():
-        patient_id = row["Reihenfolge Bilder"]
-        medical_history = row.get("Anamnese (medical history)", "")
+# === PER-CASE PIPELINE ===
+def process_case(prepared):
+    """Classify the pre-encoded images of a single patient row."""
+    row = prepared["item"]
+    patient_id = row["Reihenfolge Bilder"]
+    medical_history = row.get("Anamnese (medical history)", "")
 
-        print(f"\n🔍 Processing Patient{patient_id}")
+    print(f"\n🔍 Processing Patient{patient_id}")
 
-        # Find matching images (e.g., Patient3_1.jpg, Patient3_2.jpg)
-        image_paths = sorted([
-            os.path.join(IMAGES_FOLDER, f)
-            for f in os.listdir(IMAGES_FOLDER)
-            if f.startswith(f"Patient{patient_id}_") and f.endswith(".jpg")
-        ])
+    # Find matching images (e.g., Patient3_1.jpg, Patient3_2.jpg)
+    image_paths = prepared["paths"]
 
-        if not image_paths:
-            print(f"⚠️ No images found for Patient{patient_id}")
-            continue
+    if not image_paths:
+        print(f"⚠️ No images found for Patient{patient_id}")
+        return None
 
-        print(f"🖼️ Found {len(image_paths)} image(s) for Patient{patient_id}")
+    print(f"🖼️ Found {len(image_paths)} image(s) for Patient{patient_id}")
 
-        if medical_history.strip():
-            print("📄 Medical history provided.")
-        else:
-            print("📄 No medical history.")
+    if medical_history.strip():
+        print("📄 Medical history provided.")
+    else:
+        print("📄 No medical history.")
 
-        encoded_images = [encode_image(p) for p in image_paths]
+    if prepared["error"]:
+        print(f"❌ Image encoding failed for Patient{patient_id}: {prepared['error']}")
+        return None
 
-        g_response = ask_gemini(encoded_images, medical_history)
+    print(prepared["plan"].describe(prepared["images"]))
+    if "dedup" in prepared:
+        print(prepared["dedup"].describe(prepared["images"]))
+    encoded_images = prepared["images"]
 
-        if g_response == "ERROR":
-            continue
+    if REPLICATES > 1:
+        # One payload, REPLICATES sampled answers; the first one fills the usual columns
+        replicates = answered(ask_gemini(encoded_images, medical_history, plan=prepared["plan"], samples=REPLICATES))
+        print(f"🔁 {len(replicates)} of {REPLICATES} replicate(s) answered")
+        g_response = replicates[0] if replicates else "ERROR"
+    else:
+        g_response = ask_gemini(encoded_images, medical_history, plan=prepared["plan"])
 
-        likert_no_hist, likert_with_hist = extract_likert_scores(g_response)
+    if g_response == "ERROR":
+        return None
 
-        results.append({
-            "Patient ID": patient_id,
-            "Combined Gemini Response": g_response,
-            "Likert-Skala ohne Anamnese": likert_no_hist,
-            "Likert-Skala mit Anamnese": likert_with_hist
-        })
+    print(f"✅ Diagnosis completed for Patient{patient_id}")
+
+    record = {
+        "Patient ID": patient_id,
+        "Combined Gemini Response": g_response,
+        **result_columns(g_response, structured=STRUCTURED_OUTPUT)
+    }
+    if REPLICATES > 1:
+        record[REPLICATE_COLUMN] = replicates
+    return record
+
+# === MAIN FUNCTION ===
+def process_excel_and_images(concurrency=GEMINI_CONCURRENCY, resume=False):
+    """Read Excel data, process patient images, query Gemini, and save results."""
+    with TELEMETRY.stage("load_sheet"):
+        df = read_sheet(EXCEL_PATH)
+    rows = [row for _, row in df.iterrows()]
+    journal = ResultJournal(JOURNAL_FILE)
 
-        print(f"✅ Diagnosis completed for Patient{patient_id}")
+    if resume:
+        done = journal.completed_ids()
+        rows = [row for row in rows if normalize_patient_id(row["Reihenfolge Bilder"]) not in done]
+        print(f"⏩ Resuming: {len(df) - len(rows)} patient(s) already in {JOURNAL_FILE}")
+    else:
+        # A fresh run starts an empty journal, so no earlier answer ends up in this run's results
+        previous = journal.rotate()
+        if previous:
+            print(f"🗂️ Previous journal moved to {previous}")
 
-    # Save results to Excel
-    out_df = pd.DataFrame(results)
-    out_df.to_excel(OUTPUT_FILE, index=False)
-    print(f"\n📁 Results saved to: {OUTPUT_FILE}")
+    with TELEMETRY.stage("discovery"):
+        index = load_case_index(IMAGES_FOLDER, CASE_INDEX_FILE)
+
+    # Slices are encoded in worker processes ahead of the API calls, sized by the payload planner
+    pipeline = open_preprocess_pipeline(IMAGE_CACHE, GEMINI_PAYLOAD, telemetry=TELEMETRY, index=index)
+    prepared_cases = pipeline.stream(
+        rows, lambda row: case_sources(index, row["Reihenfolge Bilder"], DICOM_WINDOW, DICOM_SLICES)
+    )
+
+    # Each case is traced (stage timings, tokens, cost) before its result is journaled
+    worker = TELEMETRY.instrument(process_case, lambda prepared: prepared["item"]["Reihenfolge Bilder"])
+
+    # Cases run concurrently; results come back in sheet order
+    tracker = InFlightTracker()
+    results = run_dispatch(
+        prepared_cases, journal.recording(worker), concurrency=concurrency,
+        key=lambda prepared: f"Patient{prepared['item']['Reihenfolge Bilder']}", tracker=tracker
+    )
+    results = [r for r in results if r is not None]
+
+    # Materialize the journal (including resumed cases) in sheet order
+    saved = journal.save_results(RESULTS_FILE, OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"\n📁 Results saved to: {saved}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
+    print(f"📊 {tracker.completed} case(s) processed, peak {tracker.peak} request(s) in flight.")
+    print(IMAGE_CACHE.summary())
+    print(pipeline.timing_summary())
+    print(GEMINI_PROVIDER.connection_summary())
+    print(GEMINI_LIMITER.summary())
+    print(GEMINI_PAYLOAD.summary())
+    print(RESPONSE_CACHE.summary())
+    GEMINI_FILES.save()
+    print(GEMINI_FILES.summary())
+    print(TELEMETRY.summary())
+    TELEMETRY.write_metrics()
+
+# === EXPORT JOURNAL ===
+def export_results():
+    """Write OUTPUT_FILE (Excel) from the result journal without calling the API."""
+    df = read_sheet(EXCEL_PATH, columns=["Reihenfolge Bilder"])
+    journal = ResultJournal(JOURNAL_FILE)
+    count = journal.export_excel(OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+    print(f"📁 Exported {count} journaled result(s) to: {OUTPUT_FILE}")
+    replicates = save_replicates(journal, REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
 
 # === RUN SCRIPT ===
 if __name__ == "__main__":
-    process_excel_and_images()
+    parser = argparse.ArgumentParser(description="Classify CT cases with Gemini.")
+    parser.add_argument("--resume", action="store_true", help="Skip patients already in the result journal.")
+    parser.add_argument("--export", action="store_true", help="Only export the result journal to the Excel OUTPUT_FILE.")
+    parser.add_argument("--replicates", type=int, default=REPLICATES,
+                        help="Answers sampled per case from one payload (default REPLICATES, 1 = off).")
+    args = parser.parse_args()
+    REPLICATES = max(1, args.replicates)
+
+    if args.export:
+        export_results()
+    else:
+        process_excel_and_images(resume=args.resume)
@@ -0,0 +1,310 @@
+import os
+import base64
+import hashlib
+import sqlite3
+import threading
+import math
+import time
+from io import BytesIO
+from typing import Any, Optional, Sequence, Tuple
+from PIL import Image
+
+# === CONTENT-ADDRESSED CACHE FOR ENCODED CT SLICES ===
+# Entries are keyed by the SHA-256 of the source file plus the encoding
+# parameters, so a rerun (or another provider script) gets the compressed
+# bytes back without decoding the slice again. Source hashes are memoized by
+# (path, mtime, size) so unchanged files are not even re-read. A montage entry
+# (tuple of paths) is keyed by the hashes of all its slices, in order; DICOM
+# slices add their frame and window to the file hash.
+
+ENCODER_VERSION = 1
+# A slice path, a rendered source (anything with .path, .cache_tag and .render(),
+# e.g. dicom_series.DicomSlice) or a tuple of those for a montage
+Source = Any
+MIN_QUALITY = 40
+QUALITY_STEP = 10
+_FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp"}
+
+
+def _encode(img: Image.Image, quality: int, format: str, max_bytes: int) -> bytes:
+    """Encode at `quality`, stepping down (to MIN_QUALITY) while the result exceeds `max_bytes`."""
+    while True:
+        buffered = BytesIO()
+        img.save(buffered, format=format, quality=quality)
+        data = buffered.getvalue()
+        if not max_bytes or len(data) <= max_bytes or quality <= MIN_QUALITY:
+            return data
+        quality = max(MIN_QUALITY, quality - QUALITY_STEP)
+
+
+def open_source(source, draft_size: Optional[Tuple[int, int]] = None) -> Image.Image:
+    """PIL image for a slice path, or for a rendered source such as a DICOM slice (see dicom_series)."""
+    if not isinstance(source, str):
+        return source.render()
+    img = Image.open(source)
+    if draft_size:
+        img.draft(img.mode, draft_size)
+    return img
+
+
+def compress_image(image_path, max_size: Tuple[int, int] = (1024, 1024), quality: int = 85,
+                   format: str = "JPEG", draft: bool = False, timings: Optional[dict] = None,
+                   grayscale: bool = False, max_bytes: int = 0) -> bytes:
+    """Reference encoder shared by all providers: RGB, thumbnail to `max_size`, re-encode.
+
+    With `draft=True` JPEG sources are decoded at a reduced DCT scale close to
+    `max_size` instead of full resolution (output then differs slightly).
+    `grayscale=True` keeps a single channel ("L") instead of expanding to RGB, and
+    `max_bytes` lowers the quality until the encoded slice fits.
+    If `timings` is given, decode/resize/encode milliseconds are stored in it.
+    """
+    start = time.perf_counter()
+    with open_source(image_path, max_size if draft else None) as img:
+        img.load()
+        img = img.convert("L" if grayscale else "RGB")
+        decoded = time.perf_counter()
+        img.thumbnail(max_size)
+        resized = time.perf_counter()
+        data = _encode(img, quality, format, max_bytes)
+    if timings is not None:
+        timings["decode_ms"] = (decoded - start) * 1000
+        timings["resize_ms"] = (resized - decoded) * 1000
+        timings["encode_ms"] = (time.perf_counter() - resized) * 1000
+    return data
+
+
+def montage_grid(n: int) -> Tuple[int, int]:
+    """(columns, rows) of the near-square grid used to tile `n` slices."""
+    cols = math.ceil(math.sqrt(n))
+    return cols, math.ceil(n / cols)
+
+
+def compress_montage(image_paths: Sequence, max_size: Tuple[int, int] = (1024, 1024), quality: int = 85,
+                     format: str = "JPEG", draft: bool = False, timings: Optional[dict] = None,
+                     grayscale: bool = False, max_bytes: int = 0) -> bytes:
+    """Tile several slices left-to-right, top-to-bottom into one image fitting `max_size`."""
+    start = time.perf_counter()
+    cols, rows = montage_grid(len(image_paths))
+    tile = (max_size[0] // cols, max_size[1] // rows)
+    mode = "L" if grayscale else "RGB"
+    canvas = Image.new(mode, (tile[0] * cols, tile[1] * rows))
+    decode_s = 0.0
+    for i, path in enumerate(image_paths):
+        t0 = time.perf_counter()
+        with open_source(path, tile if draft else None) as img:
+            img.load()
+            img = img.convert(mode)
+        decode_s += time.perf_counter() - t0
+        img.thumbnail(tile)
+        col, row = i % cols, i // cols
+        # Center each slice in its cell
+        canvas.paste(img, (col * tile[0] + (tile[0] - img.width) // 2, row * tile[1] + (tile[1] - img.height) // 2))
+    resized = time.perf_counter()
+    data = _encode(canvas, quality, format, max_bytes)
+    if timings is not None:
+        timings["decode_ms"] = decode_s * 1000
+        timings["resize_ms"] = (resized - start - decode_s) * 1000
+        timings["encode_ms"] = (time.perf_counter() - resized) * 1000
+    return data
+
+
+def encode_source(source, max_size: Tuple[int, int] = (1024, 1024), quality: int = 85,
+                  format: str = "JPEG", draft: bool = False, timings: Optional[dict] = None,
+                  grayscale: bool = False, max_bytes: int = 0) -> bytes:
+    """Encode one slice (a path or DICOM slice) or a montage of several slices (a tuple of them)."""
+    encoder = compress_montage if isinstance(source, tuple) else compress_image
+    return encoder(source, max_size, quality, format, draft, timings, grayscale=grayscale, max_bytes=max_bytes)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageCache:
+    """Size-bounded LRU cache of encoded slices on disk, with hit/miss counters.
+
+    With `cache_dir=None` the cache is disabled and every call encodes directly.
+    The directory and its index are created on the first lookup or store, so
+    constructing the cache (e.g. when a prediction script is imported) touches
+    no files.
+    """
+
+    def __init__(self, cache_dir: Optional[str], max_bytes: int = 2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._open_lock = threading.Lock()
+        self._conn = None
+        self._total_bytes = 0
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self._open_lock:
+                if self._conn is None:
+                    self._conn = self._open_index()
+        return self._conn
+
+    def _open_index(self) -> sqlite3.Connection:
+        os.makedirs(self.cache_dir, exist_ok=True)
+        db = sqlite3.connect(os.path.join(self.cache_dir, "index.sqlite"), check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)")
+        db.execute("CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT)")
+        db.commit()
+        self._total_bytes = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        return db
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.cache_dir)
+
+    # --- keys ---
+    def source_hash(self, path: str) -> str:
+        """SHA-256 of the source file, memoized by (path, mtime, size)."""
+        st = os.stat(path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM sources WHERE path = ? AND mtime = ? AND size = ?",
+                (path, st.st_mtime, st.st_size),
+            ).fetchone()
+        if row:
+            return row[0]
+        sha = file_sha256(path)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (path, st.st_mtime, st.st_size, sha)
+            )
+            self._db.commit()
+        return sha
+
+    def _source_digest(self, source) -> str:
+        if isinstance(source, str):
+            return self.source_hash(source)
+        return f"{self.source_hash(source.path)}:{source.cache_tag}"
+
+    def entry_key(self, source: Source, max_size: Tuple[int, int], quality: int, format: str,
+                  draft: bool = False, grayscale: bool = False, max_bytes: int = 0) -> str:
+        if isinstance(source, tuple):
+            digest = "montage:" + "+".join(self._source_digest(part) for part in source)
+        else:
+            digest = self._source_digest(source)
+        params = f"{digest}|{max_size[0]}x{max_size[1]}|q{quality}|{format}|v{ENCODER_VERSION}"
+        if draft:
+            params += "|draft"
+        if grayscale:
+            params += "|gray"
+        if max_bytes:
+            params += f"|max{max_bytes}"
+        return hashlib.sha256(params.encode()).hexdigest()
+
+    def _blob_path(self, key: str, format: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + _FORMAT_EXTENSIONS.get(format, ".bin"))
+
+    # --- lookups ---
+    def lookup(self, path: Source, max_size: Tuple[int, int] = (1024, 1024), quality: int = 85,
+               format: str = "JPEG", draft: bool = False, grayscale: bool = False,
+               max_bytes: int = 0) -> Optional[bytes]:
+        """Cached bytes for `path` (or a montage of paths) or None (counted as a hit only when found)."""
+        if not self.enabled:
+            return None
+        key = self.entry_key(path, max_size, quality, format, draft, grayscale, max_bytes)
+        try:
+            with open(self._blob_path(key, format), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.hits += 1
+            self._db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._db.commit()
+        return data
+
+    def put(self, path: Source, data: bytes, max_size: Tuple[int, int] = (1024, 1024),
+            quality: int = 85, format: str = "JPEG", draft: bool = False, grayscale: bool = False,
+            max_bytes: int = 0) -> None:
+        """Record freshly encoded bytes for `path` (counted as a miss)."""
+        if not self.enabled:
+            with self._lock:
+                self.misses += 1
+            return
+        key = self.entry_key(path, max_size, quality, format, draft, grayscale, max_bytes)
+        self._store(key, self._blob_path(key, format), data)
+
+    def get_bytes(self, path: Source, max_size: Tuple[int, int] = (1024, 1024),
+                  quality: int = 85, format: str = "JPEG", draft: bool = False, grayscale: bool = False,
+                  max_bytes: int = 0) -> bytes:
+        """Compressed bytes for `path` (or a montage of paths), from the cache when possible."""
+        data = self.lookup(path, max_size, quality, format, draft, grayscale, max_bytes)
+        if data is None:
+            data = encode_source(path, max_size, quality, format, draft, grayscale=grayscale, max_bytes=max_bytes)
+            self.put(path, data, max_size, quality, format, draft, grayscale, max_bytes)
+        return data
+
+    def get_base64(self, path: Source, max_size: Tuple[int, int] = (1024, 1024),
+                   quality: int = 85, format: str = "JPEG", draft: bool = False, grayscale: bool = False,
+                   max_bytes: int = 0) -> str:
+        data = self.get_bytes(path, max_size, quality, format, draft, grayscale, max_bytes)
+        return base64.b64encode(data).decode("utf-8")
+
+    def _store(self, key: str, blob_path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = f"{blob_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, blob_path)
+
+        with self._lock:
+            self.misses += 1
+            previous = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            self._total_bytes += len(data) - (previous[0] if previous else 0)
+            self._db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, len(data), time.time()))
+            self._evict_locked()
+            self._db.commit()
+
+    def _evict_locked(self) -> None:
+        """Drop least recently used entries until the cache fits `max_bytes`."""
+        if self._total_bytes <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if self._total_bytes <= self.max_bytes:
+                break
+            for ext in _FORMAT_EXTENSIONS.values():
+                try:
+                    os.remove(os.path.join(self.cache_dir, key[:2], key + ext))
+                except FileNotFoundError:
+                    pass
+            self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "bytes": self._total_bytes,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"🗃️ Image cache: {s['hits']} hit(s), {s['misses']} miss(es) "
+            f"({s['hit_rate']:.0%} hit rate), {s['evictions']} eviction(s), {s['bytes'] / 1024 ** 2:.1f} MB stored"
+        )
+
+
+def open_image_cache() -> ImageCache:
+    """Cache configured from IMAGE_CACHE_DIR / IMAGE_CACHE_MAX_MB (empty dir disables it)."""
+    cache_dir = os.getenv("IMAGE_CACHE_DIR", ".image_cache")
+    max_mb = float(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+    return ImageCache(cache_dir or None, max_bytes=int(max_mb * 1024 ** 2))
@@ -0,0 +1,412 @@
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from contextlib import contextmanager
+from email.parser import BytesParser
+from email.policy import default as email_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# === LOCAL OPENAI / xAI / GEMINI-COMPATIBLE STUB SERVER ===
+# Lets the prediction scripts run end-to-end without an API key, e.g.:
+#   python predictions/mock_llm_server.py --port 8765 --latency 0.5
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 GPT_CONCURRENCY=8 python predictions/GPT4o_prediction.py
+#   XAI_API_URL=http://127.0.0.1:8765/v1/chat/completions python predictions/Grok_prediction.py
+#   GEMINI_API_ENDPOINT=http://127.0.0.1:8765 python predictions/gemini_prediction.py
+# --rpm / --rate-429 make it answer 429 with Retry-After to exercise the rate limiter,
+# --error-rate answers a fraction of requests with 500 to exercise retries, and
+# --vary draws a fraction of answers at random (categories and Likert scores) so
+# replicate runs (`n` / `candidateCount`) have something to disagree about.
+# /v1/files and /v1/batches stand in for the Batch API (batch_mode.py): a batch
+# answers its request lines when it is created, reports "in_progress" for
+# --batch-seconds and then "completed"; --error-rate also fails batch lines.
+
+CANNED_RESPONSE = (
+    "1. Hypothetical classification without medical history:\n"
+    "- Category: 2+3\n"
+    "- Reasoning: Hyperdense intraparenchymal lesion with surrounding contusion.\n"
+    "- Likert confidence: 3\n\n"
+    "2. Hypothetical classification with medical history:\n"
+    "- Category: 3\n"
+    "- Reasoning: History of fall supports a contusional origin.\n"
+    "- Likert confidence: 4\n"
+)
+
+# Returned instead when the request asks for JSON (STRUCTURED_OUTPUT=1)
+STRUCTURED_RESPONSE = json.dumps({
+    "without_history": {"categories": [2, 3], "likert": 3, "reasoning": "Intraparenchymal lesion with contusion."},
+    "with_history": {"categories": [3], "likert": 4, "reasoning": "Fall supports a contusional origin."},
+})
+
+
+def mock_answer(structured: bool, vary: float = 0.0) -> str:
+    """The canned answer, or with probability `vary` one with random categories and Likert scores."""
+    if not vary or random.random() >= vary:
+        return STRUCTURED_RESPONSE if structured else CANNED_RESPONSE
+    picks = [(sorted(random.sample(range(1, 6), random.choice((1, 1, 2)))), random.randint(1, 5)) for _ in range(2)]
+    if structured:
+        return json.dumps({
+            key: {"categories": categories, "likert": likert, "reasoning": "Randomized mock answer."}
+            for key, (categories, likert) in zip(("without_history", "with_history"), picks)
+        })
+    return "".join(
+        f"{i}. Hypothetical classification {condition} medical history:\n"
+        f"- Category: {'+'.join(map(str, categories))}\n"
+        f"- Reasoning: Randomized mock answer.\n"
+        f"- Likert confidence: {likert}\n\n"
+        for i, (condition, (categories, likert)) in enumerate(zip(("without", "with"), picks), start=1)
+    )
+
+
+class MockState:
+    """Counters shared between handler threads."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, rpm: int = 0, rate_429: float = 0.0,
+                 retry_after: float = 1.0, error_rate: float = 0.0, vary: float = 0.0, batch_seconds: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rpm = rpm
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.vary = vary
+        self.batches = MockBatches(self, batch_seconds)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.window = deque()
+
+    def admit(self):
+        """Return (allowed, headers) under the simulated per-minute limit and random 429s."""
+        with self.lock:
+            now = time.monotonic()
+            while self.window and now - self.window[0] >= 60:
+                self.window.popleft()
+            if self.rpm and len(self.window) >= self.rpm:
+                self.rejected += 1
+                wait = 60 - (now - self.window[0])
+                return False, {"Retry-After": f"{wait:.2f}", "x-ratelimit-remaining-requests": "0",
+                               "x-ratelimit-reset-requests": f"{wait:.2f}s"}
+            if self.rate_429 and random.random() < self.rate_429:
+                self.rejected += 1
+                return False, {"Retry-After": f"{self.retry_after:.2f}"}
+            self.window.append(now)
+            headers = {}
+            if self.rpm:
+                headers = {"x-ratelimit-limit-requests": str(self.rpm),
+                           "x-ratelimit-remaining-requests": str(self.rpm - len(self.window)),
+                           "x-ratelimit-reset-requests": f"{60 - (now - self.window[0]):.2f}s"}
+            return True, headers
+
+    def fail(self) -> bool:
+        """Whether this request gets a simulated server error."""
+        if not self.error_rate or random.random() >= self.error_rate:
+            return False
+        with self.lock:
+            self.errors += 1
+        return True
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {"requests": self.requests, "rejected": self.rejected, "errors": self.errors,
+                    "peak_in_flight": self.peak_in_flight}
+
+    def enter(self) -> None:
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self) -> None:
+        with self.lock:
+            self.in_flight -= 1
+
+
+class MockBatches:
+    """In-memory Files and Batches API: uploaded JSONL files, batches and their output files."""
+
+    def __init__(self, state: "MockState", batch_seconds: float = 0.0):
+        self.state = state
+        self.batch_seconds = batch_seconds
+        self.lock = threading.Lock()
+        self.files = {}
+        self.batches = {}
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}-mock-{random.getrandbits(48):012x}"
+
+    def add_file(self, data: bytes, filename: str, purpose: str) -> str:
+        file_id = self._new_id("file")
+        with self.lock:
+            self.files[file_id] = {"data": data, "filename": filename, "purpose": purpose, "created": int(time.time())}
+        return file_id
+
+    def file_object(self, file_id: str) -> dict:
+        entry = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(entry["data"]), "created_at": entry["created"],
+                "filename": entry["filename"], "purpose": entry["purpose"], "status": "processed"}
+
+    def upload(self, content_type: str, raw: bytes) -> dict:
+        """multipart/form-data upload with `file` and `purpose` fields."""
+        message = BytesParser(policy=email_policy).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + raw)
+        fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+        upload = fields["file"]
+        purpose = fields["purpose"].get_content().strip() if "purpose" in fields else "batch"
+        return self.file_object(self.add_file(upload.get_payload(decode=True), upload.get_filename(), purpose))
+
+    def _answer(self, batch_id: str, line: dict):
+        """(output line, None) or (None, error line) for one batch request line."""
+        entry = {"id": f"batch_req_{random.getrandbits(32):08x}", "custom_id": line.get("custom_id")}
+        if not line.get("url", "").endswith("/chat/completions"):
+            return None, dict(entry, response=None,
+                              error={"code": "invalid_url", "message": f"Unsupported url {line.get('url')}"})
+        if self.state.fail():
+            body = openai_error(500, "Internal error (mock)")
+            return None, dict(entry, response={"status_code": 500, "request_id": batch_id, "body": body}, error=None)
+        body = chat_completion(line.get("body") or {}, self.state.vary)
+        return dict(entry, response={"status_code": 200, "request_id": batch_id, "body": body}, error=None), None
+
+    def create(self, payload: dict) -> dict:
+        batch_id = self._new_id("batch")
+        lines = [json.loads(line) for line in self.files[payload["input_file_id"]]["data"].splitlines() if line.strip()]
+        outputs, errors = [], []
+        for line in lines:
+            output, error = self._answer(batch_id, line)
+            if output:
+                outputs.append(output)
+            else:
+                errors.append(error)
+        to_file = lambda entries, kind: self.add_file(
+            "".join(json.dumps(entry) + "\n" for entry in entries).encode(), f"{batch_id}_{kind}.jsonl", "batch_output"
+        ) if entries else None
+        batch = {"payload": payload, "created": time.time(), "total": len(lines), "failed": len(errors),
+                 "output_file_id": to_file(outputs, "output"), "error_file_id": to_file(errors, "error"),
+                 "cancelled": False}
+        with self.lock:
+            self.batches[batch_id] = batch
+        return self.batch_object(batch_id)
+
+    def cancel(self, batch_id: str) -> dict:
+        with self.lock:
+            self.batches[batch_id]["cancelled"] = True
+        return self.batch_object(batch_id)
+
+    def batch_object(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        elapsed = time.time() - batch["created"]
+        done = batch["cancelled"] or elapsed >= self.batch_seconds
+        status = ("cancelled" if batch["cancelled"] else "completed") if done else "in_progress"
+        progress = 1.0 if done else elapsed / self.batch_seconds
+        answered = int((batch["total"] - batch["failed"]) * progress)
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": batch["payload"].get("endpoint"),
+            "errors": None,
+            "input_file_id": batch["payload"]["input_file_id"],
+            "completion_window": batch["payload"].get("completion_window", "24h"),
+            "status": status,
+            "output_file_id": batch["output_file_id"] if done else None,
+            "error_file_id": batch["error_file_id"] if done else None,
+            "created_at": int(batch["created"]),
+            "completed_at": int(batch["created"] + self.batch_seconds) if status == "completed" else None,
+            "request_counts": {"total": batch["total"], "completed": answered,
+                               "failed": batch["failed"] if done else int(batch["failed"] * progress)},
+            "metadata": batch["payload"].get("metadata"),
+        }
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state: MockState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, body: dict, headers: dict = None) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_bytes(self, data: bytes, content_type: str = "application/octet-stream") -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        batches = self.state.batches
+        content = _FILE_CONTENT_PATH.search(path)
+        found = _OBJECT_PATH.search(path)
+        if content and content.group(1) in batches.files:
+            self._send_bytes(batches.files[content.group(1)]["data"], "application/jsonl")
+        elif found and found.group(1) == "files" and found.group(2) in batches.files:
+            self._send_json(200, batches.file_object(found.group(2)))
+        elif found and found.group(1) == "batches" and found.group(2) in batches.batches:
+            self._send_json(200, batches.batch_object(found.group(2)))
+        else:
+            self._send_json(404, openai_error(404, f"Unknown path {self.path}"))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length)
+
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/files"):
+            self._send_json(200, self.state.batches.upload(self.headers.get("Content-Type", ""), raw))
+            return
+        if path.endswith("/batches"):
+            self._send_json(200, self.state.batches.create(json.loads(raw or b"{}")))
+            return
+        cancel = _CANCEL_PATH.search(path)
+        if cancel and cancel.group(1) in self.state.batches.batches:
+            self._send_json(200, self.state.batches.cancel(cancel.group(1)))
+            return
+
+        payload = json.loads(raw or b"{}")
+        gemini = _GEMINI_PATH.search(path)
+        if gemini:
+            build, error = (lambda body: gemini_generate_content(body, gemini.group(1), self.state.vary)), gemini_error
+        elif path.endswith("/chat/completions"):
+            build, error = (lambda body: chat_completion(body, self.state.vary)), openai_error
+        else:
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        allowed, headers = self.state.admit()
+        if not allowed:
+            self._send_json(429, error(429, "Rate limit reached (mock)"), headers)
+            return
+
+        self.state.enter()
+        try:
+            time.sleep(self.state.latency + random.uniform(0, self.state.jitter))
+            if self.state.fail():
+                self._send_json(500, error(500, "Internal error (mock)"))
+            else:
+                self._send_json(200, build(payload), headers)
+        finally:
+            self.state.leave()
+
+
+_GEMINI_PATH = re.compile(r"/models/([^/:]+):generateContent$")
+_FILE_CONTENT_PATH = re.compile(r"/files/([^/]+)/content$")
+_OBJECT_PATH = re.compile(r"/(files|batches)/([^/]+)$")
+_CANCEL_PATH = re.compile(r"/batches/([^/]+)/cancel$")
+_GEMINI_STATUS = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL"}
+
+
+def openai_error(status: int, message: str) -> dict:
+    return {"error": {"message": message, "type": "rate_limit_error" if status == 429 else "server_error"}}
+
+
+def gemini_error(status: int, message: str) -> dict:
+    return {"error": {"code": status, "message": message, "status": _GEMINI_STATUS.get(status, "UNKNOWN")}}
+
+
+def chat_completion(payload: dict, vary: float = 0.0) -> dict:
+    """Build an OpenAI chat.completion object around the canned answer (`n` choices)."""
+    structured = bool(payload.get("response_format"))
+    n = max(1, int(payload.get("n") or 1))
+    return {
+        "id": f"chatcmpl-mock-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": payload.get("model", "mock"),
+        "choices": [
+            {
+                "index": i,
+                "message": {"role": "assistant", "content": mock_answer(structured, vary)},
+                "finish_reason": "stop",
+            }
+            for i in range(n)
+        ],
+        "usage": {"prompt_tokens": 1000, "completion_tokens": 120 * n, "total_tokens": 1000 + 120 * n},
+    }
+
+
+def gemini_generate_content(payload: dict, model: str, vary: float = 0.0) -> dict:
+    """Build a Gemini generateContent response (REST transport) around the canned answer (`candidateCount`)."""
+    config = payload.get("generationConfig") or {}
+    structured = config.get("responseMimeType") == "application/json"
+    n = max(1, int(config.get("candidateCount") or 1))
+    return {
+        "candidates": [
+            {
+                "content": {"parts": [{"text": mock_answer(structured, vary)}], "role": "model"},
+                "finishReason": "STOP",
+                "index": i,
+            }
+            for i in range(n)
+        ],
+        "usageMetadata": {"promptTokenCount": 1000, "candidatesTokenCount": 120 * n, "totalTokenCount": 1000 + 120 * n},
+        "modelVersion": model,
+    }
+
+
+def start_server(host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 rpm: int = 0, rate_429: float = 0.0, retry_after: float = 1.0, error_rate: float = 0.0,
+                 vary: float = 0.0, batch_seconds: float = 0.0):
+    """Start the stub in a daemon thread and return the server (see `server.state`)."""
+    state = MockState(latency=latency, jitter=jitter, rpm=rpm, rate_429=rate_429, retry_after=retry_after,
+                      error_rate=error_rate, vary=vary, batch_seconds=batch_seconds)
+    handler = type("BoundMockHandler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@contextmanager
+def running(**kwargs):
+    """Context manager yielding the base URL (".../v1") of a temporary stub server.
+
+    Gemini's endpoint is the same URL without the "/v1" suffix.
+    """
+    server = start_server(**kwargs)
+    host, port = server.server_address[:2]
+    try:
+        yield f"http://{host}:{port}/v1", server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# === RUN SERVER ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local OpenAI/xAI/Gemini-compatible stub for the prediction scripts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="Seconds added to every response.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Extra random latency (seconds).")
+    parser.add_argument("--rpm", type=int, default=0, help="Answer 429 above this many requests per minute.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="Fraction of requests answered with 429.")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After sent with random 429s.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 500.")
+    parser.add_argument("--vary", type=float, default=0.0, help="Fraction of answers drawn at random.")
+    parser.add_argument("--batch-seconds", type=float, default=0.0, help="Seconds a batch stays in progress.")
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.latency, args.jitter, args.rpm, args.rate_429, args.retry_after,
+                          args.error_rate, args.vary, args.batch_seconds)
+    print(f"🧪 Mock LLM server listening on http://{args.host}:{args.port}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,262 @@
+import os
+import asyncio
+import argparse
+import importlib
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Sequence
+from dotenv import load_dotenv
+from async_dispatch import InFlightTracker, run_dispatch
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources, dicom_settings
+from image_cache import open_image_cache
+from preprocess import open_shared_preprocess_pipeline
+from replicates import save_replicates
+from result_journal import ResultJournal
+from sheet_store import columnar_available, read_sheet, write_table
+from response_parser import RESULT_COLUMNS, parse_responses
+from telemetry import open_telemetry
+
+# === SINGLE-PASS MULTI-PROVIDER RUN ===
+# Reads the sheet once, indexes IMAGES_FOLDER once and encodes every slice once,
+# then sends each case to all selected providers at the same time. The provider
+# scripts are imported as modules, so prompts, limiters, response caches,
+# journals (and therefore --resume) and telemetry are exactly those of the
+# single-provider runs. At the end the journals are merged into one wide rater
+# table: the input sheet plus "<rater>-with(out)-medical history" category
+# columns and "<rater>_With" / "<rater>_Without" Likert columns, which the
+# kappa and Likert plots read directly.
+
+# Provider name -> script module and the module attributes the runner uses
+PROVIDER_SCRIPTS = {
+    "gpt4o": {
+        "module": "GPT4o_prediction", "client": "GPT_PROVIDER", "limiter": "GPT_LIMITER",
+        "payload": "GPT_PAYLOAD", "concurrency": "GPT_CONCURRENCY", "response": "Combined GPT Response",
+        "rater": lambda module: "GPT-4o",
+    },
+    "gemini": {
+        "module": "gemini_prediction", "client": "GEMINI_PROVIDER", "limiter": "GEMINI_LIMITER",
+        "payload": "GEMINI_PAYLOAD", "concurrency": "GEMINI_CONCURRENCY", "response": "Combined Gemini Response",
+        "rater": lambda module: module.GEMINI_PROVIDER.model_name,
+    },
+    "grok": {
+        "module": "Grok_prediction", "client": "XAI_PROVIDER", "limiter": "XAI_LIMITER",
+        "payload": "XAI_PAYLOAD", "concurrency": "GROK_CONCURRENCY", "response": "Grok Response",
+        "rater": lambda module: "grok-4-fast-reasoning",
+    },
+}
+
+WITHOUT_SUFFIX = "-without-medical history"
+WITH_SUFFIX = "-with-medical history"
+
+# === LOAD ENVIRONMENT VARIABLES FROM .env FILE ===
+load_dotenv()
+
+# === CONFIGURATION ===
+EXCEL_PATH = os.getenv("EXCEL_PATH", "input_data.xlsx")
+IMAGES_FOLDER = os.getenv("IMAGES_FOLDER", "ct_scans")
+OUTPUT_FILE = os.getenv("OUTPUT_FILE", "diagnosis_results.xlsx")
+PROVIDERS = [name.strip() for name in os.getenv("PROVIDERS", ",".join(PROVIDER_SCRIPTS)).split(",") if name.strip()]
+MULTI_CONCURRENCY = int(os.getenv("MULTI_CONCURRENCY", "0"))  # Cases in flight (0 = largest provider setting)
+MERGED_FILE = os.getenv("MERGED_FILE", f"{os.path.splitext(OUTPUT_FILE)[0]}.merged.parquet")  # Wide rater table
+CASE_INDEX_FILE = os.getenv("CASE_INDEX_FILE", "case_index.json")  # Persisted slice index
+DICOM_WINDOW, DICOM_SLICES = dicom_settings()  # Window and slice count for Patient<id>/ DICOM series
+TELEMETRY = open_telemetry("multi", OUTPUT_FILE)  # Shared stages: sheet, discovery, decode, encode
+IMAGE_CACHE = open_image_cache()  # Encoded slices shared across runs and providers
+
+
+# === PROVIDER MODULES ===
+def load_providers(names: Sequence[str]) -> Dict[str, object]:
+    """Import the script module of each selected provider (this builds its client, limiter, caches)."""
+    unknown = [name for name in names if name not in PROVIDER_SCRIPTS]
+    if unknown:
+        raise ValueError(f"❌ Unknown provider(s) {unknown}, expected some of {sorted(PROVIDER_SCRIPTS)}")
+    return {name: importlib.import_module(PROVIDER_SCRIPTS[name]["module"]) for name in names}
+
+
+def rater_names(modules: Dict[str, object]) -> Dict[str, str]:
+    """Column prefix per provider, e.g. "GPT-4o" -> "GPT-4o-with-medical history"."""
+    return {name: PROVIDER_SCRIPTS[name]["rater"](module) for name, module in modules.items()}
+
+
+# === MERGED RATER TABLE ===
+def rater_columns(frame: pd.DataFrame, response_column: str) -> pd.DataFrame:
+    """Categories and Likert scores (without, with history) from one provider's result records.
+
+    Values stored in the journal are kept; where they are missing ("N/A", or journals
+    from runs that did not store categories) the response text is re-parsed.
+    """
+    text = frame[response_column] if response_column in frame else pd.Series("", index=frame.index)
+    columns = parse_responses(text).astype(object)
+    for col in RESULT_COLUMNS:
+        if col in frame:
+            stored = frame[col].where(frame[col] != "N/A")
+            columns[col] = stored.where(stored.notna(), columns[col])
+    for col in RESULT_COLUMNS[:2]:
+        columns[col] = columns[col].map(lambda value: value if pd.isna(value) else str(value))
+    for col in RESULT_COLUMNS[2:]:
+        columns[col] = pd.to_numeric(columns[col], errors="coerce")
+    return columns
+
+
+def merged_table(sheet: pd.DataFrame, results: Dict[str, pd.DataFrame], raters: Dict[str, str],
+                 id_column: str = "Reihenfolge Bilder") -> pd.DataFrame:
+    """The input sheet plus one category and one Likert column per provider and condition."""
+    merged = sheet.copy()
+    ids = sheet[id_column].map(normalize_patient_id)
+    for name, frame in results.items():
+        rater = raters[name]
+        if frame.empty:
+            values = pd.DataFrame(index=pd.Index([], dtype=object), columns=list(RESULT_COLUMNS))
+        else:
+            frame = frame.assign(_id=frame["Patient ID"].map(normalize_patient_id)).drop_duplicates("_id", keep="last")
+            values = rater_columns(frame.set_index("_id"), PROVIDER_SCRIPTS[name]["response"])
+        merged[f"{rater}{WITHOUT_SUFFIX}"] = ids.map(values["Kategorien ohne Anamnese"]).to_numpy()
+        merged[f"{rater}{WITH_SUFFIX}"] = ids.map(values["Kategorien mit Anamnese"]).to_numpy()
+        merged[f"{rater}_Without"] = ids.map(values["Likert-Skala ohne Anamnese"]).to_numpy()
+        merged[f"{rater}_With"] = ids.map(values["Likert-Skala mit Anamnese"]).to_numpy()
+    return merged
+
+
+def save_merged(merged: pd.DataFrame, path: str = MERGED_FILE) -> str:
+    """Write the merged table as Parquet (Excel for an .xlsx MERGED_FILE or when pyarrow is missing)."""
+    if path.lower().endswith(".parquet") and columnar_available():
+        write_table(merged, path, {"source": os.path.abspath(EXCEL_PATH)})
+        return path
+    if path.lower().endswith(".parquet"):
+        path = os.path.splitext(path)[0] + ".xlsx"
+    merged.to_excel(path, index=False)
+    return path
+
+
+def merge_journals(sheet: pd.DataFrame, modules: Dict[str, object]) -> str:
+    """Merge the providers' journals into MERGED_FILE; returns the path written."""
+    order = sheet["Reihenfolge Bilder"]
+    results = {name: ResultJournal(module.JOURNAL_FILE).to_frame(order) for name, module in modules.items()}
+    merged = merged_table(sheet, results, rater_names(modules))
+    for rater in rater_names(modules).values():
+        missing = int(merged[f"{rater}{WITHOUT_SUFFIX}"].isna().sum() + merged[f"{rater}{WITH_SUFFIX}"].isna().sum())
+        if missing:
+            print(f"⚠️ {rater}: {missing} category cell(s) empty (no answer or no category found)")
+    return save_merged(merged)
+
+
+# === MAIN FUNCTION ===
+def process_all_providers(names: Sequence[str] = PROVIDERS, concurrency: int = MULTI_CONCURRENCY,
+                          resume: bool = False):
+    """Encode each case once, query all providers concurrently, then write the merged table."""
+    modules = load_providers(names)
+    with TELEMETRY.stage("load_sheet"):
+        df = read_sheet(EXCEL_PATH)
+    rows = [row for _, row in df.iterrows()]
+    journals = {name: ResultJournal(module.JOURNAL_FILE) for name, module in modules.items()}
+
+    # A provider skips the cases already in its journal; cases every provider has are not even encoded
+    done = {name: journal.completed_ids() if resume else set() for name, journal in journals.items()}
+    if resume:
+        rows = [row for row in rows if any(normalize_patient_id(row["Reihenfolge Bilder"]) not in ids
+                                           for ids in done.values())]
+        print(f"⏩ Resuming: {len(df) - len(rows)} patient(s) already answered by every provider")
+    else:
+        # A fresh run starts empty journals, so no earlier answer ends up in this run's results
+        for journal in journals.values():
+            previous = journal.rotate()
+            if previous:
+                print(f"🗂️ Previous journal moved to {previous}")
+
+    with TELEMETRY.stage("discovery"):
+        index = load_case_index(IMAGES_FOLDER, CASE_INDEX_FILE)
+
+    # One preprocessing pass; each provider's planner still picks its own payload
+    planners = {name: getattr(module, PROVIDER_SCRIPTS[name]["payload"]) for name, module in modules.items()}
+    pipeline = open_shared_preprocess_pipeline(IMAGE_CACHE, planners, telemetry=TELEMETRY, index=index)
+    prepared_cases = pipeline.stream(
+        rows, lambda row: case_sources(index, row["Reihenfolge Bilder"], DICOM_WINDOW, DICOM_SLICES)
+    )
+
+    # Each provider's process_case is traced and journaled exactly as in its own script
+    workers = {
+        name: journals[name].recording(module.TELEMETRY.instrument(
+            module.process_case, lambda prepared: prepared["item"]["Reihenfolge Bilder"]))
+        for name, module in modules.items()
+    }
+    # Every provider keeps at most its own *_CONCURRENCY requests in flight, so a slow
+    # or tightly limited provider does not get the parallelism of the fastest one
+    limits = {name: max(1, getattr(module, PROVIDER_SCRIPTS[name]["concurrency"])) for name, module in modules.items()}
+    concurrency = concurrency or max(limits.values())
+    executor = ThreadPoolExecutor(max_workers=sum(limits.values()), thread_name_prefix="provider")
+    slots: Dict[str, asyncio.Semaphore] = {}  # created inside the dispatch event loop
+    print("🚦 Requests in flight per provider: " + ", ".join(f"{name} {limit}" for name, limit in limits.items())
+          + f" ({concurrency} case(s) in flight)")
+
+    async def ask(name, prepared):
+        if name not in slots:
+            slots[name] = asyncio.Semaphore(limits[name])
+        async with slots[name]:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, workers[name], prepared["payloads"][name])
+
+    async def fan_out(prepared):
+        patient_id = normalize_patient_id(prepared["item"]["Reihenfolge Bilder"])
+        pending = {name: ask(name, prepared) for name in modules if patient_id not in done[name]}
+        answers = await asyncio.gather(*pending.values(), return_exceptions=True)
+        for name, answer in zip(pending, answers):
+            if isinstance(answer, Exception):
+                print(f"❌ {name} failed for Patient{prepared['item']['Reihenfolge Bilder']}: {answer}")
+        return {name: None if isinstance(answer, Exception) else answer for name, answer in zip(pending, answers)}
+
+    tracker = InFlightTracker()
+    try:
+        run_dispatch(
+            prepared_cases, fan_out, concurrency=concurrency,
+            key=lambda prepared: f"Patient{prepared['item']['Reihenfolge Bilder']}", tracker=tracker
+        )
+    finally:
+        executor.shutdown(wait=True)
+
+    # Per-provider tables as the single scripts write them, then the merged rater table
+    for name, module in modules.items():
+        saved = journals[name].save_results(module.RESULTS_FILE, module.OUTPUT_FILE, order=df["Reihenfolge Bilder"])
+        print(f"📁 {name} results saved to: {saved}")
+        replicates = save_replicates(journals[name], module.REPLICATES_FILE, order=df["Reihenfolge Bilder"])
+        if replicates:
+            print(f"🔁 {name} replicates saved to: {replicates}")
+    print(f"\n📁 Merged rater table saved to: {merge_journals(df, modules)}")
+    print(f"📊 {tracker.completed} case(s) processed for {len(modules)} provider(s), "
+          f"peak {tracker.peak} case(s) in flight.")
+    print(IMAGE_CACHE.summary())
+    print(pipeline.timing_summary())
+    print(TELEMETRY.summary())
+    TELEMETRY.write_metrics()
+    for name, module in modules.items():
+        spec = PROVIDER_SCRIPTS[name]
+        print(getattr(module, spec["client"]).connection_summary())
+        print(getattr(module, spec["limiter"]).summary())
+        print(getattr(module, spec["payload"]).summary())
+        print(module.TELEMETRY.summary())
+        module.TELEMETRY.write_metrics()
+        if hasattr(module, "GEMINI_FILES"):
+            module.GEMINI_FILES.save()
+
+
+# === EXPORT JOURNALS ===
+def export_merged(names: Sequence[str] = PROVIDERS):
+    """Rebuild MERGED_FILE from the providers' journals without calling any API."""
+    modules = load_providers(names)
+    df = read_sheet(EXCEL_PATH)
+    print(f"📁 Merged rater table saved to: {merge_journals(df, modules)}")
+
+
+# === RUN SCRIPT ===
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify CT cases with several providers in one pass.")
+    parser.add_argument("--providers", help=f"Comma-separated subset of {','.join(PROVIDER_SCRIPTS)} (default PROVIDERS).")
+    parser.add_argument("--resume", action="store_true", help="Skip cases already in each provider's journal.")
+    parser.add_argument("--export", action="store_true", help="Only rebuild the merged table from the journals.")
+    args = parser.parse_args()
+
+    selected = [name.strip() for name in args.providers.split(",")] if args.providers else PROVIDERS
+    if args.export:
+        export_merged(selected)
+    else:
+        process_all_providers(selected, resume=args.resume)
@@ -0,0 +1,189 @@
+import os
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+from image_cache import montage_grid
+
+# === TOKEN-BUDGET-AWARE PAYLOAD PLANNING ===
+# Decides, per case and per provider, how the CT slices are sent:
+#   - grayscale: keep the single CT channel instead of expanding to RGB,
+#   - montage:   tile up to N slices into one grid image to cut the image count,
+#   - resolution: the largest size on SIZE_LADDER whose estimated image tokens
+#                 fit the request budget (each provider bills images differently),
+#   - quality:    stepped down by the encoder until the request fits a byte budget.
+# With no PAYLOAD_* settings every slice is sent as before (1024 px RGB, quality 85).
+
+SIZE_LADDER = (1024, 896, 768, 640, 512, 384, 256)
+
+
+# --- per-provider image token models (published billing rules, rounded up) ---
+def openai_image_tokens(width: int, height: int) -> int:
+    """GPT-4o high detail: fit 2048 px, shortest side to 768 px, 85 + 170 per 512 px tile."""
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+def gemini_image_tokens(width: int, height: int) -> int:
+    """Gemini: 258 tokens for images up to 384 px, otherwise 258 per 768 px tile."""
+    if width <= 384 and height <= 384:
+        return 258
+    return 258 * math.ceil(width / 768) * math.ceil(height / 768)
+
+
+def xai_image_tokens(width: int, height: int) -> int:
+    """Grok: approximated as 256 tokens per 448 px tile."""
+    return 256 * math.ceil(width / 448) * math.ceil(height / 448)
+
+
+IMAGE_TOKEN_MODELS: Dict[str, Callable[[int, int], int]] = {
+    "openai": openai_image_tokens,
+    "gemini": gemini_image_tokens,
+    "xai": xai_image_tokens,
+}
+
+
+class PayloadPlan:
+    """How one case is encoded: sources (paths or montage tuples) plus encoder settings."""
+
+    def __init__(self, sources: List[Union[str, tuple]], max_size: Tuple[int, int], quality: int,
+                 grayscale: bool, max_bytes: int, tokens_per_image: int, n_slices: int):
+        self.sources = sources
+        self.max_size = max_size
+        self.quality = quality
+        self.grayscale = grayscale
+        self.max_bytes = max_bytes
+        self.tokens_per_image = tokens_per_image
+        self.n_slices = n_slices
+
+    @property
+    def n_images(self) -> int:
+        return len(self.sources)
+
+    @property
+    def image_tokens(self) -> int:
+        return self.n_images * self.tokens_per_image
+
+    @property
+    def is_montage(self) -> bool:
+        return any(isinstance(source, tuple) for source in self.sources)
+
+    def encode_params(self) -> dict:
+        """Keyword arguments for ImageCache / encode_source (format and draft come from the pipeline)."""
+        params = {"max_size": self.max_size, "quality": self.quality}
+        if self.grayscale:
+            params["grayscale"] = True
+        if self.max_bytes:
+            params["max_bytes"] = self.max_bytes
+        return params
+
+    def prompt_note(self) -> str:
+        """Sentence telling the model how slices are laid out (empty unless a montage is sent)."""
+        if not self.is_montage:
+            return ""
+        return (
+            f"\n\nThe {self.n_slices} CT slices are tiled into {self.n_images} grid image(s); "
+            "within each image read the slices left-to-right, top-to-bottom."
+        )
+
+    def describe(self, images: Optional[Sequence[bytes]] = None) -> str:
+        layout = f"{self.n_images} image(s)"
+        if self.is_montage:
+            cols, rows = montage_grid(len(self.sources[0]))
+            layout += f" (montage {cols}x{rows} of {self.n_slices} slices)"
+        size = f"{self.max_size[0]}px, q{self.quality}{', gray' if self.grayscale else ''}"
+        if self.max_bytes:
+            size += f", ≤{self.max_bytes / 1024:.0f} KB/image"
+        estimate = f"~{self.image_tokens} image tokens"
+        if images is not None:
+            estimate += f", {sum(len(data) for data in images) / 1024:.0f} KB"
+        return f"📦 Payload: {layout}, {size} — {estimate}"
+
+
+class PayloadPlanner:
+    """Chooses montage layout and resolution per case so requests fit `token_budget` image tokens.
+
+    `token_budget=0` means no limit (largest size), `montage<=1` sends every slice on its own,
+    and `max_kb` caps the encoded bytes per request by lowering JPEG quality.
+    """
+
+    def __init__(self, provider: str, token_budget: int = 0, grayscale: bool = False, montage: int = 0,
+                 max_kb: float = 0, max_size: int = 1024, quality: int = 85):
+        if provider not in IMAGE_TOKEN_MODELS:
+            raise ValueError(f"❌ Unknown provider '{provider}', expected one of {sorted(IMAGE_TOKEN_MODELS)}")
+        self.provider = provider
+        self.image_tokens = IMAGE_TOKEN_MODELS[provider]
+        self.token_budget = token_budget
+        self.grayscale = grayscale
+        self.montage = montage
+        self.max_bytes = int(max_kb * 1024)
+        self.sizes = [size for size in SIZE_LADDER if size <= max_size] or [max_size]
+        self.quality = quality
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.total_tokens = 0
+        self.total_bytes = 0
+        self.over_budget = 0
+
+    def _tokens_per_image(self, size: int, per_image: int) -> int:
+        if per_image <= 1:
+            return self.image_tokens(size, size)
+        cols, rows = montage_grid(per_image)
+        return self.image_tokens(size // cols * cols, size // rows * rows)
+
+    def plan(self, paths: Sequence) -> PayloadPlan:
+        paths = list(paths)
+        per_image = min(self.montage, len(paths)) if self.montage > 1 else 1
+        if per_image > 1:
+            sources = [tuple(paths[i:i + per_image]) for i in range(0, len(paths), per_image)]
+        else:
+            sources = list(paths)
+
+        # Largest resolution whose estimate fits the budget; the smallest one otherwise
+        size = self.sizes[-1]
+        for candidate in self.sizes:
+            tokens = len(sources) * self._tokens_per_image(candidate, per_image)
+            if not self.token_budget or tokens <= self.token_budget:
+                size = candidate
+                break
+        tokens_per_image = self._tokens_per_image(size, per_image)
+        if self.token_budget and sources and len(sources) * tokens_per_image > self.token_budget:
+            with self._lock:
+                self.over_budget += 1
+
+        max_bytes = self.max_bytes // len(sources) if self.max_bytes and sources else 0
+        return PayloadPlan(sources, (size, size), self.quality, self.grayscale, max_bytes,
+                           tokens_per_image, len(paths))
+
+    def record(self, plan: PayloadPlan, images: Sequence[bytes]) -> None:
+        with self._lock:
+            self.requests += 1
+            self.total_tokens += plan.image_tokens
+            self.total_bytes += sum(len(data) for data in images)
+
+    def summary(self) -> str:
+        if not self.requests:
+            return f"📦 Payload ({self.provider}): no requests planned"
+        text = (
+            f"📦 Payload ({self.provider}): ~{self.total_tokens / self.requests:.0f} image tokens and "
+            f"{self.total_bytes / self.requests / 1024:.0f} KB per request over {self.requests} request(s)"
+        )
+        if self.over_budget:
+            text += f", {self.over_budget} over the {self.token_budget}-token budget even at the smallest size"
+        return text
+
+
+def open_payload_planner(provider: str, prefix: str) -> PayloadPlanner:
+    """Planner configured from {prefix}_PAYLOAD_TOKENS (or PAYLOAD_TOKEN_BUDGET) and PAYLOAD_*."""
+    budget = os.getenv(f"{prefix}_PAYLOAD_TOKENS") or os.getenv("PAYLOAD_TOKEN_BUDGET", "0")
+    return PayloadPlanner(
+        provider,
+        token_budget=int(budget or 0),
+        grayscale=os.getenv("PAYLOAD_GRAYSCALE", "0").lower() in ("1", "true", "yes"),
+        montage=int(os.getenv("PAYLOAD_MONTAGE", "0") or 0),
+        max_kb=float(os.getenv("PAYLOAD_MAX_KB", "0") or 0),
+        max_size=int(os.getenv("PAYLOAD_MAX_SIZE", "1024")),
+        quality=int(os.getenv("PAYLOAD_QUALITY", "85")),
+    )
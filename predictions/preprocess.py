@@ -0,0 +1,261 @@
+import os
+import time
+import queue
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from image_cache import ImageCache, encode_source
+from payload_plan import PayloadPlan, PayloadPlanner
+from slice_dedup import SliceDeduper, open_slice_deduper
+from telemetry import Telemetry
+
+# === STREAMING IMAGE PREPROCESSING STAGE ===
+# Slices are decoded and re-encoded in a process pool while earlier cases are
+# still waiting on the API. Prepared cases are handed over through a bounded
+# queue in input order, so the request workers only block on the network.
+# A PayloadPlanner decides per case which images are produced (single slices
+# or montages) and at which resolution / quality; an optional SliceDeduper first
+# drops near-duplicate slices.
+
+_END = object()
+
+
+def _encode_in_worker(source, params: dict) -> Tuple[bytes, dict]:
+    timings = {}
+    data = encode_source(source, timings=timings, **params)
+    return data, timings
+
+
+def _source_name(source) -> str:
+    name = source[0] if isinstance(source, tuple) else source
+    return os.path.basename(getattr(name, "path", name))
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def pool_context():
+    """Start method for the encoder processes: never fork.
+
+    The pool is created by the producer thread while dispatch, limiter and
+    telemetry threads run; a forked child can inherit one of their locks held
+    and deadlock. forkserver (spawn where it is unavailable) starts clean workers.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+class PreprocessPipeline:
+    """Encode the slices of upcoming cases in worker processes ahead of the API calls.
+
+    `stream(items, paths_for)` yields one dict per item, in input order:
+    {"item": item, "paths": [...], "plan": PayloadPlan, "images": [bytes, ...], "error": str or None,
+     "timings": {"decode": s, "encode": s}} (seconds spent on this case's cache misses),
+    plus "dedup": CaseDedup when the deduper dropped slices of the case.
+    """
+
+    def __init__(self, cache: ImageCache, workers: Optional[int] = None, queue_size: int = 8,
+                 planner: Optional[PayloadPlanner] = None, format: str = "JPEG", draft: bool = False,
+                 telemetry: Optional[Telemetry] = None, deduper: Optional[SliceDeduper] = None):
+        self.cache = cache
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.queue_size = max(1, queue_size)
+        self.planner = planner or PayloadPlanner("openai")
+        self.format = format
+        self.draft = draft
+        self.telemetry = telemetry
+        self.deduper = deduper
+        self.slice_timings: List[dict] = []
+
+    def _encode_params(self, plan: PayloadPlan) -> dict:
+        return dict(plan.encode_params(), format=self.format, draft=self.draft)
+
+    def _submit(self, pool: Optional[ProcessPoolExecutor], source, params: dict):
+        """Return cached bytes, or a future / inline result for a cache miss."""
+        cached = self.cache.lookup(source, **params)
+        if cached is not None:
+            return cached
+        if pool is None:
+            return _encode_in_worker(source, params)
+        return pool.submit(_encode_in_worker, source, params)
+
+    def _collect(self, source, params: dict, result, case_timings: dict) -> bytes:
+        """Bytes for one submitted source; fresh encodes are cached and their timings recorded."""
+        if isinstance(result, bytes):
+            return result
+        data, timings = result if isinstance(result, tuple) else result.result()
+        self.cache.put(source, data, **params)
+        timings["path"] = source
+        self.slice_timings.append(timings)
+        case_timings["decode"] += timings["decode_ms"] / 1000
+        case_timings["encode"] += (timings["resize_ms"] + timings["encode_ms"]) / 1000
+        if self.telemetry is not None:
+            self.telemetry.observe("decode", timings["decode_ms"] / 1000)
+            self.telemetry.observe("encode", (timings["resize_ms"] + timings["encode_ms"]) / 1000)
+        return data
+
+    def _start(self, pool: Optional[ProcessPoolExecutor], item: Any, paths: List[str]) -> tuple:
+        """Plan a case and submit its cache misses; the returned state is passed to `_resolve`."""
+        plan = self.planner.plan(paths)
+        params = self._encode_params(plan)
+        return item, paths, plan, [self._submit(pool, src, params) for src in plan.sources]
+
+    def _resolve(self, item: Any, paths: List[str], plan: PayloadPlan, pending: list) -> dict:
+        params = self._encode_params(plan)
+        images, error = [], None
+        case_timings = {"decode": 0.0, "encode": 0.0}
+        for source, result in zip(plan.sources, pending):
+            try:
+                images.append(self._collect(source, params, result, case_timings))
+            except Exception as e:
+                error = f"{_source_name(source)}: {e}"
+        if error is None:
+            self.planner.record(plan, images)
+        return {"item": item, "paths": paths, "plan": plan, "images": images if error is None else [],
+                "error": error, "timings": case_timings}
+
+    def _dedup(self, paths: List) -> tuple:
+        if self.deduper is None:
+            return paths, None
+        start = time.perf_counter()
+        paths, dedup = self.deduper.filter(paths)
+        if self.telemetry is not None:
+            self.telemetry.observe("dedup", time.perf_counter() - start)
+        return paths, dedup
+
+    def _finish(self, state: tuple, dedup) -> dict:
+        prepared = self._resolve(*state)
+        if dedup is not None:
+            prepared["dedup"] = dedup
+            for payload in prepared.get("payloads", {}).values():
+                payload["dedup"] = dedup
+        return prepared
+
+    def _produce(self, items: Iterable[Any], paths_for: Callable[[Any], List[str]], out: queue.Queue) -> None:
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context()) if self.workers > 0 else None
+        # Keep up to `queue_size` cases submitted to the pool beyond what is already queued
+        in_progress = deque()
+        try:
+            for item in items:
+                paths, dedup = self._dedup(paths_for(item))
+                in_progress.append((self._start(pool, item, paths), dedup))
+                if len(in_progress) > self.queue_size:
+                    out.put(self._finish(*in_progress.popleft()))
+            while in_progress:
+                out.put(self._finish(*in_progress.popleft()))
+        except Exception as e:
+            out.put(e)
+        finally:
+            out.put(_END)
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+            if self.deduper is not None:
+                self.deduper.save()
+
+    def stream(self, items: Iterable[Any], paths_for: Callable[[Any], List[str]]) -> Iterator[dict]:
+        """Yield prepared cases in input order while later cases are still being encoded."""
+        out = queue.Queue(maxsize=self.queue_size)
+        producer = threading.Thread(target=self._produce, args=(items, paths_for, out), daemon=True)
+        producer.start()
+        while True:
+            prepared = out.get()
+            if prepared is _END:
+                break
+            if isinstance(prepared, Exception):
+                raise prepared
+            yield prepared
+        producer.join()
+
+    def timing_summary(self) -> str:
+        dedup = f"\n{self.deduper.summary()}" if self.deduper is not None else ""
+        if not self.slice_timings:
+            return "⏱️ Preprocessing: all images served from cache." + dedup
+        decode = [t["decode_ms"] for t in self.slice_timings]
+        encode = [t["resize_ms"] + t["encode_ms"] for t in self.slice_timings]
+        return (
+            f"⏱️ Preprocessed {len(self.slice_timings)} image(s) on {self.workers} worker(s): "
+            f"decode p50 {_percentile(decode, 50):.1f} ms / p95 {_percentile(decode, 95):.1f} ms, "
+            f"resize+encode p50 {_percentile(encode, 50):.1f} ms / p95 {_percentile(encode, 95):.1f} ms"
+        ) + dedup
+
+
+class SharedPreprocessPipeline(PreprocessPipeline):
+    """One preprocessing pass for several providers, each with its own PayloadPlanner.
+
+    Every distinct (source, encoder settings) pair of a case is encoded once, however
+    many providers ask for it (with the default PAYLOAD_* settings all providers share
+    the same images). `stream()` yields {"item", "paths", "timings", "payloads"}, where
+    "payloads" maps each planner name to a dict in PreprocessPipeline's layout, so a
+    provider script's process_case can take it unchanged.
+    """
+
+    def __init__(self, cache: ImageCache, planners: Dict[str, PayloadPlanner], **kwargs):
+        if not planners:
+            raise ValueError("❌ SharedPreprocessPipeline needs at least one planner")
+        super().__init__(cache, planner=next(iter(planners.values())), **kwargs)
+        self.planners = planners
+
+    def _start(self, pool: Optional[ProcessPoolExecutor], item: Any, paths: List[str]) -> tuple:
+        plans = {name: planner.plan(paths) for name, planner in self.planners.items()}
+        jobs = {}
+        for plan in plans.values():
+            params = self._encode_params(plan)
+            for source in plan.sources:
+                key = (source, tuple(sorted(params.items())))
+                if key not in jobs:
+                    jobs[key] = self._submit(pool, source, params)
+        return item, paths, plans, jobs
+
+    def _resolve(self, item: Any, paths: List[str], plans: Dict[str, PayloadPlan], jobs: dict) -> dict:
+        case_timings = {"decode": 0.0, "encode": 0.0}
+        encoded, errors = {}, {}
+        for key, result in jobs.items():
+            source, params = key
+            try:
+                encoded[key] = self._collect(source, dict(params), result, case_timings)
+            except Exception as e:
+                errors[key] = f"{_source_name(source)}: {e}"
+
+        payloads = {}
+        for name, plan in plans.items():
+            params = tuple(sorted(self._encode_params(plan).items()))
+            keys = [(source, params) for source in plan.sources]
+            error = next((errors[key] for key in keys if key in errors), None)
+            images = [encoded[key] for key in keys] if error is None else []
+            if error is None:
+                self.planners[name].record(plan, images)
+            payloads[name] = {"item": item, "paths": paths, "plan": plan, "images": images, "error": error,
+                              "timings": case_timings}
+        return {"item": item, "paths": paths, "timings": case_timings, "payloads": payloads}
+
+
+def _pipeline_settings() -> dict:
+    workers = os.getenv("PREPROCESS_WORKERS")
+    return {
+        "workers": int(workers) if workers else None,
+        "queue_size": int(os.getenv("PREPROCESS_QUEUE", "8")),
+        "draft": os.getenv("JPEG_DRAFT", "0").lower() in ("1", "true", "yes"),
+    }
+
+
+def open_preprocess_pipeline(cache: ImageCache, planner: Optional[PayloadPlanner] = None,
+                             telemetry: Optional[Telemetry] = None, index=None) -> PreprocessPipeline:
+    """Pipeline configured from PREPROCESS_WORKERS / PREPROCESS_QUEUE / JPEG_DRAFT and SLICE_DEDUP*.
+
+    Slice hashes are kept in `index` (the run's CaseIndex) when given.
+    """
+    return PreprocessPipeline(cache, planner=planner, telemetry=telemetry, deduper=open_slice_deduper(index),
+                              **_pipeline_settings())
+
+
+def open_shared_preprocess_pipeline(cache: ImageCache, planners: Dict[str, PayloadPlanner],
+                                    telemetry: Optional[Telemetry] = None, index=None) -> SharedPreprocessPipeline:
+    """SharedPreprocessPipeline with the same environment settings as open_preprocess_pipeline."""
+    return SharedPreprocessPipeline(cache, planners, telemetry=telemetry, deduper=open_slice_deduper(index),
+                                    **_pipeline_settings())
@@ -0,0 +1,205 @@
+import os
+import threading
+from typing import Optional
+import httpx
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+
+# === LONG-LIVED, POOLED PROVIDER CLIENTS ===
+# One client per provider per process, created once and shared by every
+# worker thread. Keep-alive pools amortize the TCP+TLS handshake across cases;
+# the connection counters below show how often a new connection was needed.
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "120"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+
+
+class ConnectionStats:
+    """Thread-safe request / new-connection counters for one provider."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def add(self, requests: int = 0, new_connections: int = 0) -> None:
+        with self._lock:
+            self.requests += requests
+            self.new_connections += new_connections
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reused_requests": reused,
+                "reuse_ratio": reused / self.requests if self.requests else 0.0,
+            }
+
+
+class Provider:
+    """Base class: owns one pooled client and its connection statistics."""
+
+    name = "provider"
+
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, timeout: float = HTTP_TIMEOUT):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.stats = ConnectionStats()
+
+    def connection_stats(self) -> dict:
+        return self.stats.snapshot()
+
+    def connection_summary(self) -> str:
+        s = self.connection_stats()
+        return (
+            f"🔌 {self.name}: {s['requests']} request(s) over {s['new_connections']} connection(s) "
+            f"({s['reuse_ratio']:.0%} reused, pool size {self.pool_size})"
+        )
+
+    def close(self) -> None:
+        pass
+
+
+class OpenAIProvider(Provider):
+    """OpenAI SDK client on a shared keep-alive httpx pool.
+
+    The SDK client is built on first use of `.client`: it refuses to start without
+    an API key, and importing a script (e.g. for `--export` or a cache replay) must
+    not need one.
+    """
+
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.base_url = base_url
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            timeout=httpx.Timeout(self.timeout, connect=HTTP_CONNECT_TIMEOUT),
+            event_hooks={"request": [self._trace_request]},
+        )
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self) -> openai.OpenAI:
+        with self._client_lock:
+            if self._client is None:
+                self._client = openai.OpenAI(
+                    api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                    base_url=self.base_url or os.getenv("OPENAI_BASE_URL"),
+                    http_client=self.http_client,
+                    max_retries=0,  # retries are handled by rate_limit.ProviderLimiter
+                )
+            return self._client
+
+    def _trace_request(self, request: httpx.Request) -> None:
+        # httpcore reports connection setup through the "trace" request extension
+        def trace(event: str, info: dict) -> None:
+            if event == "connection.connect_tcp.complete":
+                self.stats.add(new_connections=1)
+
+        request.extensions["trace"] = trace
+        self.stats.add(requests=1)
+
+    def close(self) -> None:
+        self.http_client.close()
+
+
+class XAIProvider(Provider):
+    """requests.Session with a keep-alive pool for the xAI chat completions endpoint."""
+
+    name = "xai"
+
+    def __init__(self, api_key: Optional[str] = None, api_url: Optional[str] = None, **kwargs):
+        super().__init__(**kwargs)
+        self.api_url = api_url or os.getenv("XAI_API_URL", "https://api.x.ai/v1/chat/completions")
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key or os.getenv('XAI_API_KEY')}",
+            "Content-Type": "application/json",
+        })
+
+    def post(self, payload: dict, url: Optional[str] = None) -> requests.Response:
+        return self.session.post(url or self.api_url, json=payload, timeout=(HTTP_CONNECT_TIMEOUT, self.timeout))
+
+    def connection_stats(self) -> dict:
+        # urllib3 keeps per-host counters on each connection pool
+        pools = self.adapter.poolmanager.pools
+        requests_made = new_connections = 0
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                requests_made += pool.num_requests
+                new_connections += pool.num_connections
+        self.stats.requests, self.stats.new_connections = requests_made, new_connections
+        return self.stats.snapshot()
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class GeminiProvider(Provider):
+    """Configures google-generativeai once and reuses one GenerativeModel per model name.
+
+    The SDK keeps a single long-lived channel per process; here we only count
+    requests, since the channel's connection handling is internal to the SDK.
+    The SDK is configured on the first request, so replaying cached answers or
+    exporting the journal needs neither the API key nor the package.
+    """
+
+    name = "gemini"
+
+    def __init__(self, api_key: Optional[str] = None, model_name: str = "gemini-1.5-pro", **kwargs):
+        super().__init__(**kwargs)
+        self.api_key = api_key
+        self.model_name = model_name
+        self.genai = None
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _configure(self):
+        import google.generativeai as genai
+
+        endpoint = os.getenv("GEMINI_API_ENDPOINT")
+        genai.configure(
+            api_key=self.api_key or os.getenv("GEMINI_API_KEY"),
+            transport="rest" if endpoint else None,
+            client_options={"api_endpoint": endpoint} if endpoint else None,
+        )
+        return genai
+
+    def sdk(self):
+        """The configured google.generativeai module."""
+        with self._lock:
+            if self.genai is None:
+                self.genai = self._configure()
+            return self.genai
+
+    def upload_file(self, *args, **kwargs):
+        return self.sdk().upload_file(*args, **kwargs)
+
+    def model(self, model_name: Optional[str] = None):
+        model_name = model_name or self.model_name
+        genai = self.sdk()
+        with self._lock:
+            if model_name not in self._models:
+                self._models[model_name] = genai.GenerativeModel(model_name)
+            return self._models[model_name]
+
+    def generate_content(self, contents, model_name: Optional[str] = None, **kwargs):
+        self.stats.add(requests=1)
+        return self.model(model_name).generate_content(contents=contents, request_options={"timeout": self.timeout},
+                                                       **kwargs)
+
+    def connection_summary(self) -> str:
+        s = self.connection_stats()
+        return f"🔌 {self.name}: {s['requests']} request(s) over {len(self._models)} shared model client(s)"
@@ -0,0 +1,303 @@
+import os
+import re
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Mapping, Optional
+from tenacity import Retrying, retry_if_exception, stop_after_attempt
+import telemetry
+
+# === ADAPTIVE RATE LIMITING, BACKOFF AND CIRCUIT BREAKING ===
+# One ProviderLimiter per provider, shared by all worker threads:
+#   - token buckets for requests/min and tokens/min smooth the request rate,
+#   - Retry-After / x-ratelimit-* headers pause the whole provider, not just one call,
+#   - retries use exponential backoff with full jitter (via tenacity),
+#   - a circuit breaker holds every caller after repeated errors until a cooldown
+#     passes, then lets one trial call through; the rest wait for its outcome.
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+# --- error inspection (works for openai, requests and google.api_core exceptions) ---
+def error_status(exc: BaseException) -> Optional[int]:
+    for candidate in (getattr(exc, "status_code", None), getattr(getattr(exc, "response", None), "status_code", None),
+                      getattr(exc, "code", None)):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def error_headers(exc: BaseException) -> Mapping[str, str]:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    return headers if headers is not None else {}
+
+
+def is_retryable(exc: BaseException) -> bool:
+    status = error_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # No status: network-level failures (connection reset, timeouts) are worth retrying
+    name = type(exc).__name__
+    return isinstance(exc, (ConnectionError, TimeoutError)) or "Connection" in name or "Timeout" in name
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Parse '1.5', '20ms', '6m0s' style durations into seconds."""
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def retry_after_seconds(headers: Mapping[str, str]) -> Optional[float]:
+    """Seconds to wait according to Retry-After / retry-after-ms headers, if present."""
+    if not headers:
+        return None
+    lowered = {k.lower(): v for k, v in headers.items()}
+    if "retry-after-ms" in lowered:
+        try:
+            return float(lowered["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = lowered.get("retry-after")
+    if value is None:
+        return None
+    seconds = parse_duration(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def rough_request_tokens(prompt: str, n_images: int, max_tokens: int, per_image: int = 765) -> int:
+    """Conservative token estimate for the tokens/min bucket (~4 chars per text token)."""
+    return len(prompt) // 4 + n_images * per_image + max_tokens
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `per_minute / 60` units per second."""
+
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._cond = threading.Condition()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1.0) -> float:
+        """Block until `amount` units are available; returns the seconds spent waiting."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                self._cond.wait((amount - self.tokens) / self.rate)
+                waited += time.monotonic() - now
+
+
+class CircuitBreaker:
+    """Open after `failure_threshold` consecutive failures; allow one trial call after `cooldown`.
+
+    Callers are held, not failed, while the circuit is open: they sleep out the
+    cooldown, and while the trial call runs they wait for its outcome. A successful
+    trial closes the circuit for everyone, a failed one opens it for another cooldown.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_running = False
+        self._cond = threading.Condition()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def before_call(self) -> float:
+        """Block while the circuit is open or a trial call is running; returns the seconds waited."""
+        start = time.monotonic()
+        with self._cond:
+            while self.opened_at is not None:
+                remaining = self.cooldown - (time.monotonic() - self.opened_at)
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                elif self.trial_running:
+                    self._cond.wait()
+                else:
+                    self.trial_running = True  # this caller makes the trial call
+                    break
+        return time.monotonic() - start
+
+    def record_success(self) -> None:
+        with self._cond:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+            self._cond.notify_all()
+
+    def record_failure(self) -> None:
+        with self._cond:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_running = False
+            self._cond.notify_all()
+
+
+class ProviderLimiter:
+    """Rate limiting, retries and circuit breaking for every call to one provider."""
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, max_attempts: int = 5,
+                 base_delay: float = 1.0, max_delay: float = 60.0, failure_threshold: int = 5,
+                 cooldown: float = 30.0):
+        self.name = name
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        self.breaker = CircuitBreaker(failure_threshold, cooldown)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self.paused_until = 0.0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    # --- throttling ---
+    def acquire(self, tokens: int = 0) -> None:
+        waited = 0.0
+        while True:
+            with self._lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+            waited += delay
+        if self.requests is not None:
+            waited += self.requests.acquire(1)
+        if self.tokens is not None and tokens:
+            waited += self.tokens.acquire(tokens)
+        if waited:
+            with self._lock:
+                self.throttled_seconds += waited
+            telemetry.observe("throttle", waited)
+
+    def pause(self, seconds: float) -> None:
+        """Hold every caller of this provider for `seconds` (e.g. after a 429 with Retry-After)."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def observe_headers(self, headers: Mapping[str, str]) -> None:
+        """Pause proactively when the provider reports an exhausted request or token budget."""
+        if not headers:
+            return
+        lowered = {k.lower(): v for k, v in headers.items()}
+        for kind in ("requests", "tokens"):
+            remaining = lowered.get(f"x-ratelimit-remaining-{kind}")
+            reset = lowered.get(f"x-ratelimit-reset-{kind}")
+            if remaining is not None and reset is not None and str(remaining).strip() == "0":
+                seconds = parse_duration(reset)
+                if seconds:
+                    self.pause(seconds)
+
+    # --- retries ---
+    def _wait(self, retry_state) -> float:
+        exc = retry_state.outcome.exception()
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (retry_state.attempt_number - 1)))
+        retry_after = retry_after_seconds(error_headers(exc))
+        if retry_after is not None:
+            # The server's hint wins over max_delay; a little jitter keeps workers from resyncing
+            self.pause(retry_after)
+            return retry_after + random.uniform(0, self.base_delay)
+        return backoff
+
+    @staticmethod
+    def _sleep(seconds: float) -> None:
+        time.sleep(seconds)
+
+    def _before_sleep(self, retry_state) -> None:
+        exc = retry_state.outcome.exception()
+        with self._lock:
+            self.retries += 1
+        telemetry.observe("retry_sleep", retry_state.next_action.sleep)
+        status = error_status(exc)
+        print(
+            f"⚠️ {self.name}: {status or type(exc).__name__} on attempt "
+            f"{retry_state.attempt_number}/{self.max_attempts}, retrying in {retry_state.next_action.sleep:.1f}s"
+        )
+
+    def call(self, fn: Callable[[], Any], tokens: int = 0,
+             headers_of: Optional[Callable[[Any], Mapping[str, str]]] = None) -> Any:
+        """Run `fn` under the limiter; non-retryable errors and exhausted retries are re-raised."""
+        def attempt():
+            held = self.breaker.before_call()
+            if held:
+                with self._lock:
+                    self.throttled_seconds += held
+                telemetry.observe("throttle", held)
+            self.acquire(tokens)
+            try:
+                with telemetry.stage("request"):
+                    result = fn()
+            except BaseException as exc:
+                if is_retryable(exc):
+                    self.breaker.record_failure()
+                else:
+                    # The provider answered (e.g. a 400), or the call never reached it: not an outage
+                    self.breaker.record_success()
+                raise
+            self.breaker.record_success()
+            if headers_of is not None:
+                self.observe_headers(headers_of(result))
+            return result
+
+        retrying = Retrying(
+            stop=stop_after_attempt(self.max_attempts),
+            wait=self._wait,
+            sleep=self._sleep,
+            retry=retry_if_exception(is_retryable),
+            before_sleep=self._before_sleep,
+            reraise=True,
+        )
+        return retrying(attempt)
+
+    def summary(self) -> str:
+        return (
+            f"🚦 {self.name}: {self.retries} retr(ies), {self.throttled_seconds:.1f}s throttled, "
+            f"circuit {self.breaker.state}"
+        )
+
+
+def limiter_from_env(name: str, prefix: str) -> ProviderLimiter:
+    """Build a limiter from {prefix}_RPM / {prefix}_TPM and the shared RETRY_* / CIRCUIT_* settings."""
+    return ProviderLimiter(
+        name,
+        rpm=float(os.getenv(f"{prefix}_RPM", "0") or 0),
+        tpm=float(os.getenv(f"{prefix}_TPM", "0") or 0),
+        max_attempts=int(os.getenv("RETRY_MAX_ATTEMPTS", "5")),
+        base_delay=float(os.getenv("RETRY_BASE_DELAY", "1")),
+        max_delay=float(os.getenv("RETRY_MAX_DELAY", "60")),
+        failure_threshold=int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")),
+        cooldown=float(os.getenv("CIRCUIT_COOLDOWN", "30")),
+    )
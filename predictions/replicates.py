@@ -0,0 +1,78 @@
+import os
+import contextvars
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional
+from case_index import normalize_patient_id
+from response_parser import RESULT_COLUMNS, parse_responses
+from result_journal import REPLICATE_COLUMN
+from sheet_store import columnar_available, write_table
+
+# === REPLICATE SAMPLING (MODEL SELF-CONSISTENCY) ===
+# With REPLICATES=N (or --replicates N) every case is answered N times from one
+# prepared payload: the slices are found and encoded once, and the N samples
+# are requested together (provider-side `n` / `candidate_count` where the API
+# has it, otherwise N concurrent requests). The journal keeps the answer texts
+# under "Replicates"; the replicate table holds one compact row per patient and
+# replicate with the parsed categories and Likert scores, which
+# plots/self_consistency.py turns into intra-model kappa and Likert variance.
+
+
+def replicates_from_env() -> int:
+    return max(1, int(os.getenv("REPLICATES", "1") or 1))
+
+
+def default_replicates_path(output_file: str, provider: str) -> str:
+    return f"{os.path.splitext(output_file)[0]}.{provider}.replicates.parquet"
+
+
+def fan_out(call: Callable[[], str], n: int) -> List[str]:
+    """`n` concurrent calls, for providers without server-side sampling of several answers.
+
+    Each call runs in a copy of the caller's context, so the telemetry case trace
+    (a ContextVar) still collects the timings and tokens of every sample.
+    """
+    if n <= 1:
+        return [call() for _ in range(n)]
+    with ThreadPoolExecutor(max_workers=n, thread_name_prefix="replicate") as pool:
+        futures = [pool.submit(contextvars.copy_context().run, call) for _ in range(n)]
+        return [future.result() for future in futures]
+
+
+def answered(responses: List[str]) -> List[str]:
+    """The samples that did not fail ("ERROR")."""
+    return [text for text in responses if text != "ERROR"]
+
+
+def replicate_table(records: Iterable[dict], id_key: str = "Patient ID") -> pd.DataFrame:
+    """Long table: one row per (patient, replicate) with the parsed result columns.
+
+    Categories are strings such as "2+3" (dictionary-encoded in Parquet) and Likert
+    scores small nullable integers, so even many replicates stay small on disk.
+    """
+    ids, replicate, texts = [], [], []
+    for record in records:
+        for i, text in enumerate(record.get(REPLICATE_COLUMN) or []):
+            ids.append(normalize_patient_id(record[id_key]))
+            replicate.append(i)
+            texts.append(text)
+    parsed = parse_responses(pd.Series(texts, dtype=object))
+    table = pd.DataFrame({"Patient ID": pd.Series(ids, dtype=object), "replicate": pd.Series(replicate, dtype="int16")})
+    for col in RESULT_COLUMNS[:2]:
+        table[col] = parsed[col].to_numpy()
+    for col in RESULT_COLUMNS[2:]:
+        table[col] = parsed[col].astype("Int8").to_numpy()
+    return table
+
+
+def save_replicates(journal, path: str, order: Optional[Iterable[Any]] = None) -> Optional[str]:
+    """Write the replicate table of a ResultJournal (Excel if pyarrow is missing); None if it has none."""
+    table = replicate_table(journal.latest_records(order))
+    if table.empty:
+        return None
+    if path.lower().endswith(".parquet") and columnar_available():
+        write_table(table, path, {"journal": os.path.abspath(journal.path)})
+        return path
+    path = os.path.splitext(path)[0] + ".xlsx"
+    table.to_excel(path, index=False)
+    return path
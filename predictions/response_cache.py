@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Callable, Iterable, List, Optional, Union
+
+# === PERSISTENT LLM RESPONSE MEMOIZATION ===
+# Responses are keyed by provider, model, prompt hash, the ordered hashes of the
+# encoded images and the sampling parameters, so re-analysing an archived run
+# (new Likert parsing, new plots) replays answers instead of paying for them.
+#   RESPONSE_CACHE_MODE=off        never read or write (default)
+#   RESPONSE_CACHE_MODE=readwrite  serve hits, call the API and store on misses
+#   RESPONSE_CACHE_MODE=replay     serve hits only; misses fail without touching the network
+
+MODES = ("off", "readwrite", "replay")
+
+
+def content_hash(data: Union[str, bytes]) -> str:
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed response memo with LRU (max entries) and max-age eviction."""
+
+    def __init__(self, path: str, mode: str = "readwrite", max_entries: int = 100_000,
+                 max_age_days: float = 0):
+        if mode not in MODES:
+            raise ValueError(f"❌ Unknown RESPONSE_CACHE_MODE '{mode}', expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = None
+        if mode != "off":
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, provider TEXT, model TEXT, "
+                "response TEXT, created REAL, last_access REAL, hits INTEGER DEFAULT 0)"
+            )
+            self._db.commit()
+            if mode != "replay":  # replay never drops archived answers, whatever the limits
+                self.evict()
+
+    @property
+    def replay_only(self) -> bool:
+        return self.mode == "replay"
+
+    @staticmethod
+    def key(provider: str, model: str, prompt: str, images: Iterable[Union[str, bytes]],
+            temperature: Optional[float] = None, max_tokens: Optional[int] = None, **extra) -> str:
+        """Stable key over everything that determines the model's answer."""
+        material = {
+            "provider": provider,
+            "model": model,
+            "prompt": content_hash(prompt),
+            "images": [content_hash(img) for img in images],
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "extra": extra,
+        }
+        return content_hash(json.dumps(material, sort_keys=True))
+
+    def get(self, key: str) -> Optional[str]:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.max_age and time.time() - row[1] > self.max_age):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE responses SET last_access = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+            return row[0]
+
+    def put(self, key: str, provider: str, model: str, response: str) -> None:
+        if self._db is None or self.mode == "replay":
+            return
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, provider, model, response, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, provider, model, response, now, now),
+            )
+            self._db.commit()
+
+    def evict(self) -> int:
+        """Drop expired entries and the least recently used ones beyond `max_entries`."""
+        if self._db is None:
+            return 0
+        with self._lock:
+            removed = 0
+            if self.max_age:
+                removed += self._db.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,)
+                ).rowcount
+            if self.max_entries:
+                removed += self._db.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access DESC "
+                    "LIMIT -1 OFFSET ?)", (self.max_entries,)
+                ).rowcount
+            self._db.commit()
+            return removed
+
+    def memoized(self, provider: str, model: str, prompt: str, images: Iterable[Union[str, bytes]],
+                 call: Callable[[], str], temperature: Optional[float] = None,
+                 max_tokens: Optional[int] = None, **extra) -> str:
+        """Cached response text, or the result of `call()` (stored unless it is "ERROR")."""
+        if self._db is None:
+            return call()
+        key = self.key(provider, model, prompt, images, temperature, max_tokens, **extra)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        if self.replay_only:
+            print(f"❌ Replay-only mode: no cached {provider}/{model} response for this case")
+            return "ERROR"
+        response = call()
+        if response != "ERROR":
+            self.put(key, provider, model, response)
+        return response
+
+    def memoized_samples(self, provider: str, model: str, prompt: str, images: Iterable[Union[str, bytes]],
+                         call: Callable[[int], List[str]], n: int, temperature: Optional[float] = None,
+                         max_tokens: Optional[int] = None, **extra) -> List[str]:
+        """`n` sampled responses; `call(k)` returns k fresh ones and is only asked for the uncached samples.
+
+        Sample 0 shares the key of `memoized` (a single run's answer is the first replicate),
+        sample i adds replicate=i to the key.
+        """
+        if self._db is None:
+            responses = list(call(n))
+            return responses + ["ERROR"] * (n - len(responses))
+        images = list(images)
+        keys = [self.key(provider, model, prompt, images, temperature, max_tokens, **extra,
+                         **({"replicate": i} if i else {})) for i in range(n)]
+        responses = [self.get(key) for key in keys]
+        missing = [i for i, response in enumerate(responses) if response is None]
+        if missing and self.replay_only:
+            print(f"❌ Replay-only mode: {len(missing)} cached {provider}/{model} replicate(s) missing for this case")
+            return [response or "ERROR" for response in responses]
+        if missing:
+            fresh = list(call(len(missing)))
+            fresh += ["ERROR"] * (len(missing) - len(fresh))  # the API returned fewer samples than asked
+            for i, response in zip(missing, fresh):
+                responses[i] = response
+                if response != "ERROR":
+                    self.put(keys[i], provider, model, response)
+        return responses
+
+    def summary(self) -> str:
+        if self._db is None:
+            return "💾 Response cache: off"
+        return f"💾 Response cache ({self.mode}): {self.hits} hit(s), {self.misses} miss(es)"
+
+
+def open_response_cache() -> ResponseCache:
+    """Cache configured from RESPONSE_CACHE_MODE / _FILE / _MAX_ENTRIES / _MAX_AGE_DAYS."""
+    return ResponseCache(
+        os.getenv("RESPONSE_CACHE_FILE", "response_cache.sqlite"),
+        mode=os.getenv("RESPONSE_CACHE_MODE", "off").lower(),
+        max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "100000")),
+        max_age_days=float(os.getenv("RESPONSE_CACHE_MAX_AGE_DAYS", "0")),
+    )
@@ -0,0 +1,114 @@
+import re
+import numpy as np
+import pandas as pd
+from typing import Optional, Tuple
+
+# === FREE-TEXT RESPONSE PARSER ===
+# One precompiled engine for the answers of all providers: the chosen
+# categories (normalized to the rater sheet's "2+3" form) and the Likert
+# confidence, for the section without and the section with medical history.
+# The answer is split at the "with medical history" heading; when a model
+# writes no such heading the first and second match are used, as the old
+# per-script extract_likert_scores did. `parse_response` handles one answer,
+# `parse_responses` a whole pandas Series of archived answers, matching each
+# distinct text once. The patterns run on the lowercased answer, which is much
+# faster than case-insensitive matching.
+
+RESULT_COLUMNS = (
+    "Kategorien ohne Anamnese", "Kategorien mit Anamnese", "Likert-Skala ohne Anamnese", "Likert-Skala mit Anamnese",
+)
+
+# A digit that is not part of a "1-5" / "1–5" range
+_NOT_RANGE_START = r"(?<![\d–\-])(?<![–\-]\s)"
+_NOT_RANGE_END = r"(?!\s*[–\-]\s*\d)(?!\d)"
+
+# A category code, optionally followed by its name ("3 – Kontusionsblutung", "1 (SAB)");
+# names never contain digits, so every digit of a match is a code
+_CODE = r"[1-5]" + _NOT_RANGE_END + r"(?:\s*[–\-:(]\s*[^\d\n,;+/&()]*\)?)?"
+_CODE_SEPARATOR = r"\s*(?:\+|,|;|/|&|\band\b|\bund\b)\s*"
+# "- Category: 2+3", "**Categories:** 2 and 3", "Kategorie 4 – Aneurysmatische SAB",
+# "Chosen category: 3 – Kontusionsblutung, 1 – Traumatische SAB", or a heading
+# followed by one bulleted code per line ("Categories:\n- 3 – Kontusionsblutung\n- 1 – SAB")
+_CATEGORY = (
+    r"(?:categor(?:y|ies)|kategorien?)(?:[^\n]*?" + _NOT_RANGE_START + r"|[^\n\d]*\n)"
+    + r"(" + _CODE + r"(?:" + _CODE_SEPARATOR + _CODE + r")*"
+    + r"|(?:[ \t]*[-*•][ \t]*[1-5](?!\d)[^\d\n]*(?:\n|$))+)"
+)
+# "- Likert confidence: 3", "Confidence level (1–5 scale): 4", "Likert-Skala: 2/5"
+_LIKERT = r"(?:likert|confidence|konfidenz|skala)[^\n]*?" + _NOT_RANGE_START + r"([1-5])" + _NOT_RANGE_END
+
+CATEGORY_PATTERN = re.compile(_CATEGORY)
+LIKERT_PATTERN = re.compile(_LIKERT)
+# First and (optional) second occurrence, for answers without section headings
+_TWO_CATEGORIES = re.compile(f"{_CATEGORY}(?:.*?{_CATEGORY})?", re.DOTALL)
+_TWO_LIKERTS = re.compile(f"{_LIKERT}(?:.*?{_LIKERT})?", re.DOTALL)
+# Heading of the with-history section: a line (no "Reasoning:"-style prefix) naming the condition
+WITH_HISTORY_HEADING = re.compile(
+    r"^[^\n:]{0,80}?\b(?:with|mit)\b(?:\s+the)?\s+(?:medical\s+history|anamnes\w*)", re.MULTILINE
+)
+_DIGITS = re.compile(r"[1-5]")
+
+
+def normalize_categories(raw: Optional[str]) -> Optional[str]:
+    """"3 and 2" or "3 – kontusionsblutung, 1 – traumatische sab" -> "2+3" / "1+3"; None stays None."""
+    if not isinstance(raw, str):
+        return None
+    return "+".join(sorted(set(_DIGITS.findall(raw)), key=int))
+
+
+def _first(pattern: re.Pattern, text: str) -> Optional[str]:
+    match = pattern.search(text)
+    return match.group(1) if match else None
+
+
+def _parse(text: str) -> Tuple:
+    """Raw (categories without, categories with, Likert without, Likert with) of a lowercased answer."""
+    parts = WITH_HISTORY_HEADING.split(text, maxsplit=1)
+    if len(parts) == 2:
+        return (_first(CATEGORY_PATTERN, parts[0]), _first(CATEGORY_PATTERN, parts[1]),
+                _first(LIKERT_PATTERN, parts[0]), _first(LIKERT_PATTERN, parts[1]))
+    categories = _TWO_CATEGORIES.search(text)
+    likerts = _TWO_LIKERTS.search(text)
+    return (categories.groups() if categories else (None, None)) + (likerts.groups() if likerts else (None, None))
+
+
+def parse_response(text: str) -> dict:
+    """{"Kategorien ohne Anamnese": "2+3", ..., "Likert-Skala mit Anamnese": 4}; missing values are None."""
+    raw = _parse(text.lower() if isinstance(text, str) else "")
+    return dict(zip(RESULT_COLUMNS, (
+        normalize_categories(raw[0]), normalize_categories(raw[1]),
+        int(raw[2]) if raw[2] else None, int(raw[3]) if raw[3] else None,
+    )))
+
+
+def extract_likert_scores(text: str) -> Tuple:
+    """(without, with) Likert scores, "N/A" where missing (the scripts' old return format)."""
+    parsed = parse_response(text)
+    return tuple("N/A" if parsed[col] is None else parsed[col] for col in RESULT_COLUMNS[2:])
+
+
+def extract_categories(text: str) -> Tuple:
+    """(without, with) categories as "2+3", "N/A" where missing."""
+    parsed = parse_response(text)
+    return tuple("N/A" if parsed[col] is None else parsed[col] for col in RESULT_COLUMNS[:2])
+
+
+def parse_responses(texts: pd.Series) -> pd.DataFrame:
+    """Bulk `parse_response` over a Series of answers, indexed like `texts`.
+
+    Each distinct answer is matched once; category strings are normalized once per
+    distinct value and the columns are assembled with array indexing. Categories come
+    back as strings ("2+3") and Likert scores as nullable integers, with missing values
+    as <NA>, so the frame can go straight into the kappa computation.
+    """
+    codes, uniques = pd.factorize(pd.Series(texts, dtype=object).where(texts.map(lambda t: isinstance(t, str)), ""))
+    raw = np.array([_parse(text.lower()) for text in uniques], dtype=object).reshape(len(uniques), 4)
+
+    columns = {}
+    for i, col in enumerate(RESULT_COLUMNS[:2]):
+        raw_codes, distinct = pd.factorize(raw[:, i])
+        normalized = np.array([normalize_categories(value) for value in distinct] + [None], dtype=object)
+        columns[col] = normalized[raw_codes][codes]  # code -1 (no match) picks the trailing None
+    for i, col in enumerate(RESULT_COLUMNS[2:], start=2):
+        columns[col] = pd.array(pd.to_numeric(pd.Series(raw[:, i])), dtype="Int64")[codes]
+    return pd.DataFrame(columns, index=texts.index)
@@ -0,0 +1,164 @@
+import os
+import glob
+import json
+import time
+import threading
+import pandas as pd
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from case_index import normalize_patient_id
+from sheet_store import columnar_available, write_table
+
+# === CRASH-SAFE RESULT JOURNAL ===
+# Every finished case is appended to an append-only JSONL file and fsync'ed
+# right away, so an interrupted run keeps every response it already paid for.
+# `--resume` skips patients found in the journal. At the end of a run the
+# journal is materialized as a columnar results table (Parquet); the Excel
+# OUTPUT_FILE is an explicit export step (`--export`).
+
+# Per-sample answers of replicate runs stay in the journal only; they are
+# exported as their own long table (see replicates.py).
+REPLICATE_COLUMN = "Replicates"
+
+
+def _json_default(value: Any):
+    """Serialize numpy scalars coming from pandas rows."""
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def default_journal_path(output_file: str, provider: str) -> str:
+    """Per-provider journal next to OUTPUT_FILE (the scripts may share one OUTPUT_FILE)."""
+    return f"{os.path.splitext(output_file)[0]}.{provider}.journal.jsonl"
+
+
+def default_results_path(output_file: str, provider: str) -> str:
+    """Per-provider Parquet results table next to OUTPUT_FILE."""
+    return f"{os.path.splitext(output_file)[0]}.{provider}.parquet"
+
+
+def shard_journal_path(journal_path: str, worker_id: str) -> str:
+    """Journal of one sharded worker, next to the main journal (<stem>.<worker_id>.jsonl)."""
+    stem, ext = os.path.splitext(journal_path)
+    return f"{stem}.{worker_id}{ext}"
+
+
+def shard_journal_paths(journal_path: str) -> List[str]:
+    stem, ext = os.path.splitext(journal_path)
+    return sorted(path for path in glob.glob(f"{glob.escape(stem)}.*{ext}") if path != journal_path)
+
+
+def consolidate_journals(journal_path: str, order: Optional[Iterable[Any]] = None) -> Tuple[int, int]:
+    """Fold the worker shards into `journal_path`, one entry per patient, in `order` (e.g. sheet order).
+
+    A completed entry beats a failed one, and among equals the latest wins, so a case
+    answered twice after a lease expired is kept once. The shards are left in place
+    (consolidating again gives the same journal). Returns (patients, entries dropped).
+    """
+    entries = []
+    for path in [journal_path] + shard_journal_paths(journal_path):
+        entries.extend(ResultJournal(path).entries())
+    best: Dict[str, dict] = {}
+    for entry in entries:
+        current = best.get(entry["patient_id"])
+        rank = (entry.get("completed", True), entry.get("ts", 0))
+        if current is None or rank >= (current.get("completed", True), current.get("ts", 0)):
+            best[entry["patient_id"]] = entry
+
+    ordered = [] if order is None else [best.pop(pid) for pid in map(normalize_patient_id, order) if pid in best]
+    ordered += sorted(best.values(), key=lambda entry: entry.get("ts", 0))
+    tmp = f"{journal_path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        for entry in ordered:
+            f.write(json.dumps(entry, ensure_ascii=False, default=_json_default) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, journal_path)
+    return len(ordered), len(entries) - len(ordered)
+
+
+class ResultJournal:
+    """Append-only JSONL journal of per-patient result records."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def append(self, patient_id: Any, record: dict, completed: bool = True) -> None:
+        line = json.dumps(
+            {"patient_id": normalize_patient_id(patient_id), "completed": completed, "ts": time.time(),
+             "record": record},
+            ensure_ascii=False, default=_json_default,
+        )
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def entries(self) -> List[dict]:
+        """All readable entries; a torn last line from a crash is ignored."""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    continue
+        return entries
+
+    def completed_ids(self) -> Set[str]:
+        return {entry["patient_id"] for entry in self.entries() if entry.get("completed", True)}
+
+    def latest_records(self, order: Optional[Iterable[Any]] = None) -> List[dict]:
+        """Latest record per patient; with `order` (e.g. sheet order) only those patients, in that order."""
+        latest: Dict[str, dict] = {}
+        for entry in self.entries():
+            latest.pop(entry["patient_id"], None)
+            latest[entry["patient_id"]] = entry["record"]
+        if order is None:
+            return list(latest.values())
+        return [latest.pop(pid) for pid in map(normalize_patient_id, order) if pid in latest]
+
+    def rotate(self) -> Optional[str]:
+        """Start an empty journal for a fresh run; the old one is kept as <path>.prev (replacing an older one)."""
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return None
+        previous = f"{self.path}.prev"
+        with self._lock:
+            os.replace(self.path, previous)
+        return previous
+
+    def to_frame(self, order: Optional[Iterable[Any]] = None) -> pd.DataFrame:
+        """The journal in the usual one-row-per-patient layout."""
+        return pd.DataFrame(self.latest_records(order)).drop(columns=[REPLICATE_COLUMN], errors="ignore")
+
+    def export_excel(self, output_file: str, order: Optional[Iterable[Any]] = None) -> int:
+        df = self.to_frame(order)
+        df.to_excel(output_file, index=False)
+        return len(df)
+
+    def export_table(self, results_file: str, order: Optional[Iterable[Any]] = None) -> int:
+        """Write the journal as a Parquet results table (read it back with sheet_store.read_table)."""
+        df = self.to_frame(order)
+        write_table(df, results_file, {"journal": os.path.abspath(self.path)})
+        return len(df)
+
+    def save_results(self, results_file: str, output_file: str, order: Optional[Iterable[Any]] = None) -> str:
+        """End-of-run output: the Parquet table, or the Excel file when pyarrow is not installed."""
+        if columnar_available():
+            self.export_table(results_file, order)
+            return results_file
+        self.export_excel(output_file, order)
+        return output_file
+
+    def recording(self, worker: Callable[[Any], Optional[dict]], id_key: str = "Patient ID") -> Callable:
+        """Wrap a per-case worker so each non-empty result is journaled as soon as it returns."""
+        def run(item):
+            record = worker(item)
+            if record is not None:
+                self.append(record[id_key], record, completed="Error" not in record)
+            return record
+        return run
@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from typing import Any, Dict, List, Optional, Sequence
+
+# === COLUMNAR SHEET STORE ===
+# openpyxl parses the whole workbook on every pd.read_excel, which dominates the
+# startup of each script once sheets grow. The first read_sheet() of a workbook
+# converts it to Parquet under SHEET_CACHE_DIR; later reads load only the
+# requested columns from that copy. The copy records the source's size, mtime
+# and sha256: a changed size/mtime triggers a hash check, and the sheet is
+# converted again only when the content really changed.
+#
+# Excel cells mix numbers and text within a column (labels like 3 and "2+3",
+# Likert scores and "N/A"); Arrow columns are typed, so such columns are stored
+# as JSON-encoded values and decoded on read, keeping ints, floats and strings.
+
+SHEET_CACHE_DIR = os.getenv("SHEET_CACHE_DIR", ".sheet_cache")
+EXCEL_SUFFIXES = (".xlsx", ".xlsm", ".xls")
+_META_KEY = b"sheet_store"
+_HASH_CHUNK = 1 << 20
+
+_warned = False
+
+
+def _pyarrow():
+    """pyarrow.parquet, or None (with a one-time warning) when it is not installed."""
+    global _warned
+    try:
+        import pyarrow.parquet as pq
+        return pq
+    except ImportError:
+        if not _warned:
+            print("⚠️ pyarrow is not installed; reading Excel directly and writing results as Excel.")
+            _warned = True
+        return None
+
+
+def columnar_available() -> bool:
+    return _pyarrow() is not None
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# --- typed storage of mixed columns ---
+def _needs_json(series: pd.Series) -> bool:
+    return series.dtype == object and pd.api.types.infer_dtype(series, skipna=True) not in ("string", "empty")
+
+
+def _encode_json(series: pd.Series) -> pd.Series:
+    codes, uniques = pd.factorize(series)
+    encoded = [json.dumps(value.item() if hasattr(value, "item") else value, ensure_ascii=False, default=str)
+               for value in uniques]
+    return pd.Series([encoded[code] if code >= 0 else None for code in codes], index=series.index, dtype=object)
+
+
+def _decode_json(series: pd.Series) -> pd.Series:
+    codes, uniques = pd.factorize(series)
+    decoded = [json.loads(value) for value in uniques]
+    return pd.Series([decoded[code] if code >= 0 else None for code in codes], index=series.index, dtype=object)
+
+
+def write_table(df: pd.DataFrame, path: str, metadata: Optional[Dict[str, Any]] = None) -> None:
+    """Write `df` to Parquet (atomically), JSON-encoding mixed-type object columns."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    json_columns = [col for col in df.columns if _needs_json(df[col])]
+    frame = df.copy() if json_columns else df
+    for col in json_columns:
+        frame[col] = _encode_json(df[col])
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    meta = dict(metadata or {}, json_columns=json_columns)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}),
+                                           _META_KEY: json.dumps(meta, ensure_ascii=False).encode()})
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def table_metadata(path: str) -> Optional[dict]:
+    """Metadata stored by write_table, or None if the file is missing or unreadable."""
+    pq = _pyarrow()
+    if pq is None or not os.path.exists(path):
+        return None
+    try:
+        raw = (pq.read_schema(path).metadata or {}).get(_META_KEY)
+        return json.loads(raw) if raw else None
+    except Exception:
+        return None
+
+
+def table_columns(path: str) -> List[str]:
+    return list(_pyarrow().read_schema(path).names)
+
+
+def read_table(path: str, columns: Optional[Sequence[str]] = None) -> pd.DataFrame:
+    """Read a Parquet file written by write_table, loading only `columns` when given."""
+    columns = list(columns) if columns is not None else None
+    if columns is not None:
+        available = set(table_columns(path))
+        missing = [col for col in columns if col not in available]
+        if missing:
+            raise ValueError(f"❌ Column(s) {missing} not found in {path}")
+    df = pd.read_parquet(path, columns=columns)
+    for col in (table_metadata(path) or {}).get("json_columns", []):
+        if col in df.columns:
+            df[col] = _decode_json(df[col])
+    return df
+
+
+# --- Excel sheets ---
+def sheet_cache_path(path: str, sheet_name=0, cache_dir: str = SHEET_CACHE_DIR) -> str:
+    """Parquet copy of one sheet, named after the workbook plus a hash of its absolute path and sheet."""
+    key = hashlib.sha1(f"{os.path.abspath(path)}|{sheet_name}".encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}.{key}.parquet")
+
+
+def _source_stamp(path: str) -> dict:
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def cached_sheet(path: str, sheet_name=0, cache_dir: str = SHEET_CACHE_DIR) -> Optional[str]:
+    """Path of an up-to-date Parquet copy of the sheet (converting it if needed), or None if caching is off."""
+    if not cache_dir or not path.lower().endswith(EXCEL_SUFFIXES) or _pyarrow() is None:
+        return None
+    cache = sheet_cache_path(path, sheet_name, cache_dir)
+    stamp = _source_stamp(path)
+    meta = table_metadata(cache)
+    if meta is not None and all(meta.get(k) == v for k, v in stamp.items()):
+        return cache
+
+    sha256 = file_sha256(path)
+    if meta is not None and meta.get("sha256") == sha256:
+        # Touched but unchanged: keep the data, refresh the recorded stamp
+        write_table(read_table(cache), cache, {**meta, **stamp})
+        return cache
+
+    df = pd.read_excel(path, sheet_name=sheet_name)
+    if not all(isinstance(col, str) for col in df.columns):
+        print(f"⚠️ {path} has non-text column headers; not caching it as Parquet.")
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    write_table(df, cache, {"source": os.path.abspath(path), "sheet": sheet_name, "sha256": sha256, **stamp})
+    print(f"🗃️ Converted {os.path.basename(path)} to Parquet ({len(df)} rows): {cache}")
+    return cache
+
+
+def read_sheet(path: str, columns: Optional[Sequence[str]] = None, sheet_name=0,
+               cache_dir: str = SHEET_CACHE_DIR) -> pd.DataFrame:
+    """pd.read_excel replacement backed by the Parquet copy; `columns` limits what is loaded.
+
+    Parquet files are read directly; other inputs (or no pyarrow / empty cache_dir)
+    fall back to pd.read_excel.
+    """
+    if path.lower().endswith(".parquet"):
+        return read_table(path, columns)
+    cache = cached_sheet(path, sheet_name, cache_dir)
+    if cache is None:
+        return pd.read_excel(path, sheet_name=sheet_name, usecols=list(columns) if columns is not None else None)
+    return read_table(cache, columns)
+
+
+def sheet_columns(path: str, sheet_name=0, cache_dir: str = SHEET_CACHE_DIR) -> List[str]:
+    """Column names of the sheet without loading its data."""
+    if path.lower().endswith(".parquet"):
+        return table_columns(path)
+    cache = cached_sheet(path, sheet_name, cache_dir)
+    if cache is None:
+        return list(pd.read_excel(path, sheet_name=sheet_name, nrows=0).columns)
+    return table_columns(cache)
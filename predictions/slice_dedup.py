@@ -0,0 +1,181 @@
+import os
+import time
+import threading
+import numpy as np
+from typing import List, Optional, Sequence, Tuple
+from PIL import Image
+from image_cache import open_source
+
+# === NEAR-DUPLICATE SLICE ELIMINATION ===
+# Adjacent CT slices are often almost identical; sending all of them costs image
+# tokens and latency without giving the model anything new. Each slice gets a
+# 64-bit perceptual hash (dHash: brightness gradients of a 9x8 thumbnail, or
+# pHash: signs of the low-frequency DCT of a 32x32 thumbnail, both computed for
+# the whole case at once with NumPy), and a slice is dropped when its Hamming
+# distance to the last slice kept is at most SLICE_DEDUP_THRESHOLD bits. The
+# first slice of every run of near-duplicates is the one sent, so slice order is
+# preserved. Hashes are stored in the case index (keyed by file mtime/size), so
+# later runs only hash new or changed slices.
+
+HASH_METHODS = ("dhash", "phash")
+_DRAFT_SIZE = (64, 64)
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so D @ X @ D.T is the 2-D DCT of X."""
+    k = np.arange(n)[:, None]
+    basis = np.cos(np.pi * (2 * np.arange(n)[None, :] + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    basis[0] /= np.sqrt(2)
+    return basis.astype(np.float32)
+
+
+_DCT_32 = _dct_matrix(32)
+
+
+def gray_stack(sources: Sequence, size: Tuple[int, int]) -> np.ndarray:
+    """(n, height, width) float32 grayscale thumbnails; JPEGs are decoded at reduced scale."""
+    stack = np.empty((len(sources), size[1], size[0]), dtype=np.float32)
+    for i, source in enumerate(sources):
+        with open_source(source, draft_size=_DRAFT_SIZE) as img:
+            stack[i] = np.asarray(img.convert("L").resize(size, Image.BILINEAR), dtype=np.float32)
+    return stack
+
+
+def _pack(bits: np.ndarray) -> np.ndarray:
+    """(n, 64) booleans -> (n,) uint64 hashes."""
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def dhash(stack: np.ndarray) -> np.ndarray:
+    """Difference hash of (n, 8, 9) thumbnails: is each pixel darker than its right neighbour."""
+    return _pack((stack[:, :, 1:] > stack[:, :, :-1]).reshape(len(stack), 64))
+
+
+def phash(stack: np.ndarray) -> np.ndarray:
+    """Perceptual hash of (n, 32, 32) thumbnails: 8x8 lowest DCT frequencies above their median."""
+    coefficients = (_DCT_32 @ stack @ _DCT_32.T)[:, :8, :8].reshape(len(stack), 64)
+    median = np.median(coefficients[:, 1:], axis=1, keepdims=True)  # the DC term would skew it
+    return _pack(coefficients > median)
+
+
+def hash_sources(sources: Sequence, method: str = "dhash") -> np.ndarray:
+    """uint64 hash per source (slice path or rendered source such as a DICOM slice)."""
+    if not sources:
+        return np.empty(0, dtype=np.uint64)
+    if method == "dhash":
+        return dhash(gray_stack(sources, (9, 8)))
+    return phash(gray_stack(sources, (32, 32)))
+
+
+def hamming_matrix(hashes: np.ndarray) -> np.ndarray:
+    """Pairwise Hamming distances (n, n) between uint64 hashes."""
+    xor = np.bitwise_xor(hashes[:, None], hashes[None, :])
+    return np.unpackbits(xor.view(np.uint8).reshape(*xor.shape, 8), axis=-1).sum(axis=-1)
+
+
+def _source_size(source) -> int:
+    try:
+        return os.path.getsize(getattr(source, "path", source))
+    except OSError:
+        return 0
+
+
+class CaseDedup:
+    """What deduplication did to one case (attached to prepared cases that lost slices)."""
+
+    def __init__(self, method: str, threshold: int, n_slices: int, dropped: List, source_bytes: int):
+        self.method = method
+        self.threshold = threshold
+        self.n_slices = n_slices
+        self.dropped = dropped
+        self.source_bytes = source_bytes
+
+    def describe(self, images: Optional[Sequence[bytes]] = None) -> str:
+        text = (f"🧬 Dropped {len(self.dropped)} of {self.n_slices} slice(s) as near-duplicates "
+                f"({self.method} distance ≤ {self.threshold})")
+        kept = self.n_slices - len(self.dropped)
+        if images and kept:
+            # Payload bytes the dropped slices would have added at this case's average size per slice
+            text += f", ~{sum(len(data) for data in images) / kept * len(self.dropped) / 1024:.0f} KB less payload"
+        return text
+
+
+class SliceDeduper:
+    """Drops slices whose perceptual hash is within `threshold` bits of the previous slice kept."""
+
+    def __init__(self, method: str = "dhash", threshold: int = 5, index=None):
+        if method not in HASH_METHODS:
+            raise ValueError(f"❌ Unknown slice hash '{method}', expected one of {HASH_METHODS}")
+        self.method = method
+        self.threshold = threshold
+        self.index = index
+        self._lock = threading.Lock()
+        self.cases = 0
+        self.slices = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.hashed = 0
+        self.from_index = 0
+        self.seconds = 0.0
+
+    def hashes(self, sources: Sequence) -> np.ndarray:
+        """Hashes of a case's sources, read from the case index where it has them."""
+        cached = [self.index.cached_hash(source, self.method) if self.index is not None else None
+                  for source in sources]
+        missing = [i for i, value in enumerate(cached) if value is None]
+        computed = hash_sources([sources[i] for i in missing], self.method)
+        for i, value in zip(missing, computed):
+            cached[i] = int(value)
+            if self.index is not None:
+                self.index.store_hash(sources[i], self.method, int(value))
+        with self._lock:
+            self.hashed += len(missing)
+            self.from_index += len(sources) - len(missing)
+        return np.array(cached, dtype=np.uint64)
+
+    def filter(self, sources: Sequence) -> Tuple[list, Optional[CaseDedup]]:
+        """(kept sources in order, CaseDedup or None when nothing was dropped)."""
+        sources = list(sources)
+        if len(sources) < 2:
+            return sources, None
+        start = time.perf_counter()
+        distances = hamming_matrix(self.hashes(sources))
+        kept, dropped = [0], []
+        for i in range(1, len(sources)):
+            if distances[i, kept[-1]] <= self.threshold:
+                dropped.append(sources[i])
+            else:
+                kept.append(i)
+        source_bytes = sum(_source_size(source) for source in dropped)
+        with self._lock:
+            self.cases += 1
+            self.slices += len(sources)
+            self.dropped += len(dropped)
+            self.dropped_bytes += source_bytes
+            self.seconds += time.perf_counter() - start
+        if not dropped:
+            return sources, None
+        return [sources[i] for i in kept], CaseDedup(self.method, self.threshold, len(sources), dropped, source_bytes)
+
+    def save(self) -> None:
+        """Persist newly computed hashes with the case index."""
+        if self.index is not None and self.hashed:
+            self.index.save()
+
+    def summary(self) -> str:
+        if not self.cases:
+            return f"🧬 Slice dedup ({self.method} ≤ {self.threshold}): no multi-slice cases"
+        return (
+            f"🧬 Slice dedup ({self.method} ≤ {self.threshold}): dropped {self.dropped} of {self.slices} slice(s) "
+            f"({100 * self.dropped / self.slices:.1f}%) in {self.cases} case(s), "
+            f"{self.dropped_bytes / 1024 ** 2:.1f} MB of source images not encoded or sent; "
+            f"{self.hashed} hash(es) computed, {self.from_index} from the index, {self.seconds:.2f}s"
+        )
+
+
+def open_slice_deduper(index=None) -> Optional[SliceDeduper]:
+    """Deduper configured from SLICE_DEDUP (off / dhash / phash) and SLICE_DEDUP_THRESHOLD, or None."""
+    method = os.getenv("SLICE_DEDUP", "off").lower()
+    if method in ("", "0", "off", "false", "no"):
+        return None
+    return SliceDeduper(method, threshold=int(os.getenv("SLICE_DEDUP_THRESHOLD", "5")), index=index)
@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import copy
+from typing import Optional
+from response_parser import RESULT_COLUMNS, parse_response
+from telemetry import stage
+
+# === STRUCTURED (JSON) OUTPUT MODE ===
+# Instead of free text, the model is asked for a compact JSON object holding the
+# categories and Likert score for both conditions. Categories come back in the
+# "2+3" form used by the rater sheet; anything that fails validation (and every
+# free-text answer) goes through the shared regex parser in response_parser.py.
+
+STRUCTURED_MAX_TOKENS = 300
+CONDITIONS = ("without_history", "with_history")
+CATEGORY_CODES = (1, 2, 3, 4, 5)
+
+_CONDITION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "categories": {"type": "array", "items": {"type": "integer", "enum": list(CATEGORY_CODES)}},
+        "likert": {"type": "integer", "enum": [1, 2, 3, 4, 5]},
+        "reasoning": {"type": ["string", "null"]},
+    },
+    "required": ["categories", "likert", "reasoning"],
+    "additionalProperties": False,
+}
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {condition: _CONDITION_SCHEMA for condition in CONDITIONS},
+    "required": list(CONDITIONS),
+    "additionalProperties": False,
+}
+
+STRUCTURED_INSTRUCTIONS = (
+    "\n\nAnswer ONLY with a JSON object of this form (no other text):\n"
+    '{"without_history": {"categories": [2, 3], "likert": 3, "reasoning": "max. 1 short sentence"}, '
+    '"with_history": {"categories": [3], "likert": 4, "reasoning": "max. 1 short sentence"}}\n'
+    "categories: one or more of 1-5; likert: your confidence from 1 (low) to 5 (high)."
+)
+
+_CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+
+
+def structured_enabled() -> bool:
+    return os.getenv("STRUCTURED_OUTPUT", "0").lower() in ("1", "true", "yes")
+
+
+# --- provider request parameters ---
+def openai_response_format() -> dict:
+    """`response_format` for OpenAI and the OpenAI-compatible xAI endpoint (strict JSON schema)."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": "hemorrhage_classification", "strict": True, "schema": RESPONSE_SCHEMA},
+    }
+
+
+def _to_gemini_schema(schema: dict) -> dict:
+    """Gemini accepts an OpenAPI subset: no additionalProperties, no integer enums, nullable flag."""
+    schema = copy.deepcopy(schema)
+    schema.pop("additionalProperties", None)
+    if isinstance(schema.get("type"), list):
+        types = [t for t in schema["type"] if t != "null"]
+        schema["type"] = types[0]
+        schema["nullable"] = True
+    if schema.get("type") == "integer":
+        schema.pop("enum", None)
+    if "properties" in schema:
+        schema["properties"] = {k: _to_gemini_schema(v) for k, v in schema["properties"].items()}
+    if "items" in schema:
+        schema["items"] = _to_gemini_schema(schema["items"])
+    return schema
+
+
+def gemini_generation_config(temperature: float) -> dict:
+    return {
+        "temperature": temperature,
+        "max_output_tokens": STRUCTURED_MAX_TOKENS,
+        "response_mime_type": "application/json",
+        "response_schema": _to_gemini_schema(RESPONSE_SCHEMA),
+    }
+
+
+# --- validating parser ---
+def parse_structured(text: str) -> Optional[dict]:
+    """Validate a JSON answer; returns {"without_history": {...}, "with_history": {...}} or None.
+
+    Each condition is normalized to {"categories": "2+3", "likert": 3, "reasoning": str or None}.
+    """
+    if not isinstance(text, str):
+        return None
+    try:
+        data = json.loads(_CODE_FENCE.sub("", text))
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+
+    parsed = {}
+    for condition in CONDITIONS:
+        block = data.get(condition)
+        if not isinstance(block, dict):
+            return None
+        categories = block.get("categories")
+        if isinstance(categories, int):
+            categories = [categories]
+        if (not isinstance(categories, list) or not categories
+                or not all(isinstance(c, int) and c in CATEGORY_CODES for c in categories)):
+            return None
+        likert = block.get("likert")
+        if not isinstance(likert, int) or isinstance(likert, bool) or not 1 <= likert <= 5:
+            return None
+        reasoning = block.get("reasoning")
+        parsed[condition] = {
+            "categories": "+".join(str(c) for c in sorted(set(categories))),
+            "likert": likert,
+            "reasoning": reasoning if isinstance(reasoning, str) else None,
+        }
+    return parsed
+
+
+def result_columns(text: str, structured: bool = True) -> dict:
+    """Category and Likert columns for the output sheet, from JSON or the free-text parser ("N/A" if missing)."""
+    with stage("parse"):
+        parsed = parse_structured(text) if structured else None
+        if parsed is None:
+            return {col: "N/A" if value is None else value for col, value in parse_response(text).items()}
+    return dict(zip(RESULT_COLUMNS, (
+        parsed["without_history"]["categories"], parsed["with_history"]["categories"],
+        parsed["without_history"]["likert"], parsed["with_history"]["likert"],
+    )))
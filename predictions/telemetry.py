@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# === PER-STAGE TELEMETRY ===
+# Timings per pipeline stage (sheet load, discovery, decode, encode, request,
+# throttle, retry_sleep, parse, case), token usage and estimated cost per case.
+# The case being processed lives in a contextvar set by `instrument()` on the
+# worker thread, so the rate limiter, the providers and the parser attribute
+# their measurements to the right case without a handle being passed around.
+# Per-case records go to a JSONL file, run totals to a Prometheus text file
+# (node-exporter textfile format), and `summary()` prints latency histograms.
+
+# Histogram buckets in seconds (upper bounds; +Inf is implicit)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# USD per 1M (prompt, completion) tokens; override or extend with MODEL_PRICES='{"model": [in, out]}'
+MODEL_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o": (2.50, 10.00),
+    "grok-4-fast-reasoning": (0.20, 0.50),
+    "gemini-1.5-pro": (1.25, 5.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+}
+
+_CASE: ContextVar[Optional["CaseTrace"]] = ContextVar("telemetry_case", default=None)
+_SPARK = " ▁▂▃▄▅▆▇█"
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def _format_seconds(seconds: float) -> str:
+    return f"{seconds * 1000:.0f} ms" if seconds < 1 else f"{seconds:.2f} s"
+
+
+def _labels(**labels) -> str:
+    return ",".join(f'{key}="{str(value).replace(chr(34), chr(39))}"' for key, value in labels.items())
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram that also keeps raw values for percentiles."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.values: List[float] = []
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.values.append(seconds)
+
+    def sparkline(self) -> str:
+        # Trim empty buckets at both ends so the shape stays readable
+        used = [i for i, count in enumerate(self.counts) if count]
+        counts = self.counts[used[0]:used[-1] + 1] if used else []
+        peak = max(counts, default=0)
+        return "".join(_SPARK[0 if not c else max(1, round(c / peak * (len(_SPARK) - 1)))] for c in counts)
+
+    def bounds(self) -> Tuple[str, str]:
+        """Labels of the first and last non-empty bucket (for the sparkline)."""
+        used = [i for i, count in enumerate(self.counts) if count]
+        label = lambda i: f"≤{_format_seconds(BUCKETS[i])}" if i < len(BUCKETS) else f">{_format_seconds(BUCKETS[-1])}"
+        return (label(used[0]), label(used[-1])) if used else ("", "")
+
+
+class CaseTrace:
+    """Measurements of one case while it is being processed."""
+
+    def __init__(self, telemetry: "Telemetry", case_id: Any):
+        self.telemetry = telemetry
+        self.case_id = case_id
+        self.stages: Dict[str, float] = {}
+        self.counts: Dict[str, int] = {}
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cost_usd = 0.0
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + 1
+
+
+class Telemetry:
+    """Stage histograms, token and cost counters for one provider run."""
+
+    def __init__(self, provider: str, jsonl_path: Optional[str] = None, metrics_path: Optional[str] = None,
+                 prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.provider = provider
+        self.jsonl_path = jsonl_path
+        self.metrics_path = metrics_path
+        self.prices = dict(MODEL_PRICES, **(prices or {}))
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Histogram] = {}
+        self.tokens: Dict[Tuple[str, str], int] = {}  # (model, "prompt" / "completion") -> tokens
+        self.cost: Dict[str, float] = {}
+        self.cases: Dict[str, int] = {}  # status -> count
+
+    # --- recording ---
+    def observe(self, stage: str, seconds: float) -> None:
+        """Record one duration for `stage`, and add it to the current case if it belongs to this run."""
+        trace = _CASE.get()
+        with self._lock:  # replicate samples of one case record into the same trace from several threads
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+            if trace is not None and trace.telemetry is self:
+                trace.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def estimate_cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        price_in, price_out = self.prices.get(model, (0.0, 0.0))
+        return (prompt_tokens * price_in + completion_tokens * price_out) / 1e6
+
+    def record_usage(self, model: str, prompt_tokens: Optional[int], completion_tokens: Optional[int],
+                     price_factor: float = 1.0) -> None:
+        """Token usage reported by the provider for one (successful) request.
+
+        `price_factor` scales the estimated cost, e.g. 0.5 for discounted batch requests.
+        """
+        prompt_tokens, completion_tokens = int(prompt_tokens or 0), int(completion_tokens or 0)
+        cost = self.estimate_cost(model, prompt_tokens, completion_tokens) * price_factor
+        trace = _CASE.get()
+        with self._lock:
+            self.tokens[(model, "prompt")] = self.tokens.get((model, "prompt"), 0) + prompt_tokens
+            self.tokens[(model, "completion")] = self.tokens.get((model, "completion"), 0) + completion_tokens
+            self.cost[model] = self.cost.get(model, 0.0) + cost
+            if trace is not None and trace.telemetry is self:
+                trace.prompt_tokens += prompt_tokens
+                trace.completion_tokens += completion_tokens
+                trace.cost_usd += cost
+
+    def instrument(self, worker: Callable[[Any], Optional[dict]],
+                   case_id: Callable[[Any], Any]) -> Callable[[Any], Optional[dict]]:
+        """Wrap a per-case worker: trace the case, add its preprocessing timings and write its record."""
+        def run(prepared):
+            trace = CaseTrace(self, case_id(prepared))
+            token = _CASE.set(trace)
+            start = time.perf_counter()
+            result, status = None, "error"
+            try:
+                # Preprocessing ran ahead of the case; only its totals are attached (no per-slice counts)
+                for stage, seconds in (prepared.get("timings") or {}).items():
+                    trace.stages[stage] = trace.stages.get(stage, 0.0) + seconds
+                result = worker(prepared)
+                status = "no_result" if result is None else ("error" if "Error" in result else "ok")
+                return result
+            finally:
+                seconds = time.perf_counter() - start
+                _CASE.reset(token)
+                self.observe("case", seconds)
+                self._finish(trace, status, seconds)
+        return run
+
+    def _finish(self, trace: CaseTrace, status: str, seconds: float) -> None:
+        with self._lock:
+            self.cases[status] = self.cases.get(status, 0) + 1
+            if not self.jsonl_path:
+                return
+            record = {
+                "ts": time.time(), "provider": self.provider, "case": trace.case_id, "status": status,
+                "seconds": round(seconds, 6), "stages": {k: round(v, 6) for k, v in trace.stages.items()},
+                "counts": trace.counts, "prompt_tokens": trace.prompt_tokens,
+                "completion_tokens": trace.completion_tokens, "cost_usd": round(trace.cost_usd, 6),
+            }
+            with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    # --- output ---
+    def prometheus_text(self) -> str:
+        p = _labels(provider=self.provider)
+        lines = ["# HELP ct_pipeline_stage_seconds Time spent per pipeline stage.",
+                 "# TYPE ct_pipeline_stage_seconds histogram"]
+        with self._lock:
+            for stage, hist in sorted(self.histograms.items()):
+                labels = f"{p},{_labels(stage=stage)}"
+                cumulative = 0
+                for bound, count in zip(BUCKETS + (float("inf"),), hist.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f'ct_pipeline_stage_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                lines.append(f"ct_pipeline_stage_seconds_sum{{{labels}}} {sum(hist.values):.6f}")
+                lines.append(f"ct_pipeline_stage_seconds_count{{{labels}}} {len(hist.values)}")
+            lines += ["# HELP ct_pipeline_cases_total Cases processed by status.", "# TYPE ct_pipeline_cases_total counter"]
+            lines += [f"ct_pipeline_cases_total{{{p},{_labels(status=s)}}} {n}" for s, n in sorted(self.cases.items())]
+            lines += ["# HELP ct_llm_tokens_total Tokens reported by the provider.", "# TYPE ct_llm_tokens_total counter"]
+            lines += [f"ct_llm_tokens_total{{{p},{_labels(model=m, type=t)}}} {n}"
+                      for (m, t), n in sorted(self.tokens.items())]
+            lines += ["# HELP ct_llm_cost_usd_total Estimated cost from MODEL_PRICES.",
+                      "# TYPE ct_llm_cost_usd_total counter"]
+            lines += [f"ct_llm_cost_usd_total{{{p},{_labels(model=m)}}} {c:.6f}" for m, c in sorted(self.cost.items())]
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self) -> Optional[str]:
+        """Write the Prometheus text file (atomically, so a collector never reads half a file)."""
+        if not self.metrics_path:
+            return None
+        tmp_path = f"{self.metrics_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, self.metrics_path)
+        return self.metrics_path
+
+    def summary(self) -> str:
+        """Per-stage latency histogram lines plus token and cost totals."""
+        lines = [f"📈 Telemetry ({self.provider}):"]
+        with self._lock:
+            width = max((len(stage) for stage in self.histograms), default=0)
+            for stage, hist in self.histograms.items():
+                low, high = hist.bounds()
+                lines.append(
+                    f"   {stage:<{width}}  n={len(hist.values):<5} p50 {_format_seconds(_percentile(hist.values, 50)):>8}"
+                    f"  p95 {_format_seconds(_percentile(hist.values, 95)):>8}"
+                    f"  max {_format_seconds(max(hist.values)):>8}  {low} {hist.sparkline()} {high}"
+                )
+            prompt = sum(n for (_, kind), n in self.tokens.items() if kind == "prompt")
+            completion = sum(n for (_, kind), n in self.tokens.items() if kind == "completion")
+            cost = sum(self.cost.values())
+        lines.append(f"   tokens: {prompt} prompt + {completion} completion, est. cost ${cost:.4f}")
+        return "\n".join(lines)
+
+
+# --- helpers for code that only sees the current case (limiter, parser) ---
+def current_telemetry() -> Optional[Telemetry]:
+    trace = _CASE.get()
+    return trace.telemetry if trace is not None else None
+
+
+def observe(stage: str, seconds: float) -> None:
+    telemetry = current_telemetry()
+    if telemetry is not None:
+        telemetry.observe(stage, seconds)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a block for the current case's telemetry (no-op outside an instrumented case)."""
+    telemetry = current_telemetry()
+    if telemetry is None:
+        yield
+        return
+    with telemetry.stage(name):
+        yield
+
+
+def default_telemetry_paths(output_file: str, provider: str) -> Tuple[str, str]:
+    """Per-provider JSONL and Prometheus files next to OUTPUT_FILE."""
+    stem = os.path.splitext(output_file)[0]
+    return f"{stem}.{provider}.telemetry.jsonl", f"{stem}.{provider}.prom"
+
+
+def open_telemetry(provider: str, output_file: str) -> Telemetry:
+    """Telemetry configured from TELEMETRY_FILE / METRICS_FILE (empty disables a file) and MODEL_PRICES."""
+    jsonl_default, metrics_default = default_telemetry_paths(output_file, provider)
+    prices = {model: tuple(price) for model, price in json.loads(os.getenv("MODEL_PRICES") or "{}").items()}
+    return Telemetry(
+        provider,
+        jsonl_path=os.getenv("TELEMETRY_FILE", jsonl_default) or None,
+        metrics_path=os.getenv("METRICS_FILE", metrics_default) or None,
+        prices=prices,
+    )
@@ -0,0 +1,334 @@
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from dotenv import load_dotenv
+from async_dispatch import InFlightTracker, run_dispatch
+from case_index import load_case_index, normalize_patient_id
+from dicom_series import case_sources
+from multi_provider import PROVIDER_SCRIPTS, load_providers
+from preprocess import open_preprocess_pipeline
+from replicates import save_replicates
+from result_journal import ResultJournal, consolidate_journals, shard_journal_path
+from sheet_store import read_sheet
+
+# === SHARDED RUNS OVER A SHARED WORK QUEUE ===
+# Any number of worker processes, on one host or on several hosts sharing a
+# filesystem, claim cases from one SQLite queue. A claim is a lease: workers
+# renew their leases while they hold them, and a case whose lease ran out (the
+# worker crashed or lost the filesystem) is claimed again by someone else.
+# Every worker journals into its own shard next to the provider's journal;
+# `merge` folds the shards into the journal (one entry per patient) and writes
+# the results table in "Reihenfolge Bilder" order.
+#
+#   python predictions/work_queue.py work --provider gpt4o     # start as many as you like
+#   python predictions/work_queue.py status --provider gpt4o
+#   python predictions/work_queue.py merge --provider gpt4o
+#
+# Note: SQLite locking needs a filesystem with working POSIX locks (local disks,
+# NFSv4 with locking enabled); the queue uses the rollback journal, not WAL,
+# so that several hosts can share it.
+
+STATUSES = ("pending", "leased", "done", "failed")
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Leased case queue in SQLite, one row per (provider, patient)."""
+
+    def __init__(self, path: str, lease_seconds: float = 600, max_attempts: int = 3):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        # Autocommit mode; claims open their own BEGIN IMMEDIATE transaction
+        self._db = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cases (provider TEXT, patient_id TEXT, position INTEGER, "
+            "status TEXT DEFAULT 'pending', worker TEXT, lease_until REAL, attempts INTEGER DEFAULT 0, "
+            "updated REAL, PRIMARY KEY (provider, patient_id))"
+        )
+
+    def enqueue(self, provider: str, patient_ids: Iterable[Any], retry_failed: bool = False) -> int:
+        """Add patients in sheet order (already queued ones are left alone); returns how many were new."""
+        rows = [(provider, normalize_patient_id(pid), position, time.time())
+                for position, pid in enumerate(patient_ids)]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.executemany(
+                "INSERT OR IGNORE INTO cases (provider, patient_id, position, updated) VALUES (?, ?, ?, ?)", rows
+            )
+            added = self._db.total_changes - before
+            if retry_failed:
+                self._db.execute(
+                    "UPDATE cases SET status = 'pending', attempts = 0, worker = NULL, lease_until = NULL "
+                    "WHERE provider = ? AND status = 'failed'", (provider,)
+                )
+            self._db.execute("COMMIT")
+        return added
+
+    def claim(self, provider: str, worker: str, limit: int = 1) -> List[str]:
+        """Lease up to `limit` pending (or expired) cases in sheet order to `worker`."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                # Expired leases that used up their attempts are given up on
+                self._db.execute(
+                    "UPDATE cases SET status = 'failed', updated = ? WHERE provider = ? AND status = 'leased' "
+                    "AND lease_until < ? AND attempts >= ?", (now, provider, now, self.max_attempts)
+                )
+                ids = [row[0] for row in self._db.execute(
+                    "SELECT patient_id FROM cases WHERE provider = ? AND (status = 'pending' OR "
+                    "(status = 'leased' AND lease_until < ?)) ORDER BY position LIMIT ?", (provider, now, limit)
+                )]
+                self._db.executemany(
+                    "UPDATE cases SET status = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                    "updated = ? WHERE provider = ? AND patient_id = ?",
+                    [(worker, now + self.lease_seconds, now, provider, pid) for pid in ids]
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def renew(self, worker: str) -> int:
+        """Extend every lease `worker` still holds; returns how many."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE cases SET lease_until = ? WHERE worker = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, worker)
+            )
+        return cursor.rowcount
+
+    def complete(self, provider: str, patient_id: Any, worker: str, failed: bool = False) -> bool:
+        """Mark a case answered (`failed=True`: answered with an error that a retry will not fix).
+
+        Only the worker holding the lease can do so; returns False if the lease ran out and
+        another worker has claimed the case since.
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE cases SET status = ?, lease_until = NULL, updated = ? "
+                "WHERE provider = ? AND patient_id = ? AND worker = ? AND status = 'leased'",
+                ("failed" if failed else "done", time.time(), provider, normalize_patient_id(patient_id), worker)
+            )
+        return cursor.rowcount > 0
+
+    def retry(self, provider: str, patient_id: Any, worker: str) -> None:
+        """Hand a case that got no answer back to the queue, or give up after max_attempts."""
+        with self._lock:
+            self._db.execute(
+                "UPDATE cases SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "lease_until = NULL, updated = ? WHERE provider = ? AND patient_id = ? AND worker = ? "
+                "AND status = 'leased'",
+                (self.max_attempts, time.time(), provider, normalize_patient_id(patient_id), worker)
+            )
+
+    def release(self, worker: str) -> int:
+        """Return the unfinished leases of a worker that is shutting down (attempt not counted)."""
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE cases SET status = 'pending', attempts = MAX(attempts - 1, 0), lease_until = NULL, "
+                "updated = ? WHERE worker = ? AND status = 'leased'", (time.time(), worker)
+            )
+        return cursor.rowcount
+
+    def counts(self, provider: str) -> Dict[str, int]:
+        counts = dict.fromkeys(STATUSES, 0)
+        with self._lock:
+            for status, n in self._db.execute(
+                    "SELECT status, COUNT(*) FROM cases WHERE provider = ? GROUP BY status", (provider,)):
+                counts[status] = n
+        return counts
+
+    def claimable(self, provider: str) -> int:
+        """Pending cases plus leased ones whose lease has expired."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM cases WHERE provider = ? AND (status = 'pending' OR "
+                "(status = 'leased' AND lease_until < ?))", (provider, time.time())
+            ).fetchone()[0]
+
+    def active_leases(self, provider: str, worker: str) -> int:
+        """Leases held by workers other than `worker` that have not expired yet."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM cases WHERE provider = ? AND status = 'leased' AND lease_until >= ? "
+                "AND worker != ?", (provider, time.time(), worker)
+            ).fetchone()[0]
+
+    def summary(self, provider: str) -> str:
+        counts = self.counts(provider)
+        return "🧾 Queue ({}): {}".format(provider, ", ".join(f"{n} {status}" for status, n in counts.items()))
+
+    def close(self) -> None:
+        self._db.close()
+
+
+def default_queue_path(output_file: str) -> str:
+    """One queue per run next to OUTPUT_FILE (providers share it, keyed by provider)."""
+    return f"{os.path.splitext(output_file)[0]}.queue.sqlite"
+
+
+def open_work_queue(output_file: str) -> WorkQueue:
+    """Queue configured from WORK_QUEUE_FILE / WORK_LEASE_SECONDS / WORK_MAX_ATTEMPTS."""
+    return WorkQueue(
+        os.getenv("WORK_QUEUE_FILE") or default_queue_path(output_file),
+        lease_seconds=float(os.getenv("WORK_LEASE_SECONDS", "600")),
+        max_attempts=int(os.getenv("WORK_MAX_ATTEMPTS", "3")),
+    )
+
+
+class LeaseKeeper:
+    """Background thread renewing a worker's leases every lease_seconds / 3."""
+
+    def __init__(self, queue: WorkQueue, worker: str):
+        self.queue = queue
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            try:
+                self.queue.renew(self.worker)
+            except sqlite3.Error as e:
+                print(f"⚠️ Lease renewal failed for {self.worker}: {e}")
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def claimed_rows(queue: WorkQueue, provider: str, worker: str, rows_by_id: Dict[str, Any]) -> Iterator[Any]:
+    """Yield sheet rows as they are claimed, until nothing is claimable right now."""
+    while True:
+        ids = queue.claim(provider, worker)
+        if not ids:
+            return
+        for pid in ids:
+            if pid in rows_by_id:
+                yield rows_by_id[pid]
+            else:
+                queue.complete(provider, pid, worker, failed=True)
+                print(f"⚠️ Patient{pid} is queued but not in the sheet; marked failed")
+
+
+# === WORKER ===
+def run_worker(provider: str, worker: Optional[str] = None, poll_seconds: float = 5) -> None:
+    """Claim and process cases of `provider` until the queue is drained."""
+    module = load_providers([provider])[provider]
+    spec = PROVIDER_SCRIPTS[provider]
+    worker = worker or default_worker_id()
+    queue = open_work_queue(module.OUTPUT_FILE)
+
+    df = read_sheet(module.EXCEL_PATH)
+    ids = df["Reihenfolge Bilder"].map(normalize_patient_id)
+    added = queue.enqueue(provider, ids)  # idempotent: the first worker fills the queue
+    if added:
+        print(f"🧾 Queued {added} case(s) for {provider} in {queue.path}")
+    rows_by_id = {pid: row for pid, (_, row) in zip(ids, df.iterrows())}
+
+    index = load_case_index(module.IMAGES_FOLDER, module.CASE_INDEX_FILE)
+    pipeline = open_preprocess_pipeline(module.IMAGE_CACHE, getattr(module, spec["payload"]),
+                                        telemetry=module.TELEMETRY, index=index)
+    journal = ResultJournal(shard_journal_path(module.JOURNAL_FILE, worker))
+    traced = journal.recording(module.TELEMETRY.instrument(
+        module.process_case, lambda prepared: prepared["item"]["Reihenfolge Bilder"]))
+
+    def process(prepared):
+        patient_id = prepared["item"]["Reihenfolge Bilder"]
+        record = None
+        try:
+            record = traced(prepared)
+        finally:
+            if record is None:
+                queue.retry(provider, patient_id, worker)
+            elif not queue.complete(provider, patient_id, worker, failed="Error" in record):
+                print(f"⚠️ Lease on Patient{patient_id} ran out before the answer arrived; another worker owns it now")
+        return record
+
+    print(f"👷 Worker {worker} processing {provider} cases from {queue.path}")
+    tracker = InFlightTracker()
+    try:
+        with LeaseKeeper(queue, worker):
+            # A pass ends when nothing is claimable. Cases handed back by `retry` start another
+            # pass; while other workers hold live leases keep polling, so the cases of a worker
+            # that crashed are picked up once its leases expire.
+            while True:
+                prepared_cases = pipeline.stream(
+                    claimed_rows(queue, provider, worker, rows_by_id),
+                    lambda row: case_sources(index, row["Reihenfolge Bilder"], module.DICOM_WINDOW, module.DICOM_SLICES)
+                )
+                run_dispatch(
+                    prepared_cases, process, concurrency=getattr(module, spec["concurrency"]),
+                    key=lambda prepared: f"Patient{prepared['item']['Reihenfolge Bilder']}", tracker=tracker
+                )
+                if queue.claimable(provider):
+                    continue
+                if not queue.active_leases(provider, worker):
+                    break
+                time.sleep(poll_seconds)
+    finally:
+        released = queue.release(worker)
+        if released:
+            print(f"↩️ Released {released} unfinished lease(s)")
+
+    print(f"\n📊 Worker {worker}: {tracker.completed} case(s) processed, journal {journal.path}")
+    print(queue.summary(provider))
+    print(pipeline.timing_summary())
+    print(getattr(module, spec["limiter"]).summary())
+    print(module.TELEMETRY.summary())
+
+
+# === MERGE ===
+def merge_results(provider: str) -> str:
+    """Fold all worker shards into the provider's journal and write its results in sheet order."""
+    module = load_providers([provider])[provider]
+    order = read_sheet(module.EXCEL_PATH, columns=["Reihenfolge Bilder"])["Reihenfolge Bilder"]
+    patients, dropped = consolidate_journals(module.JOURNAL_FILE, order)
+    print(f"🧩 Merged {patients} patient(s) into {module.JOURNAL_FILE} ({dropped} superseded entr(ies) dropped)")
+    journal = ResultJournal(module.JOURNAL_FILE)
+    saved = journal.save_results(module.RESULTS_FILE, module.OUTPUT_FILE, order=order)
+    print(f"📁 Results saved to: {saved}")
+    replicates = save_replicates(journal, module.REPLICATES_FILE, order=order)
+    if replicates:
+        print(f"🔁 Replicates saved to: {replicates}")
+    return saved
+
+
+# === RUN SCRIPT ===
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Sharded runs: workers claim cases from a shared SQLite queue.")
+    parser.add_argument("command", choices=("work", "status", "merge", "requeue"),
+                        help="work: process cases; status: queue counts; merge: assemble results; "
+                             "requeue: put failed cases back")
+    parser.add_argument("--provider", required=True, help="gpt4o, gemini or grok")
+    parser.add_argument("--worker-id", help="Worker name (default <hostname>-<pid>).")
+    parser.add_argument("--poll", type=float, default=5, help="Seconds between claims while others hold leases.")
+    args = parser.parse_args()
+
+    if args.command == "work":
+        run_worker(args.provider, args.worker_id, args.poll)
+    elif args.command == "merge":
+        merge_results(args.provider)
+    else:
+        # The queue lives next to the provider script's OUTPUT_FILE, as for `work`
+        queue = open_work_queue(load_providers([args.provider])[args.provider].OUTPUT_FILE)
+        if args.command == "requeue":
+            queue.enqueue(args.provider, [], retry_failed=True)
+        print(queue.summary(args.provider))
@@ -0,0 +1,54 @@
+import os
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+import mock_llm_server
+from async_dispatch import InFlightTracker, run_dispatch
+
+# -------- DISPATCH AGAINST THE MOCK SERVER --------
+# Every case is one chat completion against the local stub, which adds a fixed
+# latency per request and counts how many requests it holds at once.
+
+LATENCY = 0.2
+CASES = 12
+CONCURRENCY = 4
+
+
+def ask(url: str, item: int) -> int:
+    response = requests.post(f"{url}/chat/completions", timeout=10, json={
+        "model": "gpt-4o",
+        "messages": [{"role": "user", "content": f"Patient{item}"}],
+    })
+    response.raise_for_status()
+    return item
+
+
+def test_dispatch_keeps_order_bounds_concurrency_and_overlaps_requests():
+    items = list(range(CASES))
+    tracker = InFlightTracker()
+    with mock_llm_server.running(latency=LATENCY) as (url, server):
+        start = time.perf_counter()
+        results = run_dispatch(items, lambda item: ask(url, item), concurrency=CONCURRENCY, tracker=tracker)
+        elapsed = time.perf_counter() - start
+        served = server.state.snapshot()
+
+    assert results == items
+    assert served["requests"] == CASES
+    assert tracker.peak <= CONCURRENCY
+    assert served["peak_in_flight"] <= CONCURRENCY
+    # Sequential would take CASES * LATENCY (2.4 s); four in flight need about a quarter of that
+    assert elapsed < CASES * LATENCY / 2
+
+
+def test_dispatch_releases_the_slot_when_the_key_fails():
+    def key(item):
+        if item == 1:
+            raise KeyError(item)
+        return item
+
+    # With a single slot, a leaked semaphore would hang on the next case
+    results = run_dispatch([0, 1, 2], lambda item: item * 10, concurrency=1, key=key)
+
+    assert results == [0, None, 20]
@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+from types import SimpleNamespace
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "predictions"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+import batch_mode
+from batch_mode import BatchRun, ChunkWriter
+from result_journal import ResultJournal
+from synthetic import write_cohort
+
+# -------- BATCH FILES --------
+
+
+def read_lines(path: str) -> list:
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def request_body(n: int) -> dict:
+    return {"model": "gpt-4o", "messages": [{"role": "user", "content": "x" * n}]}
+
+
+def test_chunks_split_at_the_request_limit(tmp_path):
+    writer = ChunkWriter(str(tmp_path), first_part=2, max_requests=3, max_bytes=10 ** 6, structured=False)
+    for pid in range(1, 8):
+        writer.add(f"Patient{pid}", request_body(10), str(pid), n_images=4)
+    writer.close()
+
+    assert [os.path.basename(chunk["file"]) for chunk in writer.chunks] == [
+        "part-0003.jsonl", "part-0004.jsonl", "part-0005.jsonl"]
+    assert [chunk["requests"] for chunk in writer.chunks] == [3, 3, 1]
+    assert list(writer.chunks[1]["cases"]) == ["4", "5", "6"]
+    assert writer.chunks[1]["cases"]["4"] == {"custom_id": "Patient4", "images": 4}
+    for chunk in writer.chunks:
+        lines = read_lines(chunk["file"])
+        assert [line["custom_id"] for line in lines] == [case["custom_id"] for case in chunk["cases"].values()]
+        assert os.path.getsize(chunk["file"]) == chunk["bytes"]
+        assert lines[0]["url"] == batch_mode.BATCH_ENDPOINT and chunk["model"] == "gpt-4o"
+
+
+def test_chunks_split_at_the_size_limit(tmp_path):
+    writer = ChunkWriter(str(tmp_path), first_part=0, max_requests=100, max_bytes=2_500, structured=True)
+    for pid in range(1, 6):
+        writer.add(f"Patient{pid}", request_body(1_000), str(pid), n_images=1)
+    writer.add("Patient6", request_body(5_000), "6", n_images=1)  # alone above the limit: own file
+    writer.close()
+
+    assert [chunk["requests"] for chunk in writer.chunks] == [2, 2, 1, 1]
+    assert all(chunk["bytes"] <= 2_500 for chunk in writer.chunks[:3])
+    assert writer.chunks[3]["bytes"] > 5_000 and writer.chunks[3]["structured"]
+
+
+# -------- PREPARE, THEN INGEST CANNED OUTPUT --------
+
+ANSWER = ("Without medical history:\n- Category: 2+3\n- Likert confidence: 3\n\n"
+          "With medical history:\n- Category: 3\n- Likert confidence: 4\n")
+
+
+def output_line(custom_id: str, text: str) -> dict:
+    return {"custom_id": custom_id, "response": {"status_code": 200, "body": {
+        "model": "gpt-4o-2024-08-06", "choices": [{"message": {"role": "assistant", "content": text}}],
+        "usage": {"prompt_tokens": 900, "completion_tokens": 40}}}}
+
+
+def error_line(custom_id: str) -> dict:
+    return {"custom_id": custom_id, "response": {"status_code": 400, "body": {
+        "error": {"message": "Invalid image", "type": "invalid_request_error"}}}}
+
+
+def jsonl(*lines: dict) -> str:
+    return "".join(json.dumps(line) + "\n" for line in lines)
+
+
+class FakeFiles:
+    """Files API returning canned JSONL by file id."""
+
+    def __init__(self, contents: dict):
+        self.contents = contents
+
+    def content(self, file_id: str):
+        return SimpleNamespace(text=self.contents[file_id])
+
+
+@pytest.fixture
+def batch_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # relative defaults such as .sheet_cache end up here
+    paths = write_cohort(str(tmp_path), n_patients=5, slices_per_patient=2, size=64, seed=1)
+    env = {**paths, "OUTPUT_FILE": str(tmp_path / "out.xlsx"), "CASE_INDEX_FILE": str(tmp_path / "case_index.json"),
+           "IMAGE_CACHE_DIR": str(tmp_path / ".image_cache"), "OPENAI_API_KEY": "test", "STRUCTURED_OUTPUT": "0",
+           "REPLICATES": "1", "RESPONSE_CACHE_MODE": "off"}
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    for name in ("JOURNAL_FILE", "RESULTS_FILE", "REPLICATES_FILE", "TELEMETRY_FILE", "METRICS_FILE",
+                 "BATCH_MANIFEST", "BATCH_DIR"):
+        monkeypatch.delenv(name, raising=False)
+    # Provider settings are read at import: load the script again for this directory
+    monkeypatch.delitem(sys.modules, "GPT4o_prediction", raising=False)
+    monkeypatch.setattr(batch_mode, "BATCH_MAX_REQUESTS", 2)
+    return BatchRun("gpt4o")
+
+
+def test_prepare_then_ingest_canned_output(batch_run, tmp_path):
+    assert batch_run.prepare() == 5
+    chunks = batch_run.manifest.chunks
+    assert [list(chunk["cases"]) for chunk in chunks] == [["1", "2"], ["3", "4"], ["5"]]
+    assert all(case["images"] == 2 for chunk in chunks for case in chunk["cases"].values())
+    assert os.path.dirname(chunks[0]["file"]) == str(tmp_path / "out.gpt4o.batches")
+    request = read_lines(chunks[0]["file"])[0]
+    assert request["custom_id"] == "Patient1" and request["body"]["model"] == chunks[0]["model"]
+    assert batch_run.prepare() == 0  # every case is waiting in a batch
+
+    # Batch 1 answered both cases, batch 2 failed one request, batch 3 is still running
+    chunks[0].update(status="completed", output_file_id="out-1", error_file_id=None)
+    chunks[1].update(status="completed", output_file_id="out-2", error_file_id="err-2")
+    chunks[2].update(status="in_progress", output_file_id=None, error_file_id=None)
+    batch_run._client = SimpleNamespace(files=FakeFiles({
+        "out-1": jsonl(output_line("Patient2", ANSWER), output_line("Patient1", ANSWER)),
+        "out-2": jsonl(output_line("Patient3", "No classification possible.")),
+        "err-2": jsonl(error_line("Patient4")),
+    }))
+
+    assert batch_run.ingest() == 3
+    assert [chunk["ingested"] for chunk in batch_run.manifest.chunks] == [True, True, False]
+    journal = ResultJournal(batch_run.module.JOURNAL_FILE)
+    assert journal.completed_ids() == {"1", "2", "3"}
+    records = {str(record["Patient ID"]): record for record in journal.latest_records()}
+    assert records["1"]["Combined GPT Response"] == ANSWER
+    assert records["1"]["Kategorien ohne Anamnese"] == "2+3"
+    assert records["1"]["Number of Images"] == 2
+    assert records["3"]["Kategorien ohne Anamnese"] == "N/A"
+    assert batch_run.module.TELEMETRY.summary()
+
+    # Ingesting again does not journal anything twice; the failed case goes into a new batch file
+    assert batch_run.ingest() == 0
+    assert batch_run.prepare() == 1
+    assert list(batch_run.manifest.chunks[-1]["cases"]) == ["4"]
+    assert os.path.basename(batch_run.manifest.chunks[-1]["file"]) == "part-0004.jsonl"
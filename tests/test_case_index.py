@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from case_index import CaseIndex
+
+# -------- STORED SLICE HASHES --------
+
+
+def write_slice(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def test_hash_is_dropped_when_a_slice_is_overwritten_in_place(tmp_path):
+    root, index_path = tmp_path / "ct_scans", str(tmp_path / "case_index.json")
+    root.mkdir()
+    slice_path = str(root / "Patient1_1.png")
+    write_slice(slice_path, b"first version")
+
+    index = CaseIndex(str(root), index_path)
+    index.refresh()
+    index.store_hash(slice_path, "dhash", 0x1234)
+    index.save()
+
+    reloaded = CaseIndex(str(root), index_path)
+    assert reloaded.load()
+    reloaded.refresh()
+    assert reloaded.cached_hash(slice_path, "dhash") == 0x1234
+
+    # Rewriting an existing file does not touch the directory mtime, so the listing is reused
+    dir_mtime = os.stat(root).st_mtime_ns
+    write_slice(slice_path, b"second, longer version")
+    os.utime(root, ns=(dir_mtime, dir_mtime))
+
+    stale = CaseIndex(str(root), index_path)
+    assert stale.load()
+    assert stale.refresh()["dirs_reused"] == 1
+    assert stale.cached_hash(slice_path, "dhash") is None
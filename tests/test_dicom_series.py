@@ -0,0 +1,112 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from dicom_series import (WINDOWS, DicomSeries, apply_window, read_pixels, sample_indices, synthetic_volume,
+                          to_hounsfield, window_volume, write_synthetic_series)
+
+pydicom = pytest.importorskip("pydicom")
+
+# -------- WINDOWING AND SAMPLING --------
+
+
+def test_apply_window_clips_and_scales_to_uint8():
+    hu = np.array([-1000, 0, 20, 40, 60, 80, 3000], dtype=np.float32)
+    windowed = apply_window(hu, center=40, width=80)
+    assert windowed.dtype == np.uint8
+    assert windowed.tolist() == [0, 0, 63, 127, 191, 255, 255]
+
+
+def test_window_volume_keeps_the_shape_and_stacks_multi_as_rgb():
+    hu = np.linspace(-200, 1500, 2 * 4 * 5, dtype=np.float32).reshape(2, 4, 5)
+    assert window_volume(hu, "bone").shape == (2, 4, 5)
+    multi = window_volume(hu, "multi")
+    assert multi.shape == (2, 4, 5, 3)
+    for channel, name in enumerate(("brain", "subdural", "bone")):
+        np.testing.assert_array_equal(multi[..., channel], apply_window(hu, *WINDOWS[name]))
+    with pytest.raises(ValueError):
+        window_volume(hu, "lung")
+
+
+@pytest.mark.parametrize("total, count, expected", [
+    (24, 8, [0, 3, 7, 10, 13, 16, 20, 23]),
+    (24, 2, [0, 23]),
+    (5, 0, [0, 1, 2, 3, 4]),
+    (5, 9, [0, 1, 2, 3, 4]),
+    (0, 4, []),
+])
+def test_sample_indices(total, count, expected):
+    assert sample_indices(total, count) == expected
+
+
+# -------- SYNTHETIC SERIES ON DISK --------
+N_SLICES, SIZE = 12, 32
+
+
+@pytest.fixture
+def series_paths(tmp_path):
+    paths = write_synthetic_series(str(tmp_path), "7", n_slices=N_SLICES, size=SIZE, seed=3)
+    # File names that sort differently from the slice positions: order must come from the headers
+    renamed = []
+    for i, path in enumerate(paths):
+        target = os.path.join(os.path.dirname(path), f"img_{(i * 7) % N_SLICES:02d}.dcm")
+        os.rename(path, target)
+        renamed.append(target)
+    return renamed
+
+
+def expected_hu():
+    """What write_synthetic_series stores (12-bit, intercept -1024), back in HU."""
+    return np.clip(synthetic_volume(N_SLICES, SIZE, seed=3) + 1024, 0, 4095).astype(np.int16) - np.float32(1024)
+
+
+def test_series_is_ordered_by_slice_position(series_paths):
+    series = DicomSeries(list(reversed(series_paths)))
+    assert len(series) == N_SLICES
+    positions = [float(pydicom.dcmread(path, stop_before_pixels=True).ImagePositionPatient[2])
+                 for path, _ in series.frames]
+    assert positions == sorted(positions) and len(set(positions)) == N_SLICES
+    assert [path for path, _ in series.frames] == series_paths
+
+
+def test_uncompressed_pixels_are_memory_mapped(series_paths):
+    pixels, slope, intercept = read_pixels(series_paths[4])
+    assert isinstance(pixels, np.memmap)
+    assert (slope, intercept) == (1.0, -1024.0)
+    np.testing.assert_array_equal(pixels, pydicom.dcmread(series_paths[4]).pixel_array)
+    np.testing.assert_array_equal(to_hounsfield(pixels, slope, intercept), expected_hu()[4])
+
+
+@pytest.mark.parametrize("transfer_syntax", ["RLELossless", "DeflatedExplicitVRLittleEndian"])
+def test_encoded_pixels_are_decoded_by_pydicom(series_paths, tmp_path, transfer_syntax):
+    from pydicom import uid
+
+    ds = pydicom.dcmread(series_paths[4])
+    target = str(tmp_path / f"{transfer_syntax}.dcm")
+    if transfer_syntax == "RLELossless":
+        ds.compress(uid.RLELossless)
+    else:
+        ds.file_meta.TransferSyntaxUID = uid.DeflatedExplicitVRLittleEndian
+    ds.save_as(target, enforce_file_format=True)
+
+    pixels, _, _ = read_pixels(target)
+    assert not isinstance(pixels, np.memmap)
+    np.testing.assert_array_equal(pixels, read_pixels(series_paths[4])[0])
+
+
+@pytest.mark.parametrize("window", ["brain", "subdural", "multi"])
+def test_rendered_slices_carry_the_windowed_values(series_paths, window):
+    series = DicomSeries(series_paths)
+    images = series.render(count=4, window=window)
+    indices = sample_indices(N_SLICES, 4)
+    expected = window_volume(expected_hu()[indices], window)
+    assert len(images) == len(indices)
+    for image, pixels in zip(images, expected):
+        assert image.mode == ("RGB" if window == "multi" else "L")
+        np.testing.assert_array_equal(np.asarray(image), pixels)
+
+    sampled = series.sample(count=4, window=window)
+    np.testing.assert_array_equal(np.asarray(sampled[1].render()), expected[1])
+    assert sampled[1].cache_tag == f"dicom:0:{window}"
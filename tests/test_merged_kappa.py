@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "predictions"))
+sys.path.insert(0, os.path.join(ROOT, "plots"))
+from multi_provider import merged_table
+from cohen_kappa_plots import comparison_columns, kappa_metrics, sheet_comparisons
+from kappa_engine import comparison_kappa_stats
+from resampling import permutation_test_history
+
+# -------- MERGED TABLE WITH A PROVIDER THAT MISSED CASES --------
+
+REFERENCE = ["2+3", "3", "1", "4", "5", "1+3"]
+
+
+def answer(without: str, with_: str) -> str:
+    return (f"Without medical history:\n- Category: {without}\n- Likert confidence: 3\n\n"
+            f"With medical history:\n- Category: {with_}\n- Likert confidence: 4\n")
+
+
+def provider_frame(answers: dict, response_column: str) -> pd.DataFrame:
+    return pd.DataFrame({"Patient ID": list(answers), response_column: list(answers.values())})
+
+
+def merged():
+    sheet = pd.DataFrame({"Reihenfolge Bilder": range(1, 7), "Radiologist Prediction": REFERENCE})
+    results = {
+        # GPT-4o answered every case
+        "gpt4o": provider_frame({i: answer(label, label) for i, label in enumerate(REFERENCE, start=1)},
+                                "Combined GPT Response"),
+        # Grok has no answer for patients 2 and 5 and an unparsable one for patient 4
+        "grok": provider_frame({1: answer("2+3", "2+3"), 3: answer("1", "3"), 4: "No classification possible.",
+                                6: answer("1+3", "1+3")}, "Grok Response"),
+    }
+    return merged_table(sheet, results, {"gpt4o": "GPT-4o", "grok": "grok-4-fast-reasoning"})
+
+
+def test_missing_answers_stay_empty_in_the_merged_table():
+    table = merged()
+    grok = table["grok-4-fast-reasoning-without-medical history"]
+    assert grok.isna().tolist() == [False, True, False, True, True, False]
+    assert table["GPT-4o-with-medical history"].tolist() == REFERENCE
+
+
+def test_kappa_treats_missing_answers_as_no_category():
+    table = merged()
+    pairs = sheet_comparisons(table.columns)
+    assert ("grok-4-fast-reasoning-with-medical history", "Radiologist Prediction") in pairs
+
+    metrics = kappa_metrics(table[comparison_columns(pairs)], pairs, n_resamples=200, seed=0, workers=0)
+    kappa = dict(zip(metrics["rater"], metrics["kappa"]))
+    assert kappa["GPT-4o-without-medical history"] == 1.0
+    assert kappa["grok-4-fast-reasoning-without-medical history"] < 1.0
+    assert np.isfinite(metrics[["err_low", "err_high"]].to_numpy(dtype=float)).all()
+
+    # Same numbers as writing the "no answer" label out explicitly
+    explicit = table.fillna("N/A")
+    means, _ = comparison_kappa_stats(explicit, pairs)
+    np.testing.assert_array_equal(metrics["kappa"].to_numpy(), means)
+
+    history = permutation_test_history(table, pairs, n_resamples=200, seed=0, workers=0)
+    assert len(history) == 2
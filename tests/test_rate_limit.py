@@ -0,0 +1,211 @@
+import os
+import sys
+import threading
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+import rate_limit
+from rate_limit import (CircuitBreaker, ProviderLimiter, TokenBucket, is_retryable, parse_duration,
+                        retry_after_seconds)
+
+# -------- FAKE CLOCK --------
+# rate_limit reads time.monotonic / time.time / time.sleep and waits on
+# threading.Condition; both are replaced so that every wait advances the fake
+# clock instantly and the tests never sleep.
+
+
+class FakeClock:
+    def __init__(self, start: float = 1_000.0):
+        self.now = start
+        self.slept = []
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def time(self) -> float:
+        return 1_700_000_000.0 + self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class FakeCondition:
+    """Single-threaded Condition: a timed wait advances the clock, an untimed one runs `on_block`."""
+
+    def __init__(self, clock: FakeClock):
+        self.clock = clock
+        self.on_block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def wait(self, timeout=None):
+        if timeout is None:
+            assert self.on_block is not None, "would block forever"
+            self.on_block()
+        else:
+            self.clock.now += timeout
+
+    def notify_all(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(rate_limit, "time", fake)
+    monkeypatch.setattr(rate_limit, "threading",
+                        SimpleNamespace(Condition=lambda: FakeCondition(fake), Lock=threading.Lock))
+    return fake
+
+
+class StatusError(Exception):
+    def __init__(self, status: int, headers=None):
+        super().__init__(f"HTTP {status}")
+        self.response = SimpleNamespace(status_code=status, headers=headers or {})
+
+
+def flaky(*errors, result="ok"):
+    """fn raising the given exceptions in turn, then returning `result`; counts its calls."""
+    remaining = list(errors)
+
+    def fn():
+        fn.calls += 1
+        if remaining:
+            raise remaining.pop(0)
+        return result
+    fn.calls = 0
+    return fn
+
+
+# -------- TOKEN BUCKETS --------
+def test_token_bucket_waits_for_the_refill(clock):
+    bucket = TokenBucket(per_minute=60)
+    assert sum(bucket.acquire() for _ in range(60)) == 0
+    assert bucket.acquire() == pytest.approx(1.0)  # one request per second once the burst is spent
+    clock.now += 30
+    assert sum(bucket.acquire() for _ in range(30)) == 0
+    assert bucket.acquire(10) == pytest.approx(10.0)
+
+
+def test_token_bucket_clamps_requests_larger_than_its_capacity(clock):
+    bucket = TokenBucket(per_minute=1000)
+    assert bucket.acquire(5000) == 0
+    assert bucket.acquire(500) == pytest.approx(30.0)
+
+
+# -------- RETRY-AFTER AND RATE LIMIT HEADERS --------
+@pytest.mark.parametrize("value, seconds", [("1.5", 1.5), ("20ms", 0.02), ("6m0s", 360.0), ("1h2m", 3720.0),
+                                            ("soon", None)])
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+def test_retry_after_seconds(clock):
+    assert retry_after_seconds({}) is None
+    assert retry_after_seconds({"Retry-After": "7"}) == 7.0
+    assert retry_after_seconds({"retry-after-ms": "1500", "Retry-After": "7"}) == 1.5
+    http_date = format_datetime(datetime.fromtimestamp(clock.time() + 120, tz=timezone.utc), usegmt=True)
+    assert retry_after_seconds({"Retry-After": http_date}) == pytest.approx(120.0)
+
+
+def test_retry_after_pauses_the_provider_and_wins_over_backoff(clock):
+    limiter = ProviderLimiter("test", max_attempts=3, base_delay=0.0, max_delay=1.0)
+    fn = flaky(StatusError(429, {"Retry-After": "12"}))
+    assert limiter.call(fn) == "ok"
+    assert fn.calls == 2
+    assert clock.slept == [12.0]  # above max_delay: the server's hint wins
+    assert limiter.retries == 1
+    assert limiter.paused_until == pytest.approx(1_000.0 + 12.0)
+
+
+def test_exhausted_rate_limit_headers_pause_every_caller(clock):
+    limiter = ProviderLimiter("test")
+    limiter.observe_headers({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2.5s"})
+    limiter.observe_headers({"x-ratelimit-remaining-tokens": "10", "x-ratelimit-reset-tokens": "30s"})
+    limiter.acquire()
+    assert clock.slept == [2.5]
+    assert limiter.throttled_seconds == pytest.approx(2.5)
+
+
+def test_non_retryable_errors_are_raised_at_once(clock):
+    limiter = ProviderLimiter("test", max_attempts=5)
+    fn = flaky(StatusError(400))
+    with pytest.raises(StatusError):
+        limiter.call(fn)
+    assert fn.calls == 1
+    assert limiter.breaker.failures == 0
+
+
+# -------- RETRYABLE ERRORS --------
+class APIConnectionError(Exception):
+    pass
+
+
+class ReadTimeout(Exception):
+    pass
+
+
+@pytest.mark.parametrize("exc, retryable", [
+    (StatusError(429), True),
+    (StatusError(503), True),
+    (StatusError(400), False),
+    (StatusError(401), False),
+    (SimpleNamespace(code=500), True),  # google.api_core style
+    (APIConnectionError("reset"), True),
+    (ReadTimeout("read"), True),
+    (ConnectionResetError(), True),
+    (TimeoutError(), True),
+    (ValueError("bad JSON"), False),
+    (KeyError("choices"), False),
+])
+def test_is_retryable(exc, retryable):
+    assert is_retryable(exc) is retryable
+
+
+# -------- CIRCUIT BREAKER --------
+def test_breaker_holds_callers_for_the_cooldown_then_lets_one_trial_through(clock):
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=30.0)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now += 10
+    assert breaker.before_call() == pytest.approx(20.0)  # sleeps out the rest of the cooldown
+    assert breaker.state == "half-open" and breaker.trial_running
+
+    breaker.record_failure()  # failed trial: open for another cooldown
+    assert breaker.state == "open" and not breaker.trial_running
+    assert breaker.before_call() == pytest.approx(30.0)
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.failures == 0
+    assert breaker.before_call() == 0
+
+
+def test_breaker_callers_wait_for_the_running_trial(clock):
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=5.0)
+    breaker.record_failure()
+    breaker.before_call()  # first caller becomes the trial
+    assert breaker.trial_running
+
+    # A second caller blocks until the trial reports back instead of making a call of its own
+    breaker._cond.on_block = breaker.record_success
+    assert breaker.before_call() == 0
+    assert breaker.state == "closed" and not breaker.trial_running
+
+
+def test_open_breaker_delays_calls_instead_of_failing_them(clock):
+    limiter = ProviderLimiter("test", max_attempts=4, base_delay=0.0, failure_threshold=2, cooldown=30.0)
+    fn = flaky(StatusError(503), StatusError(503))
+    assert limiter.call(fn) == "ok"
+    assert fn.calls == 3
+    assert limiter.breaker.state == "closed"
+    assert limiter.throttled_seconds == pytest.approx(30.0)
@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from replicates import fan_out
+from telemetry import Telemetry
+
+# -------- FAN-OUT OF REPLICATE SAMPLES --------
+
+
+def test_fan_out_samples_count_towards_the_case_trace(tmp_path):
+    telemetry = Telemetry("test", jsonl_path=str(tmp_path / "telemetry.jsonl"))
+    threads = set()
+
+    def sample() -> str:
+        threads.add(threading.current_thread().name)
+        with telemetry.stage("api_call"):
+            telemetry.record_usage("gpt-4o", 1000, 50)
+        return "answer"
+
+    worker = telemetry.instrument(lambda prepared: {"texts": fan_out(sample, 3)}, lambda prepared: prepared["id"])
+    assert worker({"id": 7}) == {"texts": ["answer"] * 3}
+    assert all(name.startswith("replicate") for name in threads)
+
+    with open(tmp_path / "telemetry.jsonl", "r", encoding="utf-8") as f:
+        record = json.loads(f.readline())
+    assert record["case"] == 7 and record["status"] == "ok"
+    assert record["counts"] == {"api_call": 3}
+    assert (record["prompt_tokens"], record["completion_tokens"]) == (3000, 150)
+
+
+def test_fan_out_returns_every_sample():
+    answers = iter(["a", "b", "c", "d"])
+    lock = threading.Lock()
+
+    def sample() -> str:
+        with lock:
+            return next(answers)
+
+    assert sorted(fan_out(sample, 4)) == ["a", "b", "c", "d"]
+    assert fan_out(lambda: "only", 1) == ["only"]
+    assert fan_out(lambda: "never", 0) == []
@@ -0,0 +1,43 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+import response_cache
+from response_cache import ResponseCache
+
+# -------- EVICTION AND REPLAY --------
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    """Cache file with three answers stored 100, 50 and 10 days ago."""
+    path = str(tmp_path / "response_cache.sqlite")
+    now = 1_700_000_000.0
+    cache = ResponseCache(path, mode="readwrite")
+    for key, days in (("a", 100), ("b", 50), ("c", 10)):
+        monkeypatch.setattr(response_cache.time, "time", lambda t=now - days * 86400: t)
+        cache.put(key, "openai", "gpt-4o", f"answer {key}")
+    monkeypatch.setattr(response_cache.time, "time", lambda: now)
+    return path
+
+
+def stored(path: str) -> list:
+    cache = ResponseCache(path, mode="replay", max_entries=0)
+    return [key for key in "abc" if cache.get(key) is not None]
+
+
+def test_opening_in_replay_mode_keeps_every_answer(archive):
+    replay = ResponseCache(archive, mode="replay", max_entries=1, max_age_days=30)
+    assert replay.get("c") == "answer c"
+    assert stored(archive) == ["a", "b", "c"]
+
+
+def test_opening_in_readwrite_mode_drops_expired_answers(archive):
+    ResponseCache(archive, mode="readwrite", max_entries=2, max_age_days=75)
+    assert stored(archive) == ["b", "c"]
+
+
+def test_opening_in_readwrite_mode_keeps_the_most_recently_used(archive):
+    ResponseCache(archive, mode="readwrite", max_entries=1)
+    assert stored(archive) == ["c"]
@@ -0,0 +1,92 @@
+import os
+import sys
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+from response_parser import RESULT_COLUMNS, parse_response, parse_responses
+
+# -------- ANSWERS AS THE PROVIDERS WRITE THEM --------
+
+GPT_ANSWER = """1. Hypothetical classification without medical history:
+- Category: 2+3
+- Reasoning: Hyperdense intraparenchymal lesion with surrounding contusion.
+- Likert confidence: 3
+
+2. Hypothetical classification with medical history:
+- Category: 3
+- Reasoning: History of fall supports a contusional origin.
+- Likert confidence: 4
+"""
+
+GPT_NAMED_ANSWER = """**Without medical history**
+Chosen category: 3 – Kontusionsblutung, 1 – Traumatische SAB
+Reasoning: Frontobasal hyperdensities with blood in the adjacent sulci.
+Likert confidence (1–5): 4
+
+**With medical history**
+Chosen category: 3 – Kontusionsblutung
+Reasoning: The reported fall fits a contusion.
+Likert confidence (1–5): 5
+"""
+
+GEMINI_ANSWER = """## Classification without medical history
+**Category:** 1 - Traumatische SAB, 3 - Kontusionsblutung
+**Reasoning:** Sulcal hyperdensity over the convexity and a small cortical contusion.
+**Confidence level (1–5 scale):** 3
+
+## Classification with medical history
+**Categories:** 1 and 3
+**Reasoning:** The trauma history makes both findings traumatic.
+**Confidence level (1–5 scale):** 4
+"""
+
+GROK_ANSWER = """Without medical history:
+Categories:
+- 4 – Aneurysmatische SAB
+- 5 – Sonstige
+Likert-Skala: 2/5
+
+With medical history:
+Kategorie 4 – Aneurysmatische SAB
+Likert-Skala: 4/5
+"""
+
+
+@pytest.mark.parametrize("text, expected", [
+    (GPT_ANSWER, ("2+3", "3", 3, 4)),
+    (GPT_NAMED_ANSWER, ("1+3", "3", 4, 5)),
+    (GEMINI_ANSWER, ("1+3", "1+3", 3, 4)),
+    (GROK_ANSWER, ("4+5", "4", 2, 4)),
+])
+def test_parse_response_reads_every_category_and_likert(text, expected):
+    assert tuple(parse_response(text)[col] for col in RESULT_COLUMNS) == expected
+
+
+@pytest.mark.parametrize("line, expected", [
+    ("Chosen category: 3 – Kontusionsblutung, 1 – Traumatische SAB", "1+3"),
+    ("Category: 1 - Traumatische SAB, 3 - Kontusionsblutung", "1+3"),
+    ("Category: 3 (Kontusionsblutung) and 2 (SDH)", "2+3"),
+    ("- Category: 2+3", "2+3"),
+    ("Kategorien: 3, 1", "1+3"),
+    ("Category (1-5): 2", "2"),
+    ("Category: 2 (Subdural), confidence 4", "2"),
+])
+def test_category_line_variants(line, expected):
+    assert parse_response(line)["Kategorien ohne Anamnese"] == expected
+
+
+def test_missing_values_are_none():
+    parsed = parse_response("I cannot classify these images.")
+    assert all(parsed[col] is None for col in RESULT_COLUMNS)
+
+
+def test_parse_responses_matches_parse_response():
+    texts = pd.Series([GPT_ANSWER, GPT_NAMED_ANSWER, GEMINI_ANSWER, GROK_ANSWER, None, GPT_ANSWER], index=list("abcdef"))
+    frame = parse_responses(texts)
+    assert list(frame.index) == list("abcdef")
+    for label, text in texts.items():
+        expected = parse_response(text)
+        for col in RESULT_COLUMNS:
+            value = frame.at[label, col]
+            assert (None if pd.isna(value) else value) == expected[col]
@@ -0,0 +1,36 @@
+import os
+import sys
+import warnings
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plots"))
+from self_consistency import condition_stats
+
+# -------- INTRA-MODEL AGREEMENT --------
+CATEGORY, LIKERT = "Kategorien ohne Anamnese", "Likert-Skala ohne Anamnese"
+
+
+def replicate_table(answers: dict) -> pd.DataFrame:
+    """{patient: [(category, likert) per replicate]} -> long replicate table."""
+    rows = [{"Patient ID": pid, "replicate": i, CATEGORY: category, LIKERT: likert}
+            for pid, samples in answers.items() for i, (category, likert) in enumerate(samples)]
+    return pd.DataFrame(rows)
+
+
+def test_identical_labels_give_nan_kappa_without_warnings():
+    table = replicate_table({"1": [("2", 3), ("2", 3)], "2": [("2", 4), ("2", 5)]})
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        stats = condition_stats(table, CATEGORY, LIKERT)
+    assert np.isnan(stats["pairwise_kappa"]) and np.isnan(stats["fleiss_kappa"])
+    assert stats["category_disagreement"] == 0.0
+    assert stats["likert_disagreement"] == 0.5
+
+
+def test_replicates_that_agree_on_varying_labels_have_kappa_one():
+    table = replicate_table({"1": [("1", 3)] * 3, "2": [("2+3", 4)] * 3, "3": [("5", 2)] * 3})
+    stats = condition_stats(table, CATEGORY, LIKERT)
+    assert stats["replicates"] == 3 and stats["cases"] == 3
+    assert stats["pairwise_kappa"] == 1.0 and stats["fleiss_kappa"] == 1.0
+    assert stats["likert_variance"] == 0.0
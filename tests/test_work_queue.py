@@ -0,0 +1,110 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "predictions"))
+import work_queue
+from work_queue import WorkQueue
+
+# -------- LEASED SQLITE QUEUE --------
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1_000.0
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(work_queue, "time", fake)
+    return fake
+
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    queue = WorkQueue(str(tmp_path / "out.queue.sqlite"), lease_seconds=60, max_attempts=2)
+    queue.enqueue("gpt4o", [3, 1.0, " 2 "])
+    yield queue
+    queue.close()
+
+
+def status(queue, patient_id):
+    return queue._db.execute("SELECT status, worker, attempts FROM cases WHERE patient_id = ?",
+                             (patient_id,)).fetchone()
+
+
+def test_enqueue_is_idempotent_and_keeps_sheet_order(queue):
+    assert queue.enqueue("gpt4o", [3, 1, 2, 4]) == 1
+    assert queue.enqueue("grok", [3]) == 1
+    assert queue.claim("gpt4o", "a", limit=10) == ["3", "1", "2", "4"]
+    assert queue.counts("gpt4o") == {"pending": 0, "leased": 4, "done": 0, "failed": 0}
+    assert queue.counts("grok")["pending"] == 1
+
+
+def test_claimed_cases_are_not_handed_out_twice(queue):
+    assert queue.claim("gpt4o", "a") == ["3"]
+    assert queue.claim("gpt4o", "b", limit=5) == ["1", "2"]
+    assert queue.claim("gpt4o", "c") == []
+    assert queue.claimable("gpt4o") == 0
+    assert queue.active_leases("gpt4o", "a") == 2
+
+
+def test_expired_lease_is_claimed_again_and_renew_keeps_it(queue, clock):
+    queue.claim("gpt4o", "a", limit=3)
+    clock.now += 50
+    assert queue.renew("a") == 3
+    clock.now += 50  # 100 s after the claim, but only 50 s after the renewal
+    assert queue.claim("gpt4o", "b") == []
+
+    clock.now += 11
+    assert queue.claimable("gpt4o") == 3
+    assert queue.claim("gpt4o", "b") == ["3"]
+    assert status(queue, "3") == ("leased", "b", 2)
+
+
+def test_complete_needs_the_current_lease(queue, clock):
+    queue.claim("gpt4o", "a")
+    clock.now += 61
+    queue.claim("gpt4o", "b")  # a's lease ran out, b owns patient 3 now
+
+    assert not queue.complete("gpt4o", 3, "a", failed=True)
+    assert status(queue, "3") == ("leased", "b", 2)
+    assert queue.complete("gpt4o", 3, "b")
+    assert status(queue, "3") == ("done", "b", 2)
+    assert not queue.complete("gpt4o", 3, "b")  # already done
+
+
+def test_retry_hands_the_case_back_until_attempts_run_out(queue):
+    queue.claim("gpt4o", "a")
+    queue.retry("gpt4o", 3, "a")
+    assert status(queue, "3") == ("pending", "a", 1)
+    queue.retry("gpt4o", 3, "b")  # not b's lease: ignored
+    assert status(queue, "3")[0] == "pending"
+
+    assert queue.claim("gpt4o", "a") == ["3"]
+    queue.retry("gpt4o", 3, "a")
+    assert status(queue, "3") == ("failed", "a", 2)
+
+    queue.enqueue("gpt4o", [], retry_failed=True)
+    assert status(queue, "3") == ("pending", None, 0)
+
+
+def test_expired_lease_without_attempts_left_is_failed(queue, clock):
+    for worker in ("a", "b"):
+        assert queue.claim("gpt4o", worker) == ["3"]
+        clock.now += 61
+    assert queue.claim("gpt4o", "c") == ["1"]
+    assert status(queue, "3") == ("failed", "b", 2)
+
+
+def test_release_returns_leases_without_counting_the_attempt(queue):
+    queue.claim("gpt4o", "a", limit=2)
+    queue.claim("gpt4o", "b")
+    assert queue.release("a") == 2
+    assert status(queue, "3") == ("pending", "a", 0)
+    assert status(queue, "2") == ("leased", "b", 1)
+    assert queue.claim("gpt4o", "c", limit=5) == ["3", "1"]